@@ -0,0 +1,565 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+import os, sys, bz2, gzip, lzma, tarfile, collections, functools, subprocess, contextlib, time, queue, threading, multiprocessing, shutil
+from concurrent import futures
+from logging import info, warn
+from zeroinstall import SafeException
+
+import tracing, tardigest
+
+# bzip2 -9 works on blocks of 900k, so splitting the input here costs
+# (almost) nothing in compression ratio.
+BLOCK_SIZE = 900 * 1000
+
+class Format:
+	"""A compressed tar format.
+	@ivar extension: the file extension, which is also the name used in the feed and on the command line
+	@ivar level: default compression level
+	@ivar block_size: amount of input to compress in each independent block
+	@ivar open_decompressed: opens a file in this format for reading, as a stream of the uncompressed data"""
+	def __init__(self, extension, level, block_size, compressor, open_decompressed, command = None):
+		self.extension = extension
+		self.level = level
+		self.block_size = block_size
+		self.compressor = compressor
+		self.open_decompressed = open_decompressed
+		self.command = command
+
+	def is_available(self):
+		"""Can we use this format here? (Formats handled by a command need it to be installed.)"""
+		return self.command is None or shutil.which(self.command) is not None
+
+	def get_compress_function(self, level):
+		if level is None:
+			level = self.level
+		return functools.partial(self.compressor, level)
+
+def _compress_bz2(level, data):
+	return bz2.compress(data, level)
+
+def _compress_gz(level, data):
+	return gzip.compress(data, level, mtime = 0)
+
+def _compress_xz(level, data):
+	return lzma.compress(data, preset = level)
+
+# All of these formats allow a file to consist of several independently
+# compressed streams, which is what lets ParallelCompressor split the work.
+# Python has no zstd module, so that is handled by the (multithreaded) zstd command.
+formats = [
+	Format('tar.bz2', 9, BLOCK_SIZE, _compress_bz2, bz2.open),
+	Format('tar.gz', 6, 4 * 1024 * 1024, _compress_gz, gzip.open),
+	Format('tar.xz', 6, 24 * 1024 * 1024, _compress_xz, lzma.open),
+	Format('tar.zst', 19, None, None, None, command = 'zstd'),
+]
+
+default_format = formats[0]
+
+def get_format(name):
+	"""Get a Format by name ("tar.xz", etc).
+	@raise SafeException: if the format is unknown"""
+	for f in formats:
+		if f.extension == name:
+			return f
+	raise SafeException("Unknown archive format '%s'. Supported formats are: %s" % (name, ', '.join(f.extension for f in formats)))
+
+def get_format_for_file(archive_file):
+	"""Get the Format of archive_file, based on its extension.
+	>>> get_format_for_file('foo-1.0.tar.xz').extension
+	'tar.xz'
+	>>> get_format_for_file('foo-1.0.zip')
+	Traceback (most recent call last):
+		...
+	zeroinstall.SafeException: Don't know how to handle archive 'foo-1.0.zip' (supported types are .tar.bz2, .tar.gz, .tar.xz, .tar.zst)
+	"""
+	for f in formats:
+		if archive_file.endswith('.' + f.extension):
+			return f
+	raise SafeException("Don't know how to handle archive '%s' (supported types are %s)" %
+			(archive_file, ', '.join('.' + f.extension for f in formats)))
+
+def get_jobs(jobs):
+	"""The number of compression processes to use for the --compression-jobs setting."""
+	if jobs is None or jobs <= 0:
+		return os.cpu_count() or 1
+	return jobs
+
+_worker_context = None
+
+def _get_worker_context():
+	"""The multiprocessing context for compression workers. Archives are made while other
+	threads (pipeline stages, Prefetchers) are running, and forking a threaded process can
+	leave the child waiting for a lock that no thread in it will ever release. So workers are
+	forked from a separate, single-threaded server process instead (or spawned, if that isn't
+	supported). The server imports this module once, so that each worker starts quickly."""
+	global _worker_context
+	if _worker_context is None:
+		if 'forkserver' in multiprocessing.get_all_start_methods():
+			_worker_context = multiprocessing.get_context('forkserver')
+			_worker_context.set_forkserver_preload(['__main__', __name__])
+		else:
+			_worker_context = multiprocessing.get_context('spawn')
+	return _worker_context
+
+class ParallelCompressor:
+	"""A write-only file-like object which splits the data written to it into
+	blocks, compresses each block independently in a pool of worker processes and
+	writes the results to stream in order. Each compressed block is a complete bzip2
+	stream, and bzip2 readers (including bunzip2 and tarfile) treat a sequence of
+	streams as the concatenation of their contents."""
+
+	def __init__(self, stream, jobs = None, compress = functools.partial(_compress_bz2, 9), block_size = BLOCK_SIZE):
+		self.stream = stream
+		self.compress = compress
+		self.block_size = block_size
+		self.jobs = get_jobs(jobs)
+		self.buffer = bytearray()
+		self.pending = collections.deque()
+		self.blocks = 0
+		if self.jobs > 1 and sys.version_info >= (3, 7):
+			self.pool = futures.ProcessPoolExecutor(max_workers = self.jobs, mp_context = _get_worker_context())
+		else:
+			# (Python 3.6 can only fork the workers, which isn't safe here; compress in this process instead)
+			self.pool = None
+
+	def write(self, data):
+		self.buffer += data
+		while len(self.buffer) >= self.block_size:
+			block = bytes(self.buffer[:self.block_size])
+			del self.buffer[:self.block_size]
+			self._submit(block)
+		return len(data)
+
+	def _submit(self, block):
+		self.blocks += 1
+		if self.pool is None:
+			self.stream.write(self.compress(block))
+			return
+		self.pending.append(self.pool.submit(self.compress, block))
+		# Don't let the reader get too far ahead of the compressors
+		while len(self.pending) > 2 * self.jobs:
+			self.stream.write(self.pending.popleft().result())
+
+	def close(self):
+		"""Compress any remaining data and wait for all blocks to be written.
+		Does not close the underlying stream."""
+		try:
+			if self.buffer or not self.blocks:
+				self._submit(bytes(self.buffer))
+				self.buffer = bytearray()
+			while self.pending:
+				self.stream.write(self.pending.popleft().result())
+		finally:
+			self._shutdown()
+
+	def _shutdown(self):
+		# (shutdown's cancel_futures argument needs Python 3.9)
+		for future in self.pending:
+			future.cancel()
+		self.pending.clear()
+		if self.pool is not None:
+			self.pool.shutdown()
+			self.pool = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self._shutdown()
+
+class ExternalCompressor:
+	"""A write-only file-like object which compresses the data written to it using
+	an external command (which does its own multithreading) and writes the result to stream."""
+
+	def __init__(self, stream, command, jobs = None, level = None):
+		self.child = tracing.Popen([command, '-q', '-c', '-T%d' % get_jobs(jobs), '-%d' % level],
+					stdin = subprocess.PIPE, stdout = stream)
+		self.command = command
+
+	def write(self, data):
+		self.child.stdin.write(data)
+		return len(data)
+
+	def close(self):
+		self.child.stdin.close()
+		code = self.child.wait()
+		if code:
+			raise SafeException("%s failed with exit code %d" % (self.command, code))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.child.kill()
+			self.child.wait()
+
+def open_compressor(stream, archive_format, jobs = None, level = None):
+	"""Return a file-like object that writes data compressed with archive_format to stream."""
+	if level is None:
+		level = archive_format.level
+	if archive_format.command:
+		return ExternalCompressor(stream, archive_format.command, jobs, level)
+	return ParallelCompressor(stream, jobs, archive_format.get_compress_function(level), archive_format.block_size)
+
+@contextlib.contextmanager
+def open_tarball(archive_file):
+	"""Open a compressed tarball for reading, in any supported format.
+	The result is a stream, so members must be processed in order (see iter_members)."""
+	archive_format = get_format_for_file(archive_file)
+	if archive_format.command:
+		child = tracing.Popen([archive_format.command, '-q', '-d', '-c', archive_file], stdout = subprocess.PIPE)
+		try:
+			with tarfile.open(fileobj = child.stdout, mode = 'r|') as tar:
+				yield tar
+		finally:
+			child.stdout.close()
+			code = child.wait()
+		if code:
+			raise SafeException("%s failed with exit code %d" % (archive_format.command, code))
+	else:
+		# (tarfile's own 'r|bz2' mode, etc, stops at the end of the first compressed stream)
+		with archive_format.open_decompressed(archive_file, 'rb') as stream:
+			with tarfile.open(fileobj = stream, mode = 'r|') as tar:
+				yield tar
+
+def iter_members(tar):
+	"""Iterate over the members of a tarball opened with open_tarball. Unlike iterating
+	over tar itself, this doesn't keep every TarInfo in tar.members, so memory use doesn't
+	grow with the size of the archive."""
+	while True:
+		member = tar.next()
+		if member is None:
+			return
+		tar.members = []
+		yield member
+
+# Stop reading ahead of the writer threads when this much data is waiting to be written
+MAX_PENDING_WRITE = 64 * 1024 * 1024
+
+def _write_file(path, data, mode, mtime):
+	with open(path, 'wb', buffering = 1024 * 1024) as stream:
+		stream.write(data)
+	os.chmod(path, mode)
+	os.utime(path, (mtime, mtime))
+
+def _get_extract_path(target, name):
+	parts = name.split('/')
+	if name.startswith('/') or '..' in parts:
+		raise SafeException("Refusing to extract '%s' (outside the target directory)" % name)
+	return os.path.join(target, *[p for p in parts if p and p != '.'])
+
+def extract_tarball(archive_file, target = '.', readonly = False, jobs = None):
+	"""Extract archive_file into target in a single pass over the archive.
+	Directories are created as they are seen, while file contents are written by a
+	pool of threads. Modes are normalised (so that we can always delete the result).
+	If readonly is set, everything below the top-level entries is also made read-only
+	(support.remove_tree can still delete the result).
+	@param jobs: number of writer threads (None for the default)"""
+	directories = []
+	writing = {}			# Path -> future, for files still being written (for hard links)
+	pending = collections.deque()	# (path, future, size), in the order submitted
+	pending_size = 0
+	n_files = 0
+	start = time.time()
+
+	def wait_for(path, future, size):
+		nonlocal pending_size
+		future.result()
+		pending_size -= size
+		if writing.get(path) is future:
+			del writing[path]
+
+	with futures.ThreadPoolExecutor(max_workers = jobs) as pool:
+		try:
+			with open_tarball(archive_file) as tar:
+				for member in iter_members(tar):
+					if member.name == 'pax_global_header': continue
+
+					path = _get_extract_path(target, member.name)
+					mode = (member.mode | 0o600) & 0o755
+					if readonly and '/' in member.name.strip('/'):
+						mode &= 0o555
+
+					if member.isdir():
+						os.makedirs(path, exist_ok = True)
+						directories.append((path, mode, member.mtime))
+						continue
+
+					parent = os.path.dirname(path)
+					if parent and not os.path.isdir(parent):
+						os.makedirs(parent)
+
+					if member.isfile():
+						data = tar.extractfile(member).read()
+						future = pool.submit(_write_file, path, data, mode, member.mtime)
+						writing[path] = future
+						pending.append((path, future, len(data)))
+						pending_size += len(data)
+						n_files += 1
+						# (forget finished writes, so that memory use doesn't grow with the archive)
+						while pending and (pending_size > MAX_PENDING_WRITE or pending[0][1].done()):
+							wait_for(*pending.popleft())
+					elif member.issym():
+						if os.path.lexists(path):
+							os.unlink(path)
+						os.symlink(member.linkname, path)
+					elif member.islnk():
+						link_target = _get_extract_path(target, member.linkname)
+						if link_target in writing:
+							writing[link_target].result()
+						if os.path.lexists(path):
+							os.unlink(path)
+						os.link(link_target, path)
+					else:
+						warn("Skipping special file '%s' in archive", member.name)
+		finally:
+			# Wait for all the writes, even if something failed
+			futures.wait([future for path, future, size in pending])
+		while pending:
+			wait_for(*pending.popleft())
+
+	# Fix up directories last (deepest first), as adding their contents changed them
+	for path, mode, mtime in reversed(directories):
+		os.chmod(path, mode)
+		os.utime(path, (mtime, mtime))
+
+	info("Extracted %s (%d files) in %.2fs", archive_file, n_files, time.time() - start)
+
+def get_normalised_mode(member):
+	"""The permissions normalise_member gives member: only whether a file is executable is kept.
+	>>> member = tarfile.TarInfo('foo-1.0/run')
+	>>> member.mode = 0o775
+	>>> oct(get_normalised_mode(member))
+	'0o755'
+	"""
+	if member.isdir():
+		return 0o755
+	elif member.issym():
+		return 0o777
+	return 0o755 if member.mode & 0o111 else 0o644
+
+def normalise_member(member, mtime):
+	"""Reset the metadata which depends on when, where and by whom an archive was
+	created, rather than on its contents.
+	>>> member = tarfile.TarInfo('foo-1.0/run')
+	>>> member.mode, member.uid, member.uname = 0o775, 1000, 'bob'
+	>>> normalise_member(member, 1234567890)
+	>>> oct(member.mode), member.uid, member.uname, member.mtime
+	('0o755', 0, '', 1234567890)
+	"""
+	member.mtime = mtime
+	member.uid = member.gid = 0
+	member.uname = member.gname = ''
+	member.pax_headers = {}
+	member.mode = get_normalised_mode(member)
+
+def _copy_members(source, tar, builder, mtime, seen_dirs = None):
+	"""Copy the members of the uncompressed tar stream source to tar (without any pax
+	global header), applying normalise_member if mtime is not None.
+	@param seen_dirs: if not None, directories already in tar (which are skipped)"""
+	with tarfile.open(fileobj = source, mode = 'r|') as original:
+		for member in original:
+			if mtime is not None:
+				normalise_member(member, mtime)
+			if member.isfile():
+				reader = tardigest.HashingReader(original.extractfile(member))
+				tar.addfile(member, reader)
+				builder.add_file(member, reader.digest.hexdigest())
+			else:
+				if seen_dirs is not None and member.isdir():
+					name = member.name.rstrip('/')
+					if name in seen_dirs:
+						continue
+					seen_dirs.add(name)
+				tar.addfile(member)
+				builder.add(member)
+	# Read the end-of-archive blocks too, so the writer doesn't get EPIPE
+	while source.read(BLOCK_SIZE):
+		pass
+
+def compress_stream(source, archive_file, jobs = None, level = None, extract = None, mtime = None):
+	"""Compress everything read from source into a new archive_file.
+	The format is chosen based on archive_file's extension.
+	If extract is given, source must be an uncompressed tar archive and the manifest
+	digest of its extract directory is calculated as it is compressed.
+	If mtime is given, source must be an uncompressed tar archive, which is rewritten
+	with every member passed through normalise_member (for reproducible archives).
+	@return: the implementation ID, if extract was given"""
+	archive_format = get_format_for_file(archive_file)
+	with open(archive_file, 'wb') as stream:
+		with open_compressor(stream, archive_format, jobs, level) as compressor:
+			if mtime is not None:
+				builder = tardigest.ManifestBuilder(extract)
+				with tarfile.open(fileobj = compressor, mode = 'w|', format = tarfile.GNU_FORMAT) as tar:
+					_copy_members(source, tar, builder, mtime)
+				if extract is not None:
+					return builder.get_id()
+				return None
+			if extract is not None:
+				return tardigest.digest_tar_stream(source, extract, sink = compressor)
+			while True:
+				data = source.read(BLOCK_SIZE)
+				if not data: break
+				compressor.write(data)
+
+def compress_streams(sources, archive_file, jobs = None, level = None, extract = None, mtime = None):
+	"""Like compress_stream, but the new archive_file gets the members of several
+	uncompressed tar streams, one after the other. A directory which appears in more
+	than one stream is only added once.
+	@return: the implementation ID, if extract was given"""
+	archive_format = get_format_for_file(archive_file)
+	builder = tardigest.ManifestBuilder(extract)
+	seen_dirs = set()
+	with open(archive_file, 'wb') as stream:
+		with open_compressor(stream, archive_format, jobs, level) as compressor:
+			with tarfile.open(fileobj = compressor, mode = 'w|', format = tarfile.GNU_FORMAT) as tar:
+				for source in sources:
+					_copy_members(source, tar, builder, mtime, seen_dirs)
+	if extract is not None:
+		return builder.get_id()
+	return None
+
+class Prefetcher:
+	"""Reads a stream in a background thread, keeping up to max_buffered bytes ready.
+	This lets several processes write their output at the same time, even though
+	we only read from one of them at a time.
+	>>> import io
+	>>> reader = Prefetcher(io.BytesIO(b'hello world'))
+	>>> reader.read(5), reader.read(), reader.read()
+	(b'hello', b' world', b'')
+	"""
+
+	def __init__(self, stream, max_buffered = 16 * BLOCK_SIZE):
+		self.stream = stream
+		self.blocks = queue.Queue(maxsize = max(max_buffered // BLOCK_SIZE, 1))
+		self.buffer = b''
+		self.pos = 0
+		self.eof = False
+		self.closed = False
+		self.thread = threading.Thread(target = self._run, daemon = True)
+		self.thread.start()
+
+	def _run(self):
+		while not self.closed:
+			try:
+				data = self.stream.read(BLOCK_SIZE)
+			except Exception as ex:
+				self.blocks.put(ex)
+				return
+			self.blocks.put(data)
+			if not data:
+				return
+
+	def read(self, size = -1):
+		pieces = []
+		while size != 0:
+			if self.pos == len(self.buffer):
+				if self.eof:
+					break
+				block = self.blocks.get()
+				if isinstance(block, Exception):
+					raise block
+				if not block:
+					self.eof = True
+				self.buffer, self.pos = block, 0
+				continue
+			end = len(self.buffer) if size < 0 else min(len(self.buffer), self.pos + size)
+			pieces.append(self.buffer[self.pos:end])
+			if size > 0:
+				size -= end - self.pos
+			self.pos = end
+		return b''.join(pieces)
+
+	def close(self):
+		"""Stop reading (the thread exits after its current read)."""
+		self.closed = True
+		try:
+			while True:
+				self.blocks.get_nowait()
+		except queue.Empty:
+			pass
+
+def _git_order(path, leaf):
+	"""Sort key giving the order in which git stores (and "git archive" exports) the
+	entries of a directory: by name, with each directory's name followed by a '/'."""
+	name = os.fsencode(leaf)
+	full = os.path.join(path, leaf)
+	if os.path.isdir(full) and not os.path.islink(full):
+		name += b'/'
+	return name
+
+def _add_tree(tar, path, builder, mtime):
+	"""Like tar.add(path), but also adds each member to builder.
+	Members are added in the same order as "git archive" uses (so that a regenerated archive
+	of an unchanged tree is identical to the exported one), and normalised if mtime is not None."""
+	member = tar.gettarinfo(path)
+	if mtime is not None:
+		normalise_member(member, mtime)
+	if member.isfile():
+		with open(path, 'rb') as stream:
+			reader = tardigest.HashingReader(stream)
+			tar.addfile(member, reader)
+		builder.add_file(member, reader.digest.hexdigest())
+		return
+	tar.addfile(member)
+	builder.add(member)
+	if member.isdir():
+		for leaf in sorted(os.listdir(path), key = lambda leaf: _git_order(path, leaf)):
+			_add_tree(tar, os.path.join(path, leaf), builder, mtime)
+
+def create_tarball(archive_file, path, jobs = None, level = None, mtime = None):
+	"""Create a compressed archive_file containing the directory path.
+	Equivalent to "tar cjf archive_file path", but compresses in parallel.
+	If mtime is given, the archive is reproducible: it depends only on the contents
+	of path and the compression settings (see normalise_member).
+	@return: the implementation ID of path, as calculated from the archive"""
+	archive_format = get_format_for_file(archive_file)
+	builder = tardigest.ManifestBuilder(path)
+	with open(archive_file, 'wb') as stream:
+		with open_compressor(stream, archive_format, jobs, level) as compressor:
+			with tarfile.open(fileobj = compressor, mode = 'w|', format = tarfile.GNU_FORMAT) as tar:
+				_add_tree(tar, path, builder, mtime)
+	return builder.get_id()
+
+def get_archive_digest(archive_file, extract = None):
+	"""Calculate the manifest digest of the directory extract within archive_file,
+	in a single pass over the archive and without unpacking it.
+	@return: the implementation ID"""
+	builder = tardigest.ManifestBuilder(extract)
+	with open_tarball(archive_file) as tar:
+		for member in iter_members(tar):
+			builder.add(member, tar.extractfile(member) if member.isfile() else None)
+	return builder.get_id()
+
+def benchmark_formats(tar_file, jobs = None, benchmark_formats = None):
+	"""Compress the uncompressed tar_file with each format and then decompress it again.
+	@param benchmark_formats: the formats to try (default: all of them)
+	@return: a list of (format, compressed size, compress seconds, decompress seconds)"""
+	results = []
+	for archive_format in benchmark_formats or formats:
+		archive_file = tar_file + '.' + archive_format.extension
+		try:
+			start = time.time()
+			with open(tar_file, 'rb') as source:
+				compress_stream(source, archive_file, jobs)
+			compress_time = time.time() - start
+
+			start = time.time()
+			with open_tarball(archive_file) as tar:
+				for member in iter_members(tar):
+					if member.isfile():
+						tar.extractfile(member).read()
+			decompress_time = time.time() - start
+
+			results.append((archive_format, os.path.getsize(archive_file), compress_time, decompress_time))
+		finally:
+			if os.path.exists(archive_file):
+				os.unlink(archive_file)
+	return results
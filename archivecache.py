@@ -0,0 +1,86 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Keeps recently created (reproducible) source archives, so that retrying a release
+# of the same tree can reuse the archive instead of exporting and compressing it again.
+
+import os, json, hashlib, time
+from logging import info, warn
+from zeroinstall.support import basedir, portable_rename
+
+import support
+
+# Entries not used for this long are removed
+MAX_AGE = 30 * 24 * 60 * 60
+
+# Only this many archives are kept
+MAX_ENTRIES = 10
+
+def get_key(tree, prefix, extract, hooks, extension, level, mtime):
+	"""The cache key for an archive of tree (the git tree SHA), exported under prefix and
+	then modified by the given generate-archive hooks.
+	>>> get_key('4b825dc', 'foo-1.0', 'foo-1.0', [], 'tar.bz2', None, 0) == get_key('4b825dc', 'foo-1.0', 'foo-1.0', ['make'], 'tar.bz2', None, 0)
+	False
+	"""
+	return hashlib.sha256(json.dumps([tree, prefix, extract, hooks, extension, level, mtime]).encode('utf-8')).hexdigest()
+
+class ArchiveCache:
+	"""A directory of archives, stored as KEY/ARCHIVE with the digest in KEY/info.json."""
+
+	def __init__(self, cache_dir):
+		self.cache_dir = cache_dir
+
+	def fetch(self, key, archive_file):
+		"""If there is a cached archive for key, copy it to archive_file.
+		@return: the archive's implementation ID, or None on a miss"""
+		entry = os.path.join(self.cache_dir, key)
+		info_file = os.path.join(entry, 'info.json')
+		try:
+			with open(info_file, 'r') as stream:
+				details = json.load(stream)
+			digest = details['digest']
+			support.link_or_copy(os.path.join(entry, os.path.basename(archive_file)), archive_file)
+		except (OSError, ValueError, KeyError, TypeError) as ex:
+			# (TypeError if info.json doesn't hold a dict)
+			info("No cached archive for %s: %s", key, ex)
+			return None
+		os.utime(info_file)
+		return digest
+
+	def store(self, key, archive_file, digest):
+		"""Add archive_file to the cache, and remove old entries.
+		Failures are only reported as warnings."""
+		entry = os.path.join(self.cache_dir, key)
+		tmp = entry + '.new'
+		try:
+			if os.path.exists(tmp):
+				support.remove_tree(tmp)
+			os.makedirs(tmp)
+			support.link_or_copy(archive_file, os.path.join(tmp, os.path.basename(archive_file)))
+			with open(os.path.join(tmp, 'info.json'), 'w') as stream:
+				json.dump({'digest': digest}, stream)
+			if os.path.exists(entry):
+				support.remove_tree(entry)
+			portable_rename(tmp, entry)
+			self.evict()
+		except OSError as ex:
+			warn("Failed to add archive to cache: %s", ex)
+
+	def evict(self):
+		entries = []
+		for entry in os.scandir(self.cache_dir):
+			try:
+				last_used = os.stat(os.path.join(entry.path, 'info.json')).st_mtime
+			except OSError:
+				last_used = entry.stat().st_mtime
+			entries.append((last_used, entry.path))
+		entries.sort(reverse = True)
+		cutoff = time.time() - MAX_AGE
+		for i, (last_used, path) in enumerate(entries):
+			if i >= MAX_ENTRIES or last_used < cutoff:
+				info("Removing %s from archive cache", path)
+				support.remove_tree(path)
+
+def get_archive_cache():
+	"""Open the user's archive cache (~/.cache/0install.net/0release/archives)."""
+	return ArchiveCache(os.path.join(basedir.xdg_cache_home, '0install.net', '0release', 'archives'))
@@ -0,0 +1,119 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Compares two release archives without extracting them.
+
+import hashlib, difflib
+
+import archive
+
+def _strip_top(name):
+	"""Remove the top-level directory (e.g. "foo-1.0/") from an archive member's name."""
+	parts = name.strip('/').split('/', 1)
+	if len(parts) < 2:
+		return None
+	return parts[1]
+
+def scan_archive(archive_file):
+	"""Read through archive_file once, recording the details of each member.
+	Modes are normalised as for archive.normalise_member, so that comparing an archive made
+	before archives were normalised with a newer one only shows real permission changes.
+	@return: a dict mapping names (without the top-level directory) to (type, mode, size, sha256 or link target)"""
+	entries = {}
+	with archive.open_tarball(archive_file) as tar:
+		for member in archive.iter_members(tar):
+			name = _strip_top(member.name)
+			if name is None or member.name == 'pax_global_header': continue
+			mode = archive.get_normalised_mode(member)
+			if member.isfile():
+				digest = hashlib.sha256()
+				stream = tar.extractfile(member)
+				while True:
+					data = stream.read(1024 * 1024)
+					if not data: break
+					digest.update(data)
+				entries[name] = ('file', mode, member.size, digest.hexdigest())
+			elif member.isdir():
+				entries[name] = ('dir', mode, 0, None)
+			elif member.issym():
+				entries[name] = ('symlink', 0, 0, member.linkname)
+			elif member.islnk():
+				entries[name] = ('hardlink', 0, 0, _strip_top(member.linkname))
+			else:
+				entries[name] = ('special', mode, 0, None)
+	return entries
+
+def read_files(archive_file, names):
+	"""Get the contents of the named files from archive_file.
+	@return: a dict mapping names to bytes"""
+	contents = {}
+	with archive.open_tarball(archive_file) as tar:
+		for member in archive.iter_members(tar):
+			name = _strip_top(member.name)
+			if name in names and member.isfile():
+				contents[name] = tar.extractfile(member).read()
+	return contents
+
+class ArchiveDiff:
+	"""The differences between two archives.
+	@ivar added: names only in the new archive
+	@ivar removed: names only in the old archive
+	@ivar changed: names whose type, contents or link target differ
+	@ivar mode_changed: names whose permissions differ (but are otherwise unchanged)"""
+
+	def __init__(self, old_file, new_file):
+		self.old_file = old_file
+		self.new_file = new_file
+		self.old = scan_archive(old_file)
+		self.new = scan_archive(new_file)
+		self.added = sorted(set(self.new) - set(self.old))
+		self.removed = sorted(set(self.old) - set(self.new))
+		self.changed = []
+		self.mode_changed = []
+		for name in sorted(set(self.old) & set(self.new)):
+			old_type, old_mode, old_size, old_details = self.old[name]
+			new_type, new_mode, new_size, new_details = self.new[name]
+			if (old_type, old_size, old_details) != (new_type, new_size, new_details):
+				self.changed.append(name)
+			elif old_mode != new_mode:
+				self.mode_changed.append(name)
+
+	def get_size(self, entries):
+		return sum(size for (kind, mode, size, details) in entries.values())
+
+	def write_summary(self, stream):
+		print("Comparing %s with %s:" % (self.old_file, self.new_file), file = stream)
+		for name in self.added:
+			print("  A %s (%d bytes)" % (name, self.new[name][2]), file = stream)
+		for name in self.removed:
+			print("  D %s" % name, file = stream)
+		for name in self.changed:
+			delta = self.new[name][2] - self.old[name][2]
+			print("  M %s (%+d bytes)" % (name, delta), file = stream)
+		for name in self.mode_changed:
+			print("  P %s (%o -> %o)" % (name, self.old[name][1], self.new[name][1]), file = stream)
+		old_size = self.get_size(self.old)
+		new_size = self.get_size(self.new)
+		print("%d added, %d removed, %d changed, %d permission changes; total size %d -> %d bytes (%+d)" % (
+			len(self.added), len(self.removed), len(self.changed), len(self.mode_changed),
+			old_size, new_size, new_size - old_size), file = stream)
+
+	def write_unified_diffs(self, stream):
+		"""Show the changes to text files (binary files are just listed)."""
+		names = {name for name in self.changed if self.old[name][0] == self.new[name][0] == 'file'}
+		if not names:
+			return
+		old_contents = read_files(self.old_file, names)
+		new_contents = read_files(self.new_file, names)
+		for name in sorted(names):
+			old_data = old_contents[name]
+			new_data = new_contents[name]
+			try:
+				if b'\0' in old_data or b'\0' in new_data:
+					raise UnicodeError("binary data")
+				old_lines = old_data.decode('utf-8').splitlines(True)
+				new_lines = new_data.decode('utf-8').splitlines(True)
+			except UnicodeError:
+				print("Binary file %s differs" % name, file = stream)
+				continue
+			stream.writelines(difflib.unified_diff(old_lines, new_lines, 'a/' + name, 'b/' + name))
@@ -0,0 +1,126 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Keeps the binaries made by each builder, so that rebuilding an identical
+# source archive (e.g. after failing a release candidate) is just a copy.
+
+import os, json, hashlib, shutil, time, tempfile, threading
+from logging import info, warn
+from zeroinstall.support import basedir, portable_rename
+
+import support
+
+def get_key(src_digest, target, commands):
+	"""The cache key for building the source with this digest using the given builder.
+	@param commands: the builder's start, build and stop commands
+	>>> get_key('sha256new_ABC', 'host', ['', 'make', '']) == get_key('sha256new_ABC', 'host', ['', 'make -j4', ''])
+	False
+	"""
+	return hashlib.sha256(json.dumps([src_digest, target, commands]).encode('utf-8')).hexdigest()
+
+class BuildCache:
+	"""A directory of previous build results, each stored as:
+	  KEY/binary.xml, KEY/ARCHIVE and KEY/info.json
+	The mtime of info.json records when the entry was last used.
+	@ivar max_size: evict the least recently used entries to keep the total below this (bytes)
+	@ivar max_age: evict entries not used for this long (seconds)"""
+
+	def __init__(self, cache_dir, max_size, max_age):
+		self.cache_dir = cache_dir
+		self.max_size = max_size
+		self.max_age = max_age
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def _count(self, hit):
+		with self.lock:
+			if hit:
+				self.hits += 1
+			else:
+				self.misses += 1
+
+	def fetch(self, key, binary_feed):
+		"""If we have a build for key, copy its feed to binary_feed and its archive next to it.
+		@return: True on a hit"""
+		entry = os.path.join(self.cache_dir, key)
+		info_file = os.path.join(entry, 'info.json')
+		try:
+			with open(info_file, 'r') as stream:
+				details = json.load(stream)
+			target_dir = os.path.dirname(os.path.abspath(binary_feed))
+			support.link_or_copy(os.path.join(entry, details['archive']), os.path.join(target_dir, details['archive']))
+			support.link_or_copy(os.path.join(entry, 'binary.xml'), binary_feed)
+		except (OSError, ValueError, KeyError, TypeError) as ex:
+			info("Build cache miss for %s: %s", key, ex)
+			self._count(False)
+			return False
+		os.utime(info_file)
+		self._count(True)
+		return True
+
+	def store(self, key, binary_feed, archive_file, **details):
+		"""Add a successful build to the cache. Failures are only reported as warnings."""
+		try:
+			os.makedirs(self.cache_dir, exist_ok = True)
+			tmp = tempfile.mkdtemp(prefix = 'tmp-', dir = self.cache_dir)
+			try:
+				support.link_or_copy(archive_file, os.path.join(tmp, os.path.basename(archive_file)))
+				support.link_or_copy(binary_feed, os.path.join(tmp, 'binary.xml'))
+				details['archive'] = os.path.basename(archive_file)
+				details['size'] = os.path.getsize(archive_file) + os.path.getsize(binary_feed)
+				with open(os.path.join(tmp, 'info.json'), 'w') as stream:
+					json.dump(details, stream)
+				entry = os.path.join(self.cache_dir, key)
+				if os.path.exists(entry):
+					shutil.rmtree(entry)
+				portable_rename(tmp, entry)
+			except:
+				shutil.rmtree(tmp)
+				raise
+		except OSError as ex:
+			warn("Failed to add build to cache: %s", ex)
+
+	def get_entries(self):
+		"""@return: a list of (last used, size, path), oldest first"""
+		entries = []
+		if not os.path.isdir(self.cache_dir):
+			return entries
+		for entry in os.scandir(self.cache_dir):
+			try:
+				with open(os.path.join(entry.path, 'info.json'), 'r') as stream:
+					size = json.load(stream)['size']
+				last_used = os.stat(os.path.join(entry.path, 'info.json')).st_mtime
+			except (OSError, ValueError, KeyError, TypeError):
+				# Incomplete (still being stored, or left behind by a crash)
+				last_used, size = entry.stat().st_mtime, 0
+			entries.append((last_used, size, entry.path))
+		entries.sort()
+		return entries
+
+	def evict(self):
+		"""Remove entries which are too old, and then the least recently used ones
+		until the cache fits in max_size.
+		@return: the number of entries removed"""
+		entries = self.get_entries()
+		total = sum(size for last_used, size, path in entries)
+		cutoff = time.time() - self.max_age
+		removed = 0
+		for last_used, size, path in entries:
+			if last_used >= cutoff and total <= self.max_size:
+				break
+			info("Evicting %s from build cache", path)
+			support.remove_tree(path)
+			total -= size
+			removed += 1
+		return removed
+
+	def format_stats(self):
+		entries = self.get_entries()
+		return "Build cache: %d hit(s), %d miss(es); %d entries using %.1f MB (in %s)" % (
+			self.hits, self.misses, len(entries), sum(size for last_used, size, path in entries) / 1e6, self.cache_dir)
+
+def get_build_cache(max_size_mb, max_age_days):
+	"""Open the user's build cache (~/.cache/0install.net/0release/builds)."""
+	cache_dir = os.path.join(basedir.xdg_cache_home, '0install.net', '0release', 'builds')
+	return BuildCache(cache_dir, max_size_mb * 1000 * 1000, max_age_days * 24 * 60 * 60)
@@ -3,10 +3,12 @@
 
 import tempfile, shutil, os, sys
 import configparser
+from concurrent import futures
 from logging import info
+from zeroinstall import SafeException
 from zeroinstall.support import basedir, portable_rename
 
-import support
+import support, tracing, buildcache, workspace
 
 class Compiler:
 	def __init__(self, options, src_feed_name, release_version):
@@ -18,6 +20,9 @@ class Compiler:
 		# Start with a default configuration
 		self.config.add_section('global')
 		self.config.set('global', 'builders', 'host')
+		self.config.set('global', 'max-concurrent-builds', '0')	# 0 = no limit
+		self.config.set('global', 'build-cache-size', '1000')	# MB; 0 = don't cache builds
+		self.config.set('global', 'build-cache-max-age', '30')	# Days
 
 		self.config.add_section('builder-host')
 		#self.config.set('builder-host', 'build', '0launch --not-before 0.10 http://0install.net/2007/interfaces/0release.xml --build-slave "$@"')
@@ -45,8 +50,22 @@ class Compiler:
 		else:
 			self.targets = []
 
+		self.incremental_build = options.incremental_build
+
+		if options.build_jobs is not None:
+			self.max_concurrent_builds = options.build_jobs
+		else:
+			self.max_concurrent_builds = self.config.getint('global', 'max-concurrent-builds')
+
+		cache_size = self.config.getint('global', 'build-cache-size')
+		if options.no_build_cache or cache_size <= 0:
+			self.build_cache = None
+		else:
+			self.build_cache = buildcache.get_build_cache(cache_size, self.config.getint('global', 'build-cache-max-age'))
+
 	# We run the build in a sub-process. The idea is that the build may need to run
-	# on a different machine.
+	# on a different machine. Builders are independent, so when there is more than
+	# one to run we run them in parallel, each with its own log file.
 	def build_binaries(self):
 		if not self.targets: return
 
@@ -54,37 +73,107 @@ class Compiler:
 
 		archive_file = support.get_archive_basename(self.src_impl)
 
+		pending = []
 		for target in self.targets:
-			start = self.get('builder-' + target, 'start', None)
-			command = self.config.get('builder-' + target, 'build')
-			stop = self.get('builder-' + target, 'stop', None)
-
 			binary_feed = 'binary-' + target + '.xml'
 			if os.path.exists(binary_feed):
 				print("Feed %s already exists; not rebuilding" % binary_feed)
+			elif self.build_cache and self.build_cache.fetch(self.get_cache_key(target), binary_feed):
+				print("Using cached build of this source by builder '%s'" % target)
 			else:
+				pending.append(target)
+
+		try:
+			self._build_pending(pending, archive_file)
+		finally:
+			if self.build_cache:
+				self.build_cache.evict()
+				print(self.build_cache.format_stats())
+
+	def _build_pending(self, pending, archive_file):
+		jobs = len(pending)
+		if self.max_concurrent_builds > 0:
+			jobs = min(jobs, self.max_concurrent_builds)
+
+		if jobs <= 1:
+			for target in pending:
 				print("\nBuilding binary with builder '%s' ...\n" % target)
+				self.build_target(target, archive_file)
+			return
 
-				if start: support.show_and_run(start, [])
+		print("\nBuilding %d binaries, up to %d at a time ...\n" % (len(pending), jobs))
+		failed = []
+		with futures.ThreadPoolExecutor(max_workers = jobs) as pool:
+			running = {pool.submit(self.build_target_logged, target, archive_file): target for target in pending}
+			for future in futures.as_completed(running):
+				target = running[future]
 				try:
-					args = [os.path.basename(self.src_feed_name), archive_file, '', binary_feed + '.new']
-					if not command:
-						assert target == 'host', 'Missing build command'
-						support.check_call([sys.executable, sys.argv[0], '--build-slave'] + args)
-					else:
-						support.show_and_run(command, args)
-				finally:
-					if stop: support.show_and_run(stop, [])
+					future.result()
+				except Exception as ex:
+					print("Builder '%s' FAILED: %s (see %s)" % (target, str(ex) or type(ex).__name__, self.get_log_file(target)))
+					failed.append(target)
+				else:
+					print("Builder '%s' finished" % target)
+
+		if failed:
+			raise SafeException("Build failed for builder(s): %s" % ', '.join(failed))
+
+	def build_target_logged(self, target, archive_file):
+		"""Run build_target with all output going to the target's log file."""
+		log_file = self.get_log_file(target)
+		print("Building binary with builder '%s' (log: %s)" % (target, log_file))
+		with open(log_file, 'w') as log:
+			self.build_target(target, archive_file, log)
+
+	def build_target(self, target, archive_file, log = None):
+		"""Build binary-<target>.xml and its archive using the given builder.
+		@param log: stream for the build's output (default is stdout)"""
+		with tracing.phase('build ' + target):
+			self._build_target(target, archive_file, log)
 
-				bin_feed = support.load_feed(binary_feed + '.new')
-				bin_impl = support.get_singleton_impl(bin_feed)
-				bin_archive_file = support.get_archive_basename(bin_impl)
-				bin_size = bin_impl.download_sources[0].size
+	def _build_target(self, target, archive_file, log):
+		start, command, stop = self.get_builder_commands(target)
 
-				assert os.path.exists(bin_archive_file), "Compiled binary '%s' not found!" % os.path.abspath(bin_archive_file)
-				assert os.path.getsize(bin_archive_file) == bin_size, "Compiled binary '%s' has wrong size!" % os.path.abspath(bin_archive_file)
+		binary_feed = 'binary-' + target + '.xml'
 
-				portable_rename(binary_feed + '.new', binary_feed)
+		if start: support.show_and_run(start, [], log)
+		try:
+			args = [os.path.basename(self.src_feed_name), archive_file, '', binary_feed + '.new']
+			if not command:
+				assert target == 'host', 'Missing build command'
+				slave = [sys.executable, sys.argv[0], '--build-slave']
+				if self.incremental_build:
+					slave.append('--incremental-build')
+				support.check_call(slave + args, **support.log_redirect(log))
+			else:
+				support.show_and_run(command, args, log)
+		finally:
+			if stop: support.show_and_run(stop, [], log)
+
+		bin_feed = support.load_feed(binary_feed + '.new')
+		bin_impl = support.get_singleton_impl(bin_feed)
+		bin_archive_file = support.get_archive_basename(bin_impl)
+		bin_size = bin_impl.download_sources[0].size
+
+		assert os.path.exists(bin_archive_file), "Compiled binary '%s' not found!" % os.path.abspath(bin_archive_file)
+		assert os.path.getsize(bin_archive_file) == bin_size, "Compiled binary '%s' has wrong size!" % os.path.abspath(bin_archive_file)
+
+		portable_rename(binary_feed + '.new', binary_feed)
+
+		if self.build_cache:
+			self.build_cache.store(self.get_cache_key(target), binary_feed, bin_archive_file,
+					target = target, source = self.src_impl.id, version = self.src_impl.get_version())
+
+	def get_builder_commands(self, target):
+		section = 'builder-' + target
+		return [self.get(section, 'start', None), self.config.get(section, 'build'), self.get(section, 'stop', None)]
+
+	def get_cache_key(self, target):
+		"""Builds are cached by source digest (the source implementation's ID) and builder."""
+		return buildcache.get_key(self.src_impl.id, target, self.get_builder_commands(target))
+
+	def get_log_file(self, target):
+		return 'build-%s.log' % target
 
 	def get_binary_feeds(self):
 		return ['binary-%s.xml' % target for target in self.targets]
@@ -95,8 +184,11 @@ class Compiler:
 		except configparser.NoOptionError:
 			return default
 
-# This is the actual build process, running on the build machine
-def build_slave(src_feed, archive_file, archive_dir_public_url, target_feed):
+# This is the actual build process, running on the build machine.
+# Normally, we build in a new temporary directory. With incremental set, we build in
+# a workspace kept from the previous release of this feed instead, updating only the
+# source files that changed so that 0compile can reuse the earlier build.
+def build_slave(src_feed, archive_file, archive_dir_public_url, target_feed, incremental = False):
 	if archive_dir_public_url: print("WARNING: archive_dir_public_url is deprecated!")
 	try:
 		COMPILE = [os.environ['ZI_COMPILE']]
@@ -112,14 +204,39 @@ def build_slave(src_feed, archive_file, archive_dir_public_url, target_feed):
 
 	impl, = list(feed.implementations.values())
 
-	tmpdir = tempfile.mkdtemp(prefix = '0release-')
+	lock = None
+	if incremental:
+		tmpdir = workspace.get_workspace_dir(feed)
+		lock = workspace.lock_workspace(tmpdir)
+		print("Building in workspace %s" % tmpdir)
+	else:
+		tmpdir = tempfile.mkdtemp(prefix = '0release-')
 	try:
 		os.chdir(tmpdir)
 		depdir = os.path.join(tmpdir, 'dependencies')
-		os.mkdir(depdir)
-
-		support.unpack_tarball(archive_file)
-		portable_rename(impl.download_sources[0].extract, os.path.join(depdir, impl.id))
+		if incremental:
+			# The sources always live in src, so that paths recorded by the previous build
+			# stay valid; 0compile finds them through a link named after this release's digest.
+			src_dir = os.path.join(tmpdir, 'src')
+			if os.path.isdir(depdir):
+				for name in os.listdir(depdir):
+					path = os.path.join(depdir, name)
+					if os.path.islink(path):
+						os.unlink(path)
+					elif not os.path.exists(src_dir):
+						portable_rename(path, src_dir)		# (workspace from an older 0release)
+					else:
+						support.remove_tree(path)
+			else:
+				os.mkdir(depdir)
+			os.symlink(os.path.join('..', 'src'), os.path.join(depdir, impl.id))
+			sync = workspace.SourceSync(src_dir, os.path.join(tmpdir, 'source-manifest.json'))
+			written, unchanged, removed = sync.sync(archive_file, impl.download_sources[0].extract)
+			print("Updated sources: %d files changed, %d unchanged, %d removed" % (written, unchanged, removed))
+		else:
+			os.mkdir(depdir)
+			support.unpack_tarball(archive_file)
+			portable_rename(impl.download_sources[0].extract, os.path.join(depdir, impl.id))
 
 		config = configparser.RawConfigParser()
 		config.add_section('compile')
@@ -145,7 +262,14 @@ def build_slave(src_feed, archive_file, archive_dir_public_url, target_feed):
 
 		shutil.move(archive_file, os.path.join(os.path.dirname(target_feed), archive_file))
 	except:
-		print("\nLeaving temporary directory %s for inspection...\n" % tmpdir)
+		if not incremental:
+			print("\nLeaving temporary directory %s for inspection...\n" % tmpdir)
 		raise
 	else:
-		shutil.rmtree(tmpdir)
+		if not incremental:
+			shutil.rmtree(tmpdir)
+	finally:
+		if lock is not None:
+			lock.close()
+	if incremental:
+		workspace.evict_workspaces()
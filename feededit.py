@@ -0,0 +1,120 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Edits feeds in-process (rather than running 0publish once per change).
+
+import os, collections
+from concurrent import futures
+from xml.dom import minidom
+from zeroinstall import SafeException
+from zeroinstall.injector import namespaces
+from zeroinstall.support import portable_rename
+
+def is_signed(feed_path):
+	"""Does this feed have a signature block? If so, only 0publish can update it."""
+	with open(feed_path, 'rb') as stream:
+		return b'<!-- Base64 Signature' in stream.read()
+
+def _parse(path):
+	with open(path, 'rb') as stream:
+		return minidom.parse(stream)
+
+def parse_feeds(paths, jobs = 4):
+	"""Parse each feed in paths, yielding the documents in order.
+	A pool of threads reads up to jobs feeds ahead of the caller, so only a few
+	documents are in memory at once however many feeds there are."""
+	with futures.ThreadPoolExecutor(max_workers = jobs) as pool:
+		pending = collections.deque()
+		paths = iter(paths)
+		for path in paths:
+			pending.append(pool.submit(_parse, path))
+			if len(pending) >= jobs: break
+		while pending:
+			doc = pending.popleft().result()
+			for path in paths:
+				pending.append(pool.submit(_parse, path))
+				break
+			yield doc
+
+class FeedEditor:
+	"""Loads a feed, applies a batch of changes to it and writes it out once.
+	Changes to the implementation require the feed to contain exactly one."""
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as stream:
+			self.doc = minidom.parse(stream)
+
+	def get_implementation(self):
+		impls = self.doc.getElementsByTagNameNS(namespaces.XMLNS_IFACE, 'implementation')
+		if len(impls) != 1:
+			raise SafeException("Feed '%s' contains %d implementations! I need exactly one!" % (self.path, len(impls)))
+		return impls[0]
+
+	def _set_attribute(self, name, value):
+		impl = self.get_implementation()
+		if value:
+			impl.setAttribute(name, value)
+		elif impl.hasAttribute(name):
+			impl.removeAttribute(name)
+
+	def set_version(self, version):
+		self._set_attribute('version', version)
+
+	def set_released(self, date):
+		"""Set the release date ("YYYY-MM-DD"), or remove it if date is empty."""
+		self._set_attribute('released', date)
+
+	def set_main(self, main):
+		self._set_attribute('main', main)
+
+	def add_archive(self, href, size, extract, digest):
+		"""Add an <archive> to the implementation and give it the archive's digest as its ID.
+		@param digest: the implementation ID (e.g. from archive.get_archive_digest)"""
+		impl = self.get_implementation()
+		alg, value = digest.split('_', 1)
+		impl.setAttribute('id', digest)
+		if impl.hasAttribute('local-path'):
+			impl.removeAttribute('local-path')
+
+		manifest_digest = self.doc.createElementNS(namespaces.XMLNS_IFACE, 'manifest-digest')
+		manifest_digest.setAttribute(alg, value)
+		impl.appendChild(manifest_digest)
+
+		archive = self.doc.createElementNS(namespaces.XMLNS_IFACE, 'archive')
+		archive.setAttribute('href', href)
+		archive.setAttribute('size', str(size))
+		if extract:
+			archive.setAttribute('extract', extract)
+		impl.appendChild(archive)
+
+	def make_archives_relative(self):
+		"""Reduce the hrefs of all archives and files to just their basenames."""
+		for elem in self.doc.getElementsByTagNameNS(namespaces.XMLNS_IFACE, 'archive') + self.doc.getElementsByTagNameNS(namespaces.XMLNS_IFACE, 'file'):
+			href = elem.getAttribute('href')
+			assert href, 'Missing href on %r' % elem
+			if '/' in href:
+				elem.setAttribute('href', href.rsplit('/', 1)[1])
+
+	def merge_feeds(self, paths, merge):
+		"""Merge the implementations from each of the feeds in paths into this one.
+		@param merge: the merge function (0repo's merge.merge)"""
+		for doc in parse_feeds(paths):
+			merge(self.doc, doc)
+
+	def save(self, path = None):
+		"""Write the feed to path (default: where it was loaded from), replacing it atomically."""
+		path = path or self.path
+		tmp_name = path + '.new'
+		try:
+			with open(tmp_name, 'w', encoding = 'utf-8') as stream:
+				# (like doc.writexml, but keeps stylesheets, etc on their own lines)
+				stream.write('<?xml version="1.0" ?>\n')
+				for node in self.doc.childNodes:
+					node.writexml(stream)
+					stream.write('\n')
+			portable_rename(tmp_name, path)
+		except:
+			if os.path.exists(tmp_name):
+				os.unlink(tmp_name)
+			raise
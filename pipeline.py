@@ -0,0 +1,154 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Runs the stages of a release as a dependency graph, so that stages which
+# don't depend on each other (e.g. writing the changelog and running the tests)
+# can overlap.
+
+import time, threading
+from concurrent import futures
+from logging import info
+from zeroinstall import SafeException
+
+import tracing
+
+# Separates the names of completed stages in the status file (stage names may contain spaces)
+COMPLETED_SEPARATOR = ','
+
+class Stage:
+	def __init__(self, name, fn, inputs, after, resumable, on_error):
+		self.name = name
+		self.fn = fn
+		self.inputs = inputs		# Stages whose results are passed to fn, in order
+		self.after = after		# Other stages which must finish first
+		self.resumable = resumable	# Record completion in the status file, and skip it when resuming
+		self.on_error = on_error
+		self.start = None
+		self.end = None
+
+	@property
+	def needs(self):
+		return list(self.inputs) + [name for name in self.after if name not in self.inputs]
+
+	@property
+	def duration(self):
+		if self.start is None:
+			return 0
+		return self.end - self.start
+
+class Pipeline:
+	"""A set of stages, each of which runs once all the stages it needs have finished.
+	If a stage fails, no new stages are started; once the running ones have finished,
+	the exception is raised again. If it was a SafeException (e.g. a test failure), the
+	failed stage's on_error is called first; other errors, KeyboardInterrupt and SystemExit
+	leave things as they are, so that the release can be resumed.
+
+	>>> p = Pipeline()
+	>>> p.add('a', lambda: 1)
+	>>> p.add('b', lambda a: a + 1, inputs = ['a'])
+	>>> p.add('c', lambda a, b: a + b, inputs = ['a', 'b'])
+	>>> p.run()['c']
+	3
+	>>> [stage.name for stage in p.get_critical_path()]
+	['a', 'b', 'c']
+	"""
+
+	def __init__(self, status = None, jobs = 4):
+		"""@param status: if given, the support.Status in which to record completed resumable stages"""
+		self.stages = {}
+		self.status = status
+		self.jobs = jobs
+		self.results = {}
+		self.lock = threading.Lock()
+
+	def add(self, name, fn, inputs = (), after = (), resumable = False, on_error = None):
+		"""Add a stage. fn is called with the results of the inputs stages as its arguments,
+		and its return value is the stage's result.
+		@param resumable: fn has no result and only needs to succeed once per release
+		(when resuming, it is skipped once the stages it needs have finished)"""
+		assert name not in self.stages, name
+		if COMPLETED_SEPARATOR in name:
+			raise SafeException("Stage name '%s' may not contain '%s'" % (name, COMPLETED_SEPARATOR))
+		for dep in list(inputs) + list(after):
+			if dep not in self.stages:
+				raise SafeException("Stage '%s' needs unknown stage '%s'" % (name, dep))
+		self.stages[name] = Stage(name, fn, list(inputs), list(after), resumable, on_error)
+
+	def _get_completed(self):
+		if self.status is None or not self.status.completed_stages:
+			return set()
+		return set(self.status.completed_stages.split(COMPLETED_SEPARATOR))
+
+	def _mark_completed(self, stage):
+		if self.status is None or not stage.resumable:
+			return
+		with self.lock:
+			completed = self._get_completed() | {stage.name}
+			self.status.completed_stages = COMPLETED_SEPARATOR.join(sorted(completed))
+			self.status.save()
+
+	def _run_stage(self, stage):
+		stage.start = time.time()
+		try:
+			with tracing.phase(stage.name):
+				return stage.fn(*[self.results[name] for name in stage.inputs])
+		finally:
+			stage.end = time.time()
+
+	def run(self):
+		"""Run all the stages (as many at once as possible).
+		@return: a dict mapping stage names to results"""
+		completed = self._get_completed()
+		waiting = dict(self.stages)
+		running = {}
+		failed = None
+		with futures.ThreadPoolExecutor(max_workers = self.jobs) as pool:
+			while waiting or running:
+				if failed is None:
+					for stage in list(waiting.values()):
+						if any(dep in waiting or dep in running.values() for dep in stage.needs):
+							continue
+						del waiting[stage.name]
+						if stage.resumable and stage.name in completed:
+							print("Stage '%s' already done - skipping" % stage.name)
+							self.results[stage.name] = None
+							continue
+						info("Starting stage '%s'", stage.name)
+						running[pool.submit(self._run_stage, stage)] = stage.name
+					if not running:
+						continue	# (skipped some stages; look again)
+				elif not running:
+					break
+				done, unused = futures.wait(running, return_when = futures.FIRST_COMPLETED)
+				for future in done:
+					stage = self.stages[running.pop(future)]
+					try:
+						self.results[stage.name] = future.result()
+					except Exception as ex:
+						if failed is None:
+							failed = (stage, ex)
+					else:
+						self._mark_completed(stage)
+		if failed:
+			stage, ex = failed
+			if stage.on_error and isinstance(ex, SafeException):
+				stage.on_error()
+			raise ex
+		return self.results
+
+	def get_critical_path(self):
+		"""The chain of stages which determined the total time: the last stage to finish,
+		the stage it waited for last, and so on back to the start."""
+		path = []
+		stage = max(self.stages.values(), key = lambda s: (s.end or 0, s.duration))
+		while stage is not None:
+			path.append(stage)
+			deps = [self.stages[name] for name in stage.needs]
+			stage = max(deps, key = lambda s: (s.end or 0, s.duration)) if deps else None
+		path.reverse()
+		return path
+
+	def format_critical_path(self):
+		path = self.get_critical_path()
+		return "Critical path (%.1fs): %s" % (sum(stage.duration for stage in path),
+				' -> '.join('%s (%.1fs)' % (stage.name, stage.duration) for stage in path))
@@ -1,17 +1,14 @@
 # Copyright (C) 2009, Thomas Leonard
 # See the README file for details, or visit http://0install.net.
 
-import os, subprocess, shutil, sys, re
-from xml.dom import minidom
+import os, shutil, sys, re, tempfile, time, collections
 from zeroinstall import SafeException
-from zeroinstall.injector import model
-from zeroinstall.support import ro_rmtree
 from logging import info, warn
 
+# (0repo's modules and most of our own are only imported when needed, to start quickly)
 sys.path.insert(0, os.environ['RELEASE_0REPO'])
-from repo import registry, merge
 
-import support, compile
+import support, archive, archivecache, tracing
 from scm import get_scm
 
 XMLNS_RELEASE = 'http://zero-install.sourceforge.net/2007/namespaces/0release'
@@ -20,16 +17,18 @@ valid_phases = ['commit-release', 'generate-archive']
 
 TMP_BRANCH_NAME = '0release-tmp'
 
+# Pristine copies of extracted archives, inside the release directory
+PRISTINE_DIR = '.0release-pristine'
+
 test_command = os.environ['ZI_TEST']
 
-def run_unit_tests(local_feed):
+def run_unit_tests(local_feed, shards = 1, digest = None):
+	"""Run the tests for local_feed, split into shards run in parallel.
+	If digest is given, skip shards which have already passed for that source tree."""
+	import testrunner
 	print("Running self-tests...")
-	exitstatus = subprocess.call([test_command, '--', local_feed])
-	if exitstatus == 2:
-		print("SKIPPED unit tests for %s (no 'test' command)" % local_feed)
-		return
-	if exitstatus:
-		raise SafeException("Self-test failed with exit status %d" % exitstatus)
+	runner = testrunner.TestRunner(test_command, shards, testrunner.get_result_cache())
+	runner.run(local_feed, digest)
 
 legacy_warning = """\
 The upload functions of 0release (--archive-dir-public-url,
@@ -42,27 +41,104 @@ mailing list to let us know.
   http://www.0install.net/support.html#lists"""
 
 def do_version_substitutions(impl_dir, version_substitutions, new_version):
-	for (rel_path, subst) in version_substitutions:
-		assert not os.path.isabs(rel_path), rel_path
-		path = os.path.join(impl_dir, rel_path)
-		with open(path, 'rt') as stream:
-			data = stream.read()
-
-		match = subst.search(data)
-		if match:
-			orig = match.group(0)
-			span = match.span(1)
-			if match.lastindex != 1:
-				raise SafeException("Regex '%s' must have exactly one matching () group" % subst.pattern)
-			assert span[0] >= 0, "Version match group did not match (regexp=%s; match=%s)" % (subst.pattern, orig)
-			new_data = data[:span[0]] + new_version + data[span[1]:]
-		else:
-			raise SafeException("No matches for regex '%s' in '%s'" % (subst.pattern, path))
-
-		with open(path, 'wt') as stream:
-			stream.write(new_data)
+	import versionsubst
+	changes = versionsubst.substitute(impl_dir, version_substitutions, new_version)
+	if changes:
+		print("Set version to %s in %d file(s)" % (new_version, len(changes)))
+	return changes
+
+def hand_off_to_0repo(new_impls_feeds):
+	import repo.cmd
+	oldcwd = os.getcwd()
+	try:
+		cmd = ['0repo', 'add', '--'] + new_impls_feeds
+		print("Handing off to 0repo:")
+		print(" ".join(cmd))
+		print("")
+		with tracing.phase('0repo'):
+			repo.cmd.main(cmd)
+	finally:
+		os.chdir(oldcwd)
+
+def push_release(scm, version, options):
+	print("Push changes to public SCM repository...")
+	public_repos = options.public_scm_repository
+	if public_repos:
+		scm.push_head_and_release(version)
+	else:
+		print("NOTE: No public repository set => you'll have to push the tag and trunk yourself.")
+
+def get_project_dir_name(local_feed):
+	return local_feed.get_name().replace(' ', '-')
+
+class Batch:
+	"""State shared between the projects in a batch release (see release_all)."""
+	def __init__(self, options, local_feeds):
+		self.options = options
+		self.scms = []			# To close at the end
+		self.searched = set()		# Roots already searched (in full) for TODOs
+		self.releases = []		# (status file, merged feed, SCM, version) to publish
+		roots = collections.Counter(get_scm(local_feed, options).root_dir for local_feed in local_feeds)
+		self.shared_roots = {root for root, n in roots.items() if n > 1}
+
+	def get_scm(self, local_feed):
+		"""Projects which share a repository with another project in the batch tag their
+		releases as <name>-v<version> (rather than v<version>), and so each has its own
+		previous release, changelog and search for new TODO notes."""
+		scm = get_scm(local_feed, self.options)
+		if scm.root_dir in self.shared_roots:
+			scm.tag_prefix = get_project_dir_name(local_feed) + '-v'
+		self.scms.append(scm)
+		return scm
+
+	def add_release(self, merged_feed, scm, version):
+		self.releases.append((support.release_status_file, merged_feed, scm, version))
+
+	def publish(self):
+		"""Hand all the new releases to 0repo together, then push them."""
+		if not self.releases:
+			return
+		hand_off_to_0repo([merged_feed for status_file, merged_feed, scm, version in self.releases])
+		for status_file, merged_feed, scm, version in self.releases:
+			os.unlink(merged_feed)
+			push_release(scm, version, self.options)
+			os.unlink(status_file)
+		self.releases = []
+
+	def close(self):
+		for scm in self.scms:
+			scm.close()
+
+def release_all(local_feeds, options):
+	"""Release several projects in one run. Each project gets its own releases directory
+	(named after the feed) under the current directory. The projects are released one
+	after another, since they may share a working copy, and the new versions are only
+	passed to 0repo at the end, once they have all been accepted. Projects sharing a
+	repository get their own release tags (see Batch.get_scm)."""
+	batch = Batch(options, local_feeds)
+	top = os.getcwd()
+	try:
+		for local_feed in local_feeds:
+			release_dir = os.path.join(top, get_project_dir_name(local_feed))
+			if not os.path.isdir(release_dir):
+				os.mkdir(release_dir)
+			os.chdir(release_dir)
+			support.release_status_file = os.path.abspath('release-status')
+			print("\n=== %s (in %s) ===" % (local_feed.get_name(), release_dir))
+			with tracing.phase('release ' + local_feed.get_name()):
+				do_release(local_feed, options, batch)
+			os.chdir(top)
+		batch.publish()
+	finally:
+		os.chdir(top)
+		batch.close()
+
+def do_release(local_feed, options, batch = None):
+	"""Release local_feed, interactively.
+	@param batch: if given, share state with other projects and leave publishing to the batch"""
+	# (fail now if 0repo is missing, rather than after tagging the release)
+	from repo import registry, merge
 
-def do_release(local_feed, options):
 	if options.master_feed_file or options.archive_dir_public_url or options.archive_upload_command or options.master_feed_upload_command:
 		raise SafeException(legacy_warning)
 
@@ -93,6 +169,9 @@ def do_release(local_feed, options):
 	version_substitutions = []
 
 	add_toplevel_dir = None
+	archive_format = archive.default_format
+	compression_level = None
+	test_shards = 1
 	release_management = local_feed.get_metadata(XMLNS_RELEASE, 'management')
 	if len(release_management) == 1:
 		info("Found <release:management> element.")
@@ -107,6 +186,12 @@ def do_release(local_feed, options):
 				version_substitutions.append((x.getAttribute('path'), re.compile(x.content, re.MULTILINE)))
 			elif x.uri == XMLNS_RELEASE and x.name == 'add-toplevel-directory':
 				add_toplevel_dir = local_feed.get_name()
+			elif x.uri == XMLNS_RELEASE and x.name == 'test-shards':
+				test_shards = int(x.content.strip())
+			elif x.uri == XMLNS_RELEASE and x.name == 'archive-format':
+				archive_format = archive.get_format(x.content.strip())
+				if x.getAttribute('level'):
+					compression_level = int(x.getAttribute('level'))
 			else:
 				warn("Unknown <release:management> element: %s", x)
 	elif len(release_management) > 1:
@@ -114,7 +199,17 @@ def do_release(local_feed, options):
 	else:
 		info("No <release:management> element found in local feed.")
 
-	scm = get_scm(local_feed, options)
+	if options.archive_format:
+		archive_format = archive.get_format(options.archive_format)
+	if options.compression_level is not None:
+		compression_level = options.compression_level
+	if options.test_shards is not None:
+		test_shards = options.test_shards
+
+	if batch is None:
+		scm = get_scm(local_feed, options)
+	else:
+		scm = batch.get_scm(local_feed)
 
 	# Path relative to the archive / SCM root
 	local_iface_rel_root_path = local_feed.local_path[len(scm.root_dir) + 1:]
@@ -123,9 +218,10 @@ def do_release(local_feed, options):
 		info("Running hooks for phase '%s'" % phase)
 		full_env = os.environ.copy()
 		full_env.update(env)
-		for x in phase_actions[phase]:
-			print("[%s]: %s" % (phase, x))
-			support.check_call(x, shell = True, cwd = cwd, env = full_env)
+		with tracing.phase('hooks: ' + phase):
+			for x in phase_actions[phase]:
+				print("[%s]: %s" % (phase, x))
+				support.check_call(x, shell = True, cwd = cwd, env = full_env)
 
 	def set_to_release():
 		print("Snapshot version is " + local_impl.get_version())
@@ -142,11 +238,13 @@ def do_release(local_feed, options):
 		status.save()
 
 		working_copy = local_impl.id
-		do_version_substitutions(local_impl_dir, version_substitutions, release_version)
+		with tracing.phase('version substitution'):
+			do_version_substitutions(local_impl_dir, version_substitutions, release_version)
 		run_hooks('commit-release', cwd = working_copy, env = {'RELEASE_VERSION': release_version})
 
 		print("Releasing version", release_version)
-		support.publish(local_feed.local_path, set_released = 'today', set_version = release_version)
+		with tracing.phase('update local feed'):
+			update_local_feed(release_version, released = time.strftime('%Y-%m-%d'))
 
 		support.backup_if_exists(release_version)
 		os.mkdir(release_version)
@@ -154,50 +252,113 @@ def do_release(local_feed, options):
 
 		status.old_snapshot_version = local_impl.get_version()
 		status.release_version = release_version
-		status.head_at_release = scm.commit('Release %s' % release_version, branch = TMP_BRANCH_NAME, parent = 'HEAD')
+		with tracing.phase('commit'):
+			status.head_at_release = scm.commit('Release %s' % release_version, branch = TMP_BRANCH_NAME, parent = 'HEAD')
 		status.save()
 
+	def update_local_feed(version, released):
+		import feededit
+		if feededit.is_signed(local_feed.local_path):
+			support.publish(local_feed.local_path, set_released = released, set_version = version)
+		else:
+			editor = feededit.FeedEditor(local_feed.local_path)
+			editor.set_version(version)
+			editor.set_released(released)
+			editor.save()
+
 	def set_to_snapshot(snapshot_version):
 		assert snapshot_version.endswith('-post')
-		support.publish(local_feed.local_path, set_released = '', set_version = snapshot_version)
-		do_version_substitutions(local_impl_dir, version_substitutions, snapshot_version)
-		scm.commit('Start development series %s' % snapshot_version, branch = TMP_BRANCH_NAME, parent = TMP_BRANCH_NAME)
+		with tracing.phase('update local feed'):
+			update_local_feed(snapshot_version, released = '')
+		with tracing.phase('version substitution'):
+			do_version_substitutions(local_impl_dir, version_substitutions, snapshot_version)
+		with tracing.phase('commit'):
+			scm.commit('Start development series %s' % snapshot_version, branch = TMP_BRANCH_NAME, parent = TMP_BRANCH_NAME)
 		status.new_snapshot_version = scm.get_head_revision()
 		status.save()
 
 	def ensure_ready_to_release():
-		scm.ensure_committed()
-		scm.ensure_versioned(os.path.abspath(local_feed.local_path))
+		with tracing.phase('check working copy'):
+			check_working_copy()
+
+	def check_working_copy():
+		with tracing.phase('check repositories'):
+			report = scm.check_health([os.path.abspath(local_feed.local_path)])
+		if len(report.repos) > 1:
+			print(report.format())
+		report.check()
 		info("No uncommitted changes. Good.")
 		# Not needed for GIT. For SCMs where tagging is expensive (e.g. svn) this might be useful.
 		#run_unit_tests(local_impl)
 
-		scm.grep('\(^\\|[^=]\)\<\\(TODO\\|XXX\\|FIXME\\)\>')
-
-		branch = scm.get_current_branch()
+		notes_pattern = '\(^\\|[^=]\)\<\\(TODO\\|XXX\\|FIXME\\)\>'
+		previous_release = get_previous_release(local_impl.get_version())
+		if previous_release:
+			# Only show notes added since the last release, not every old one
+			with tracing.phase('search for new TODO notes'):
+				scm.grep_changed(notes_pattern, previous_release)
+		elif batch is None or scm.root_dir not in batch.searched:
+			scm.grep(notes_pattern)
+			if batch is not None:
+				batch.searched.add(scm.root_dir)
+
+		branch = report.superproject.branch
 		if branch != "refs/heads/master":
 			print("\nWARNING: you are currently on the '%s' branch.\nThe release will be made from that branch.\n" % branch)
 
 	def create_feed(target_feed, local_iface_path, archive_file, archive_name, main):
-		shutil.copyfile(local_iface_path, target_feed)
-
-		support.publish(target_feed,
-			set_main = main,
-			archive_url = os.path.basename(archive_file),
-			archive_file = archive_file,
-			archive_extract = archive_name)
+		import feededit
+		if not status.archive_digest:
+			# (archive created by an older version, which didn't record the digest)
+			status.archive_digest = archive.get_archive_digest(archive_file, archive_name)
+			status.save()
+		editor = feededit.FeedEditor(local_iface_path)
+		if main:
+			editor.set_main(main)
+		editor.add_archive(os.path.basename(archive_file), os.path.getsize(archive_file), archive_name,
+				status.archive_digest)
+		editor.save(target_feed)
 
 	def get_previous_release(this_version):
 		"""Return the highest numbered verison in the master feed before this_version.
 		@return: version, or None if there wasn't one"""
-		parsed_release_version = model.parse_version(this_version)
-
-		versions = [model.parse_version(version) for version in scm.get_tagged_versions()]
-		versions = [version for version in versions if version < parsed_release_version]
-
-		if versions:
-			return model.format_version(max(versions))
-		return None
+		return scm.get_tag_index().previous(this_version)
+
+	def find_previous_archive(previous_release, previous_archive_name):
+		"""Find the archive for an earlier release, which may have used any format.
+		@return: the path of the archive (which may not exist)"""
+		candidates = []
+		for previous_format in [archive_format] + archive.formats:
+			basename = previous_archive_name + '.' + previous_format.extension
+			candidates.append('..' + os.sep + previous_release + os.sep + basename)
+			# For archives created by older versions of 0release
+			candidates.append('..' + os.sep + basename)
+		for path in candidates:
+			if os.path.isfile(path):
+				return path
+		return candidates[0]
+
+	def create_archive(archive_file, archive_name, export_prefix, mtime):
+		# (submodules are streamed into the same archive)
+		with tracing.phase('export', archive = archive_file) as details:
+			status.archive_digest = scm.export(export_prefix, archive_file, status.head_at_release, compression_level,
+							   extract = archive_name, mtime = mtime, submodules = scm.has_submodules())
+			details['bytes'] = os.path.getsize(archive_file)
+
+		if phase_actions['generate-archive']:
+			try:
+				with tracing.phase('unpack'):
+					support.unpack_tarball(archive_file)
+				run_hooks('generate-archive', cwd = archive_name, env = {'RELEASE_VERSION': status.release_version})
+				info("Regenerating archive (may have been modified by generate-archive hooks...")
+				with tracing.phase('generate archive', archive = archive_file) as details:
+					status.archive_digest = archive.create_tarball(archive_file, archive_name, options.compression_jobs,
+										       compression_level, mtime = mtime)
+					details['bytes'] = os.path.getsize(archive_file)
+			except SafeException:
+				scm.reset_hard(scm.get_current_branch())
+				fail_candidate()
+				raise
 
 	def export_changelog(previous_release):
 		with open('changelog-%s' % status.release_version, 'w') as changelog:
@@ -216,20 +377,8 @@ def do_release(local_feed, options):
 		os.unlink(support.release_status_file)
 		print("Restored to state before starting release. Make your fixes and try again...")
 
-	def release_via_0repo(new_impls_feed):
-		import repo.cmd
-		support.make_archives_relative(new_impls_feed)
-		oldcwd = os.getcwd()
-		try:
-			cmd = ['0repo', 'add', '--', new_impls_feed]
-			print("Handing off to 0repo:")
-			print(" ".join(cmd))
-			print("")
-			repo.cmd.main(cmd)
-		finally:
-			os.chdir(oldcwd)
-
 	def accept_and_publish(archive_file, src_feed_name):
+		import feededit
 		if status.tagged:
 			print("Already tagged in SCM. Not re-tagging.")
 		else:
@@ -252,31 +401,29 @@ def do_release(local_feed, options):
 		# Merge the source and binary feeds together first, so
 		# that we update the master feed atomically and only
 		# have to sign it once.
-		with open(src_feed_name, 'rb') as stream:
-			doc = minidom.parse(stream)
-		for b in compiler.get_binary_feeds():
-			with open(b, 'rb') as stream:
-				bin_doc = minidom.parse(b)
-			merge.merge(doc, bin_doc)
-		new_impls_feed = 'merged.xml'
-		with open(new_impls_feed, 'w') as stream:
-			doc.writexml(stream)
+		with tracing.phase('merge feeds'):
+			editor = feededit.FeedEditor(src_feed_name)
+			editor.merge_feeds(compiler.get_binary_feeds(), merge.merge)
+			editor.make_archives_relative()
+			new_impls_feed = os.path.abspath('merged.xml')
+			editor.save(new_impls_feed)
 
 		# TODO: support uploading to a sub-feed (requires support in 0repo too)
 		master_feed, = local_feed.feed_for
 		repository = registry.lookup(master_feed, missing_ok = True)
 		if not repository:
 			raise SafeException("No repository for %s has been registered with 0repo!" % master_feed)
-		release_via_0repo(new_impls_feed)
+
+		if batch is not None:
+			batch.add_release(new_impls_feed, scm, status.release_version)
+			print("Release of %s %s accepted; it will be published with the rest of the batch." % (local_feed.get_name(), status.release_version))
+			return
+
+		hand_off_to_0repo([new_impls_feed])
 
 		os.unlink(new_impls_feed)
 
-		print("Push changes to public SCM repository...")
-		public_repos = options.public_scm_repository
-		if public_repos:
-			scm.push_head_and_release(status.release_version)
-		else:
-			print("NOTE: No public repository set => you'll have to push the tag and trunk yourself.")
+		push_release(scm, status.release_version, options)
 
 		os.unlink(support.release_status_file)
 
@@ -326,93 +473,123 @@ def do_release(local_feed, options):
 	os.environ['RELEASE_VERSION'] = status.release_version
 
 	archive_name = support.make_archive_name(local_feed.get_name(), status.release_version)
-	archive_file = archive_name + '.tar.bz2'
+	archive_file = archive_name + '.' + archive_format.extension
 
 	export_prefix = archive_name
 	if add_toplevel_dir is not None:
 		export_prefix += os.sep + add_toplevel_dir
 
-	if status.created_archive and os.path.isfile(archive_file):
-		print("Archive already created")
-	else:
+	def make_archive():
+		if status.created_archive and os.path.isfile(archive_file):
+			print("Archive already created")
+			return
 		support.backup_if_exists(archive_file)
-		scm.export(export_prefix, archive_file, status.head_at_release)
-
-		has_submodules = scm.has_submodules()
 
-		if phase_actions['generate-archive'] or has_submodules:
-			try:
-				support.unpack_tarball(archive_file)
-				if has_submodules:
-					scm.export_submodules(archive_name)
-				run_hooks('generate-archive', cwd = archive_name, env = {'RELEASE_VERSION': status.release_version})
-				info("Regenerating archive (may have been modified by generate-archive hooks...")
-				support.check_call(['tar', 'cjf', archive_file, archive_name])
-			except SafeException:
-				scm.reset_hard(scm.get_current_branch())
-				fail_candidate()
-				raise
+		# Archives are reproducible, with every file dated to the last commit before the
+		# release, so an identical archive from an earlier attempt can be reused
+		mtime = scm.get_commit_time(status.head_before_release)
+		archive_key = archivecache.get_key(scm.get_tree(status.head_at_release), export_prefix, archive_name,
+				phase_actions['generate-archive'], archive_format.extension, compression_level, mtime)
+		archive_cache = archivecache.get_archive_cache()
+		status.archive_digest = archive_cache.fetch(archive_key, archive_file)
+		if status.archive_digest:
+			print("Reusing identical archive from an earlier attempt")
+		else:
+			create_archive(archive_file, archive_name, export_prefix, mtime)
+			archive_cache.store(archive_key, archive_file, status.archive_digest)
 
 		status.created_archive = 'true'
 		status.save()
 
-	if need_set_snapshot:
-		set_to_snapshot(status.release_version + '-post')
-		# Revert back to the original revision, so that any fixes the user makes
-		# will get applied before the tag
-		scm.reset_hard(scm.get_current_branch())
-
-	#backup_if_exists(archive_name)
-	support.unpack_tarball(archive_file)
-
-	extracted_feed_path = os.path.abspath(os.path.join(export_prefix, local_iface_rel_root_path))
-	assert os.path.isfile(extracted_feed_path), "Local feed not in archive! Is it under version control?"
-	extracted_feed = support.load_feed(extracted_feed_path)
-	extracted_impl = support.get_singleton_impl(extracted_feed)
-
-	if extracted_impl.main:
-		# Find main executable, relative to the archive root
-		abs_main = os.path.join(os.path.dirname(extracted_feed_path), extracted_impl.id, extracted_impl.main)
-		main = os.path.relpath(abs_main, archive_name + os.sep)
-		if main != extracted_impl.main:
-			print("(adjusting main: '%s' for the feed inside the archive, '%s' externally)" % (extracted_impl.main, main))
-			# XXX: this is going to fail if the feed uses the new <command> syntax
-		if not os.path.exists(abs_main):
-			raise SafeException("Main executable '%s' not found after unpacking archive!" % abs_main)
-		if main == extracted_impl.main:
-			main = None	# Don't change the main attribute
-	else:
-		main = None
+	def start_snapshot():
+		if need_set_snapshot:
+			set_to_snapshot(status.release_version + '-post')
+			# Revert back to the original revision, so that any fixes the user makes
+			# will get applied before the tag
+			scm.reset_hard(scm.get_current_branch())
+
+	def unpack():
+		#backup_if_exists(archive_name)
+		# Make directories read-only (checks tests don't write)
+		import snapshot
+		src_snapshot = snapshot.Snapshot(archive_file, PRISTINE_DIR, archive_name)
+		src_snapshot.restore(archive_name, readonly = True)
+		return src_snapshot
+
+	def load_extracted_feed(src_snapshot):
+		"""@return: (path of the feed in the extracted archive, new main attribute or None)"""
+		extracted_feed_path = os.path.abspath(os.path.join(export_prefix, local_iface_rel_root_path))
+		assert os.path.isfile(extracted_feed_path), "Local feed not in archive! Is it under version control?"
+		extracted_feed = support.load_feed(extracted_feed_path)
+		extracted_impl = support.get_singleton_impl(extracted_feed)
+
+		if extracted_impl.main:
+			# Find main executable, relative to the archive root
+			abs_main = os.path.join(os.path.dirname(extracted_feed_path), extracted_impl.id, extracted_impl.main)
+			main = os.path.relpath(abs_main, archive_name + os.sep)
+			if main != extracted_impl.main:
+				print("(adjusting main: '%s' for the feed inside the archive, '%s' externally)" % (extracted_impl.main, main))
+				# XXX: this is going to fail if the feed uses the new <command> syntax
+			if not os.path.exists(abs_main):
+				raise SafeException("Main executable '%s' not found after unpacking archive!" % abs_main)
+			if main == extracted_impl.main:
+				main = None	# Don't change the main attribute
+		else:
+			main = None
+		return extracted_feed_path, main
 
-	try:
+	def run_tests(extracted):
 		if status.src_tests_passed:
 			print("Unit-tests already passed - not running again")
 		else:
-			# Make directories read-only (checks tests don't write)
-			support.make_readonly_recursive(archive_name)
-
-			run_unit_tests(extracted_feed_path)
+			run_unit_tests(extracted[0], test_shards, status.archive_digest)
 			status.src_tests_passed = True
 			status.save()
-	except SafeException:
+
+	def tests_failed():
 		print("(leaving extracted directory for examination)")
 		fail_candidate()
-		raise
-	# Unpack it again in case the unit-tests changed anything
-	ro_rmtree(archive_name)
-	support.unpack_tarball(archive_file)
 
-	# Generate feed for source
-	src_feed_name = '%s.xml' % archive_name
-	create_feed(src_feed_name, extracted_feed_path, archive_file, archive_name, main)
-	print("Wrote source feed as %s" % src_feed_name)
-
-	# If it's a source package, compile the binaries now...
-	compiler = compile.Compiler(options, os.path.abspath(src_feed_name), release_version = status.release_version)
-	compiler.build_binaries()
-
-	previous_release = get_previous_release(status.release_version)
-	export_changelog(previous_release)
+	def restore(src_snapshot):
+		# Restore it in case the unit-tests changed anything
+		src_snapshot.restore(archive_name, readonly = True)
+
+	def create_source_feed(extracted):
+		extracted_feed_path, main = extracted
+		src_feed_name = '%s.xml' % archive_name
+		create_feed(src_feed_name, extracted_feed_path, archive_file, archive_name, main)
+		print("Wrote source feed as %s" % src_feed_name)
+		return src_feed_name
+
+	def build_binaries(src_feed_name):
+		# If it's a source package, compile the binaries now...
+		import compile
+		compiler = compile.Compiler(options, os.path.abspath(src_feed_name), release_version = status.release_version)
+		compiler.build_binaries()
+		return compiler
+
+	# Stages which don't need each other's results run at the same time
+	# (e.g. the changelog is written while the tests run)
+	import pipeline
+	stages = pipeline.Pipeline(status)
+	stages.add('archive', make_archive)
+	# (the snapshot commits and resets the working tree, so nothing else may run alongside it)
+	stages.add('snapshot', start_snapshot, after = ['archive'], resumable = True)
+	stages.add('unpack', unpack, after = ['snapshot'])
+	stages.add('load feed', load_extracted_feed, inputs = ['unpack'])
+	stages.add('unit tests', run_tests, inputs = ['load feed'], resumable = True, on_error = tests_failed)
+	stages.add('restore', restore, inputs = ['unpack'], after = ['unit tests'])
+	stages.add('create source feed', create_source_feed, inputs = ['load feed'], after = ['restore'])
+	stages.add('build binaries', build_binaries, inputs = ['create source feed'])
+	# (after the archive, since a failed generate-archive hook abandons the candidate)
+	stages.add('previous release', lambda: get_previous_release(status.release_version), after = ['snapshot'])
+	stages.add('changelog', export_changelog, inputs = ['previous release'], resumable = True)
+	results = stages.run()
+	print(stages.format_critical_path())
+
+	src_feed_name = results['create source feed']
+	compiler = results['build binaries']
+	previous_release = results['previous release']
 
 	if status.tagged:
 		input('Already tagged. Press Return to resume publishing process...')
@@ -435,20 +612,16 @@ def do_release(local_feed, options):
 			choice = support.get_choice(['Publish', 'Fail'] + maybe_diff)
 			if choice == 'Diff':
 				previous_archive_name = support.make_archive_name(local_feed.get_name(), previous_release)
-				previous_archive_file = '..' + os.sep + previous_release + os.sep + previous_archive_name + '.tar.bz2'
-
-				# For archives created by older versions of 0release
-				if not os.path.isfile(previous_archive_file):
-					old_previous_archive_file = '..' + os.sep + previous_archive_name + '.tar.bz2'
-					if os.path.isfile(old_previous_archive_file):
-						previous_archive_file = old_previous_archive_file
+				previous_archive_file = find_previous_archive(previous_release, previous_archive_name)
 
 				if os.path.isfile(previous_archive_file):
-					support.unpack_tarball(previous_archive_file)
-					try:
-						support.show_diff(previous_archive_name, archive_name)
-					finally:
-						shutil.rmtree(previous_archive_name)
+					import archivediff
+					changes = archivediff.ArchiveDiff(previous_archive_file, archive_file)
+					changes.write_summary(sys.stdout)
+					if changes.changed:
+						print("Show changes to files?")
+						if support.get_choice(['Yes', 'No']) == 'Yes':
+							changes.write_unified_diffs(sys.stdout)
 				else:
 					# TODO: download it?
 					print("Sorry, archive file %s not found! Can't show diff." % previous_archive_file)
@@ -456,10 +629,35 @@ def do_release(local_feed, options):
 				break
 
 	info("Deleting extracted archive %s", archive_name)
-	shutil.rmtree(archive_name)
+	support.remove_tree(archive_name)
+	if os.path.exists(PRISTINE_DIR):
+		support.remove_tree(PRISTINE_DIR)
 
 	if choice == 'Publish':
 		accept_and_publish(archive_file, src_feed_name)
 	else:
 		assert choice == 'Fail'
 		fail_candidate()
+
+def benchmark_formats(local_feed, options):
+	"""Compress the current HEAD with each supported archive format and report the results."""
+	scm = get_scm(local_feed, options)
+	archive_name = support.make_archive_name(local_feed.get_name(), 'benchmark')
+	tmpdir = tempfile.mkdtemp(prefix = '0release-')
+	try:
+		tar_file = os.path.join(tmpdir, archive_name + '.tar')
+		with open(tar_file, 'wb') as stream:
+			scm.export_tar(archive_name, stream, scm.get_head_revision())
+		size = os.path.getsize(tar_file)
+		print("Uncompressed size of HEAD is %d bytes. Trying each format (this may take a while)...\n" % size)
+
+		available = [f for f in archive.formats if f.is_available()]
+		print("%-8s %12s %7s %11s %13s" % ('Format', 'Size', 'Ratio', 'Compress', 'Decompress'))
+		for archive_format, compressed_size, compress_time, decompress_time in archive.benchmark_formats(tar_file, options.compression_jobs, available):
+			print("%-8s %12d %6.1f%% %10.2fs %12.2fs" % (archive_format.extension, compressed_size,
+				100.0 * compressed_size / max(size, 1), compress_time, decompress_time))
+		for archive_format in archive.formats:
+			if archive_format not in available:
+				print("%-8s (skipped: '%s' command not found)" % (archive_format.extension, archive_format.command))
+	finally:
+		shutil.rmtree(tmpdir)
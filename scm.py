@@ -1,21 +1,163 @@
 # Copyright (C) 2007, Thomas Leonard
 # See the README file for details, or visit http://0install.net.
 
-import os, subprocess, tempfile
+import os, subprocess, json, codecs, threading
+from concurrent import futures
 from zeroinstall import SafeException
 from logging import info, warn
-from support import unpack_tarball
+import archive, tracing
+from tagindex import TagIndex
+
+class RepositoryStatus:
+	"""The state of one working copy, as found by GIT.check_health."""
+	def __init__(self, rel_path):
+		self.rel_path = rel_path	# Path from the superproject ('' for the superproject itself)
+		self.head = None		# The commit checked out
+		self.branch = None		# e.g. 'refs/heads/master', or None if detached
+		self.changes = []		# Uncommitted changes, as "XY path" lines
+		self.problems = []		# Reasons why we can't release from here
+
+class HealthReport:
+	"""The results of GIT.check_health, for the superproject and each submodule."""
+	def __init__(self, repos):
+		self.repos = repos
+		self.superproject = repos[0]
+
+	def get_problems(self):
+		"""@return: a list of (rel_path, problem) pairs"""
+		return [(repo.rel_path, problem) for repo in self.repos for problem in repo.problems]
+
+	def format(self):
+		lines = ["Checked %d repositories (%d submodule(s))" % (len(self.repos), len(self.repos) - 1)]
+		for repo in self.repos:
+			state = 'OK' if not repo.problems else 'NOT READY'
+			lines.append("  %-30s %-10s %s" % (repo.rel_path or '.', (repo.head or 'none')[:10], state))
+		return '\n'.join(lines)
+
+	def check(self):
+		"""@raise SafeException: if any repository has problems (listing all of them)"""
+		problems = self.get_problems()
+		if problems:
+			raise SafeException('\n'.join(problem if not rel_path else "Submodule %s: %s" % (rel_path, problem)
+							for rel_path, problem in problems))
 
 class SCM:
+	processes_spawned = 0		# Total for all SCM objects
+
 	def __init__(self, root_dir, options):
 		self.options = options
 		self.root_dir = root_dir
 		assert type(root_dir) == str, root_dir
 
 class GIT(SCM):
+	def __init__(self, root_dir, options):
+		SCM.__init__(self, root_dir, options)
+		self._cache = {}
+		self._cache_stamp = None
+		self._batch = None
+		self._lock = threading.RLock()	# For the cache and the batch process
+		self.tag_prefix = 'v'		# Release tags are named tag_prefix + version
+
 	def _run(self, args, **kwargs):
 		info("Running git %s (in %s)", ' '.join(args), self.root_dir)
-		return subprocess.Popen(["git"] + args, cwd = self.root_dir, **kwargs)
+		SCM.processes_spawned += 1
+		return tracing.Popen(["git"] + args, cwd = self.root_dir, **kwargs)
+
+	def _get_git_dirs(self):
+		"""Find the repository's git directory, and the one containing the refs (which
+		is different for linked worktrees).
+		@return: (git_dir, common_dir), or None if they can't be found"""
+		git_dir = os.path.join(self.root_dir, '.git')
+		try:
+			if os.path.isfile(git_dir):
+				# Submodule or linked worktree
+				with open(git_dir, 'r') as stream:
+					line = stream.read().strip()
+				if not line.startswith('gitdir:'): return None
+				git_dir = os.path.join(self.root_dir, line[7:].strip())
+			common_dir = git_dir
+			if os.path.isfile(os.path.join(git_dir, 'commondir')):
+				with open(os.path.join(git_dir, 'commondir'), 'r') as stream:
+					common_dir = os.path.join(git_dir, stream.read().strip())
+		except OSError:
+			return None
+		return git_dir, common_dir
+
+	def _stat_refs(self, common_dir, paths):
+		stamp = []
+		for path in paths:
+			try:
+				st = os.stat(os.path.join(common_dir, path))
+				stamp.append([st.st_ino, st.st_mtime_ns, st.st_size])
+			except OSError:
+				stamp.append(None)
+		return stamp
+
+	def _get_refs_stamp(self):
+		"""Return a value which changes whenever HEAD or any ref changes, without running git.
+		@return: the stamp, or None if we can't tell (so nothing should be cached)"""
+		dirs = self._get_git_dirs()
+		if dirs is None:
+			return None
+		git_dir, common_dir = dirs
+		try:
+			with open(os.path.join(git_dir, 'HEAD'), 'r') as stream:
+				head = stream.read()
+		except OSError:
+			return None
+		paths = ['packed-refs', 'refs/heads', 'refs/tags']
+		if head.startswith('ref: '):
+			paths.append(head[5:].strip())
+		return [head] + self._stat_refs(common_dir, paths)
+
+	def _cached(self, key, fn):
+		"""Return the cached result of fn(), unless the refs have changed since it was cached."""
+		with self._lock:
+			stamp = self._get_refs_stamp()
+			if stamp is None or stamp != self._cache_stamp:
+				self._invalidate()
+			if key in self._cache:
+				return self._cache[key]
+			value = fn()
+			if stamp is not None:
+				self._cache_stamp = stamp
+				self._cache[key] = value
+			return value
+
+	def _invalidate(self):
+		"""Forget everything we know about the refs (call after changing them)."""
+		with self._lock:
+			self._cache = {}
+			self._cache_stamp = None
+			self.close()
+
+	def close(self):
+		"""Stop the helper process, if running."""
+		with self._lock:
+			if self._batch is not None:
+				self._batch.stdin.close()
+				self._batch.wait()
+				self._batch.stdout.close()
+				self._batch = None
+
+	def _lookup(self, name):
+		"""Look up an object name (e.g. "HEAD" or "HEAD:path") using a long-lived
+		"git cat-file --batch-check" process, rather than starting a new git each time.
+		@return: (sha, type), or None if there is no such object"""
+		with self._lock:
+			if self._batch is None:
+				self._batch = self._run(['cat-file', '--batch-check'], stdin = subprocess.PIPE, stdout = subprocess.PIPE, encoding = 'utf-8')
+			self._batch.stdin.write(name + '\n')
+			self._batch.stdin.flush()
+			line = self._batch.stdout.readline()
+			if not line:
+				self.close()
+				raise SafeException("git cat-file exited unexpectedly")
+		parts = line.split()
+		if len(parts) != 3:
+			# "NAME missing" or "NAME ambiguous"
+			return None
+		return parts[0], parts[1]
 
 	def _run_check(self, args, **kwargs):
 		child = self._run(args, **kwargs)
@@ -27,18 +169,23 @@ class GIT(SCM):
 		child = self._run(args, stdout = subprocess.PIPE, encoding = 'utf-8', **kwargs)
 		stdout, unused = child.communicate()
 		if child.returncode:
-			raise SafeException('Failed to get current branch! Exit code %d: %s' % (child.returncode, stdout))
+			raise SafeException('"git %s" failed with exit code %d: %s' % (' '.join(args), child.returncode, stdout))
 		return stdout
 
 	def ensure_versioned(self, path):
 		"""Ensure path is a file tracked by the version control system.
 		@raise SafeException: if file is not tracked"""
-		out = self._run_stdout(['ls-tree', 'HEAD', path]).strip()
+		rel_path = os.path.relpath(os.path.abspath(path), self.root_dir)
+		if rel_path.startswith('..'):
+			out = self._run_stdout(['ls-tree', 'HEAD', path]).strip()
+		else:
+			out = self._cached(('versioned', rel_path), lambda: self._lookup('HEAD:' + rel_path.replace(os.sep, '/')))
 		if not out:
 			raise SafeException("File '%s' is not under version control, according to git-ls-tree" % path)
 
 	def reset_hard(self, revision):
 		self._run_check(['reset', '--hard', revision])
+		self._invalidate()
 
 	def ensure_committed(self):
 		child = self._run(["status", "--porcelain", "-uno"], stdout = subprocess.PIPE, encoding = 'utf-8')
@@ -67,7 +214,7 @@ class GIT(SCM):
 			yield scm
 
 	def make_tag(self, version):
-		return 'v' + version
+		return self.tag_prefix + version
 
 	def tag(self, version, revision):
 		tag = self.make_tag(version)
@@ -76,58 +223,221 @@ class GIT(SCM):
 		else:
 			key_opts = []
 		self._run_check(['tag', '-s'] + key_opts + ['-m', 'Release %s' % version, tag, revision])
+		self._invalidate()
 		print("Tagged as %s" % tag)
 
 	def get_current_branch(self):
-		current_branch = self._run_stdout(['symbolic-ref', 'HEAD']).strip()
+		current_branch = self._cached('branch', lambda: self._run_stdout(['symbolic-ref', 'HEAD']).strip())
 		info("Current branch is %s", current_branch)
 		return current_branch
 
 	def get_tagged_versions(self):
-		child = self._run(['tag', '-l', 'v*'], stdout = subprocess.PIPE, encoding = 'utf-8')
+		return self.get_tag_index().versions
+
+	def get_tag_index(self):
+		"""Get an index of the release tags.
+		The index is cached on disk, and rebuilt only when the tags change.
+		@rtype: L{tagindex.TagIndex}"""
+		return self._cached('tag-index', self._load_tag_index)
+
+	def _load_tag_index(self):
+		dirs = self._get_git_dirs()
+		if dirs is None:
+			return TagIndex(self._get_tagged_versions())
+		# (one index for each prefix; see release.Batch)
+		cache_file = os.path.join(dirs[1], '0release-tags-%s.json' % self.tag_prefix.replace('/', '_'))
+		# (git creates, renames or deletes files in these whenever a tag changes)
+		stamp = self._stat_refs(dirs[1], ['packed-refs', 'refs/tags'])
+
+		try:
+			with open(cache_file, 'r') as stream:
+				cached = json.load(stream)
+			if cached['stamp'] == stamp:
+				info("Loaded tag index from %s", cache_file)
+				return TagIndex.from_json(cached['index'])
+		except (OSError, ValueError, KeyError):
+			pass
+
+		index = TagIndex(self._get_tagged_versions())
+		try:
+			tmp_name = cache_file + '.new'
+			with open(tmp_name, 'w') as stream:
+				json.dump({'stamp': stamp, 'index': index.to_json()}, stream)
+			os.rename(tmp_name, cache_file)
+		except OSError as ex:
+			info("Can't save tag index: %s", ex)
+		return index
+
+	def _get_tagged_versions(self):
+		child = self._run(['for-each-ref', '--format=%(refname:strip=2)', 'refs/tags/' + self.tag_prefix + '*'], stdout = subprocess.PIPE, encoding = 'utf-8')
 		stdout, unused = child.communicate()
 		status = child.wait()
 		if status:
-			raise SafeException("git tag failed with exit code %d" % status)
-		return [v[1:] for v in stdout.split('\n') if v]
+			raise SafeException("git for-each-ref failed with exit code %d" % status)
+		return [v[len(self.tag_prefix):] for v in stdout.split('\n') if v]
 
 	def delete_branch(self, branch):
 		self._run_check(['branch', '-D', branch])
+		self._invalidate()
 
 	def push_head_and_release(self, version):
 		self._run_check(['push', self.options.public_scm_repository, self.make_tag(version), self.get_current_branch()])
 
 	def ensure_no_tag(self, version):
 		tag = self.make_tag(version)
-		child = self._run(['tag', '-l', tag], stdout = subprocess.PIPE, encoding = 'utf-8')
-		stdout, unused = child.communicate()
-		if tag in stdout.split('\n'):
+		if self.get_tag_index().exists(version):
 			raise SafeException(("Release %s is already tagged! If you want to replace it, do\n" + 
 						"git tag -d %s") % (version, tag))
 
-	def export(self, prefix, archive_file, revision):
-		child = self._run(['archive', '--format=tar', '--prefix=' + prefix + os.sep, revision], stdout = subprocess.PIPE)
-		with open(archive_file, 'wb') as stream:
-			subprocess.check_call(['bzip2', '-'], stdin = child.stdout, stdout = stream)
-			status = child.wait()
-		if status:
-			if os.path.exists(archive_file):
-				os.unlink(archive_file)
-			raise SafeException("git-archive failed with exit code %d" % status)
-
-	def export_submodules(self, target):
-		# Export all sub-modules under target
-		cwd = os.getcwd()
-		target = os.path.abspath(target)
-		for scm in self._submodules():
-			tmp = tempfile.NamedTemporaryFile(prefix = '0release-')
+	def export(self, prefix, archive_file, revision, level = None, extract = None, mtime = None, submodules = False):
+		"""Export revision to archive_file, with every path starting with prefix.
+		@param extract: also calculate the manifest digest of this directory in the archive
+		@param mtime: make a reproducible archive, with this as the time of every file
+		@param submodules: also include each submodule (as recorded in revision) in the archive
+		@return: the implementation ID, if extract was given"""
+		sources = [(self, revision, prefix)]
+		if submodules:
+			sources += [(scm, rev, prefix + '/' + scm.rel_path) for scm, rev in self._get_submodules(revision)]
+		# (all the "git archive" processes run at once)
+		children = [scm._run(['archive', '--format=tar', '--prefix=' + sub_prefix + os.sep, rev], stdout = subprocess.PIPE)
+				for scm, rev, sub_prefix in sources]
+		readers = []
+		try:
+			if len(children) == 1:
+				digest = archive.compress_stream(children[0].stdout, archive_file, self.options.compression_jobs, level, extract, mtime)
+			else:
+				readers = [archive.Prefetcher(child.stdout) for child in children]
+				digest = archive.compress_streams(readers, archive_file, self.options.compression_jobs, level, extract, mtime)
+		finally:
+			for reader in readers:
+				reader.close()
+			for child in children:
+				child.stdout.close()
+			statuses = [child.wait() for child in children]
+			for (scm, rev, sub_prefix), status in zip(sources, statuses):
+				if status:
+					if os.path.exists(archive_file):
+						os.unlink(archive_file)
+					raise SafeException("git-archive failed with exit code %d (in %s)" % (status, scm.root_dir))
+		return digest
+
+	def _get_submodule_entries(self, revision):
+		"""Find the submodules recorded in revision.
+		@return: a list of (path, commit) pairs"""
+		if self._lookup(revision + ':.gitmodules') is None:
+			return []
+		config = self._run_stdout(['config', '--blob', revision + ':.gitmodules', '--get-regexp', r'^submodule\..*\.path$'])
+		paths = [line.split(' ', 1)[1] for line in config.splitlines() if ' ' in line]
+		entries = []
+		for entry in self._run_stdout(['ls-tree', '-z', revision, '--'] + paths).split('\0'):
+			if not entry: continue
+			details, path = entry.split('\t', 1)
+			mode, obj_type, sha = details.split()
+			if obj_type == 'commit':
+				entries.append((path, sha))
+		return entries
+
+	def _get_submodules(self, revision):
+		"""Find the submodules recorded in revision. Each one must be checked out.
+		@return: a list of (GIT, commit) pairs, with rel_path set on each GIT"""
+		submodules = []
+		for path, sha in self._get_submodule_entries(revision):
+			scm = GIT(os.path.join(self.root_dir, path), self.options)
+			if not os.path.exists(os.path.join(scm.root_dir, '.git')):
+				raise SafeException("Submodule '%s' is not checked out (try 'git submodule update --init')" % path)
+			scm.rel_path = path
+			submodules.append((scm, sha))
+		return submodules
+
+	def _get_status(self, status):
+		"""Fill in the head, branch and changes of status from "git status"."""
+		items = self._run_stdout(['status', '--porcelain=v2', '--branch', '-uno', '-z']).split('\0')
+		items.reverse()
+		while items:
+			item = items.pop()
+			if item.startswith('# branch.oid '):
+				head = item.split(' ')[2]
+				status.head = None if head == '(initial)' else head
+			elif item.startswith('# branch.head '):
+				branch = item.split(' ', 2)[2]
+				status.branch = None if branch == '(detached)' else 'refs/heads/' + branch
+			elif item.startswith('1 '):
+				fields = item.split(' ', 8)
+				status.changes.append(fields[1] + ' ' + fields[8])
+			elif item.startswith('2 '):
+				fields = item.split(' ', 9)
+				status.changes.append(fields[1] + ' ' + fields[9] + ' <- ' + items.pop())
+			elif item.startswith('u '):
+				fields = item.split(' ', 10)
+				status.changes.append(fields[1] + ' ' + fields[10])
+
+	def _check_repository(self, rel_path, pinned = None):
+		"""Check one working copy (see check_health).
+		@param pinned: the commit the parent repository records for this submodule
+		@return: (RepositoryStatus, [(GIT, rel_path, pinned commit)] for its submodules)"""
+		status = RepositoryStatus(rel_path)
+		if not os.path.exists(os.path.join(self.root_dir, '.git')):
+			status.problems.append("not checked out (try 'git submodule update --init --recursive')")
+			return status, []
+		try:
+			self._get_status(status)
+			if status.changes:
+				status.problems.append('Uncommitted changes! Use "git-commit -a" to commit them. Changes are:\n' +
+						'\n'.join('  ' + change for change in status.changes))
+			if pinned is not None and status.head != pinned:
+				status.problems.append("checked out %s, but the parent repository records %s" % (status.head, pinned))
+			submodules = []
+			if status.head is not None:
+				for path, sha in self._get_submodule_entries('HEAD'):
+					submodules.append((GIT(os.path.join(self.root_dir, path), self.options), os.path.join(rel_path, path), sha))
+		except SafeException as ex:
+			status.problems.append(str(ex))
+			submodules = []
+		finally:
+			self.close()
+		return status, submodules
+
+	def check_health(self, tracked = (), jobs = 8):
+		"""Check that this working copy and all of its submodules (recursively) are ready
+		for a release. The repositories are checked in parallel. Each must have no uncommitted
+		changes, and each submodule must have checked out the commit its parent records.
+		@param tracked: paths which must be tracked in this repository
+		@rtype: L{HealthReport}"""
+		repos = []
+		with futures.ThreadPoolExecutor(max_workers = jobs) as pool:
+			pending = {pool.submit(self._check_repository, '')}
+			while pending:
+				done, pending = futures.wait(pending, return_when = futures.FIRST_COMPLETED)
+				for future in done:
+					status, submodules = future.result()
+					repos.append(status)
+					for scm, rel_path, pinned in submodules:
+						pending.add(pool.submit(scm._check_repository, rel_path, pinned))
+		repos.sort(key = lambda status: status.rel_path)
+		report = HealthReport(repos)
+		if report.superproject.branch is None:
+			report.superproject.problems.append("not on a branch (detached HEAD)")
+		for path in tracked:
 			try:
-				scm.export(prefix = '.', archive_file = tmp.name, revision = scm.rev)
-				os.chdir(os.path.join(target, scm.rel_path))
-				unpack_tarball(tmp.name)
-			finally:
-				tmp.close()
-		os.chdir(cwd)
+				self.ensure_versioned(path)
+			except SafeException as ex:
+				report.superproject.problems.append(str(ex))
+		return report
+
+	def get_tree(self, revision):
+		"""@return: the SHA of revision's tree"""
+		result = self._lookup(revision + '^{tree}')
+		if result is None:
+			raise SafeException("Can't find tree for revision '%s'" % revision)
+		return result[0]
+
+	def get_commit_time(self, revision):
+		"""@return: the committer time of revision (seconds since the epoch)"""
+		return int(self._cached(('commit-time', revision), lambda: self._run_stdout(['log', '-1', '--format=%ct', revision]).strip()))
+
+	def export_tar(self, prefix, stream, revision):
+		"""Write an uncompressed tar archive of revision to stream."""
+		self._run_check(['archive', '--format=tar', '--prefix=' + prefix + os.sep, revision], stdout = stream)
 
 	def commit(self, message, branch, parent):
 		self._run_check(['add', '-u'])		# Commit all changed tracked files to index
@@ -137,20 +447,18 @@ class GIT(SCM):
 		commit = stdout.strip()
 		info("Committed as %s", commit)
 		self._run_check(['branch', '-f', branch, commit])
+		self._invalidate()
 		return commit
 
 	def get_head_revision(self):
-		proc = self._run(['rev-parse', 'HEAD'], stdout = subprocess.PIPE, encoding = 'utf-8')
-		stdout, unused = proc.communicate()
-		if proc.returncode:
-			raise Exception("git rev-parse failed with exit code %d" % proc.returncode)
-		head = stdout.strip()
-		assert head
-		return head
+		head = self._cached('HEAD', lambda: self._lookup('HEAD'))
+		if head is None:
+			raise Exception("Can't resolve HEAD (no commits yet?)")
+		return head[0]
 
 	def export_changelog(self, last_release_version, head, stream):
 		if last_release_version:
-			self._run_check(['log', 'refs/tags/v' + last_release_version + '..' + head], stdout = stream)
+			self._run_check(['log', 'refs/tags/' + self.make_tag(last_release_version) + '..' + head], stdout = stream)
 		else:
 			self._run_check(['log', head], stdout = stream)
 
@@ -161,6 +469,102 @@ class GIT(SCM):
 			return
 		warn("git grep returned exit code %d", child.returncode)
 
+	def _get_added_lines(self, base):
+		"""Find the lines added or changed in HEAD since base.
+		@return: a dict mapping paths to (blob SHA, [(first line, line count)])"""
+		child = self._run(['-c', 'core.quotePath=false', 'diff', '-U0', '--no-color', '--no-ext-diff', '--no-renames',
+				'--full-index', '--no-prefix', base, 'HEAD'], stdout = subprocess.PIPE, encoding = 'utf-8', errors = 'replace')
+		changed = {}
+		blob = path = None
+		for line in child.stdout:
+			if line.startswith('diff '):
+				blob = path = None
+			elif path is None and line.startswith('index '):
+				blob = line.split()[1].split('..')[1]
+			elif path is None and line.startswith('+++ '):
+				# (git adds a tab after names containing spaces)
+				path = line[4:].rstrip('\n').rstrip('\t')
+				if path.startswith('"'):
+					path = _unquote(path)
+				if path == '/dev/null' or blob is None:
+					path = None
+				else:
+					changed[path] = (blob, [])
+			elif path is not None and line.startswith('@@ '):
+				# @@ -old[,count] +new[,count] @@
+				new = line.split()[2][1:].split(',')
+				count = int(new[1]) if len(new) > 1 else 1
+				if count:
+					changed[path][1].append((int(new[0]), count))
+		child.stdout.close()
+		if child.wait():
+			raise SafeException("git diff %s HEAD failed with exit code %d" % (base, child.returncode))
+		return {path: entry for path, entry in changed.items() if entry[1]}
+
+	def _grep_paths(self, pattern, paths):
+		"""Search HEAD's versions of paths.
+		@return: a dict mapping paths to lists of (line number, line), for paths with matches"""
+		child = self._run(['--literal-pathspecs', 'grep', '-I', '-n', '-z', '-e', pattern, 'HEAD', '--'] + paths,
+				stdout = subprocess.PIPE, encoding = 'utf-8', errors = 'replace')
+		matches = {}
+		for line in child.stdout:
+			parts = line.rstrip('\n').split('\0', 2)
+			if len(parts) == 3 and parts[0].startswith('HEAD:'):
+				matches.setdefault(parts[0][5:], []).append((int(parts[1]), parts[2]))
+		child.stdout.close()
+		if child.wait() not in [0, 1]:
+			raise SafeException("git grep returned exit code %d" % child.returncode)
+		return matches
+
+	def grep_changed(self, pattern, since_version, jobs = 4):
+		"""Like grep, but only report matches on lines added or changed since the release
+		since_version. The matches in each blob are cached in the git directory, so that
+		files which haven't changed since the last check aren't searched again.
+		@return: the number of matching lines"""
+		base = 'refs/tags/' + self.make_tag(since_version)
+		changed = self._get_added_lines(base)
+
+		dirs = self._get_git_dirs()
+		cache_file = dirs and os.path.join(dirs[1], '0release-grep.json')
+		blobs = {}
+		if cache_file:
+			try:
+				with open(cache_file, 'r') as stream:
+					cached = json.load(stream)
+				if cached['pattern'] == pattern:
+					blobs = cached['blobs']
+			except (OSError, ValueError, KeyError):
+				pass
+
+		missing = sorted(path for path, (blob, ranges) in changed.items() if blob not in blobs)
+		if missing:
+			info("Searching %d changed file(s) (%d unchanged since the last check)", len(missing), len(changed) - len(missing))
+			# (in chunks, to keep the command lines short and use several git processes)
+			chunks = [missing[i:i + 500] for i in range(0, len(missing), 500)]
+			with futures.ThreadPoolExecutor(max_workers = jobs) as pool:
+				for chunk, matches in zip(chunks, pool.map(lambda chunk: self._grep_paths(pattern, chunk), chunks)):
+					for path in chunk:
+						blobs[changed[path][0]] = matches.get(path, [])
+			if cache_file:
+				# Only keep blobs changed since the release; older ones won't be needed again
+				current = {blob for blob, ranges in changed.values()}
+				try:
+					tmp_name = cache_file + '.new'
+					with open(tmp_name, 'w') as stream:
+						json.dump({'pattern': pattern, 'blobs': {blob: hits for blob, hits in blobs.items() if blob in current}}, stream)
+					os.rename(tmp_name, cache_file)
+				except OSError as ex:
+					info("Can't save grep cache: %s", ex)
+
+		found = 0
+		for path in sorted(changed):
+			blob, ranges = changed[path]
+			for line_no, text in blobs[blob]:
+				if any(start <= line_no < start + count for start, count in ranges):
+					print("%s:%d:%s" % (path, line_no, text))
+					found += 1
+		return found
+
 	def has_submodules(self):
 		return os.path.isfile(os.path.join(self.root_dir, '.gitmodules'))
 
@@ -174,3 +578,12 @@ def get_scm(local_feed, options):
 		if parent == current:
 			raise SafeException("Unable to determine which version control system is being used. Couldn't find .git in %s or any parent directory." % start_dir)
 		current = parent
+
+def _unquote(path):
+	"""Decode a path which git has quoted because it contains unusual characters.
+	>>> _unquote('"tab\\\\there.txt"')
+	'tab\\there.txt'
+	>>> _unquote('"caf\\\\303\\\\251"')
+	'café'
+	"""
+	return codecs.escape_decode(path[1:-1].encode('utf-8'))[0].decode('utf-8', 'replace')
@@ -0,0 +1,188 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+import os, stat, json, shutil, errno, fcntl, time
+from logging import info
+from zeroinstall import SafeException
+
+import archive, support
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+# Version of the manifest files (older ones are treated as out of date)
+MANIFEST_FORMAT = 2
+
+def _reflink(src, dst):
+	"""Make dst a copy-on-write clone of src, if the filesystem supports it.
+	@return: True on success"""
+	with open(src, 'rb') as src_stream:
+		with open(dst, 'wb') as dst_stream:
+			try:
+				fcntl.ioctl(dst_stream.fileno(), FICLONE, src_stream.fileno())
+				return True
+			except OSError as ex:
+				if ex.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EBADF):
+					return False
+				raise
+	# (on failure, dst is left as an empty file)
+
+def scan_tree(root):
+	"""Describe everything under root.
+	@return: a dict mapping relative paths to [type, mode, size, mtime (ns), link target, inode]"""
+	entries = {}
+	def scan(rel_dir):
+		for entry in os.scandir(os.path.join(root, rel_dir)):
+			rel_path = os.path.join(rel_dir, entry.name)
+			st = entry.stat(follow_symlinks = False)
+			mode = stat.S_IMODE(st.st_mode)
+			if stat.S_ISDIR(st.st_mode):
+				entries[rel_path] = ['D', mode, 0, 0, None, 0]
+				scan(rel_path)
+			elif stat.S_ISLNK(st.st_mode):
+				entries[rel_path] = ['S', 0, 0, 0, os.readlink(entry.path), 0]
+			else:
+				entries[rel_path] = ['F', mode, st.st_size, st.st_mtime_ns, None, st.st_ino]
+	scan('')
+	return entries
+
+def _checkout_mode(mode, readonly):
+	if readonly:
+		return mode & 0o555
+	return mode
+
+def _same_contents(actual, expected, readonly, check_inodes = False):
+	"""Compare two results from scan_tree, ignoring inodes unless check_inodes is set.
+	Writing to a file changes its mtime (to the nanosecond), even if the size stays the same;
+	replacing it changes the inode. Permissions must match the expected ones (made read-only
+	if readonly is set); a chmod through a hard link changes them in every copy."""
+	if actual.keys() != expected.keys():
+		return False
+	for rel_path, (kind, mode, size, mtime, link_target, ino) in expected.items():
+		a_kind, a_mode, a_size, a_mtime, a_link_target, a_ino = actual[rel_path]
+		if [kind, size, mtime, link_target] != [a_kind, a_size, a_mtime, a_link_target] or (check_inodes and ino != a_ino):
+			info("%s has been modified", rel_path)
+			return False
+		if kind != 'S' and a_mode != _checkout_mode(mode, readonly):
+			info("Permissions of %s have been changed", rel_path)
+			return False
+	return True
+
+class Snapshot:
+	"""A pristine, read-only extraction of an archive, from which working copies can be
+	made quickly by reflinking (where the filesystem supports it) or hard-linking files.
+	A manifest of the archive's contents is stored alongside it so that copies can be
+	checked by comparing file metadata, without extracting the archive again.
+	@ivar extract: the directory in the archive that is copied"""
+
+	def __init__(self, archive_file, cache_dir, extract):
+		self.archive_file = os.path.abspath(archive_file)
+		self.dir = os.path.join(os.path.abspath(cache_dir), os.path.basename(archive_file))
+		self.root = os.path.join(self.dir, extract)
+		self.manifest_file = self.dir + '.manifest'
+		self.manifest = None
+
+	def _archive_id(self):
+		st = os.stat(self.archive_file)
+		return [st.st_size, st.st_mtime_ns]
+
+	def ensure(self):
+		"""Extract the archive into the cache, unless an up-to-date copy is already there."""
+		if self.manifest is not None:
+			return
+		if os.path.isfile(self.manifest_file):
+			with open(self.manifest_file, 'r') as stream:
+				saved = json.load(stream)
+			if saved.get('format') == MANIFEST_FORMAT and saved['archive'] == self._archive_id() and \
+			   os.path.isdir(self.root) and _same_contents(scan_tree(self.root), saved['entries'], readonly = True, check_inodes = True):
+				self.manifest = saved['entries']
+				info("Reusing pristine copy of %s", self.archive_file)
+				return
+			info("Pristine copy of %s is out of date or has been modified", self.archive_file)
+		self.discard()
+
+		os.makedirs(self.dir)
+		archive.extract_tarball(self.archive_file, self.dir)
+		if not os.path.isdir(self.root):
+			raise SafeException("Archive '%s' does not contain the directory '%s'" % (self.archive_file, os.path.relpath(self.root, self.dir)))
+		manifest = scan_tree(self.root)
+		# Make it read-only, so that hard-linked copies can't be modified by accident
+		support.make_readonly_recursive(self.root)
+
+		tmp_name = self.manifest_file + '.new'
+		with open(tmp_name, 'w') as stream:
+			json.dump({'format': MANIFEST_FORMAT, 'archive': self._archive_id(), 'entries': manifest}, stream)
+		os.rename(tmp_name, self.manifest_file)
+		self.manifest = manifest
+
+	def discard(self):
+		"""Remove the pristine copy from the cache."""
+		self.manifest = None
+		if os.path.exists(self.manifest_file):
+			os.unlink(self.manifest_file)
+		if os.path.exists(self.dir):
+			support.remove_tree(self.dir)
+
+	def checkout(self, target, readonly = False):
+		"""Create the directory target as a copy of the extract directory.
+		If readonly is set, everything inside target is made read-only (as for
+		support.unpack_tarball) and files may be hard-linked to the pristine copy;
+		otherwise they are reflinked or copied. Files are never hard-linked when
+		running as root, since root can write to read-only files."""
+		self.ensure()
+		start = time.time()
+		directories = []
+		use_reflink = True
+		may_link = os.geteuid() != 0
+		n_files = 0
+		os.makedirs(target, exist_ok = True)
+		for rel_path in sorted(self.manifest):
+			kind, mode, size, mtime, link_target, ino = self.manifest[rel_path]
+			src = os.path.join(self.root, rel_path)
+			dst = os.path.join(target, rel_path)
+			mode = _checkout_mode(mode, readonly)
+			if kind == 'D':
+				os.mkdir(dst)
+				directories.append((dst, mode))
+			elif kind == 'S':
+				os.symlink(link_target, dst)
+			else:
+				n_files += 1
+				if use_reflink:
+					use_reflink = _reflink(src, dst)
+					if not use_reflink:
+						os.unlink(dst)
+						info("Filesystem does not support reflinks; falling back to hard links or copying")
+				if use_reflink:
+					os.chmod(dst, mode)
+					os.utime(dst, ns = (mtime, mtime))
+				elif may_link and mode == mode & 0o555:
+					# (the pristine file already has this mode)
+					os.link(src, dst)
+				else:
+					shutil.copyfile(src, dst)
+					os.chmod(dst, mode)
+					os.utime(dst, ns = (mtime, mtime))
+		for path, mode in reversed(directories):
+			os.chmod(path, mode)
+		info("Created %s from pristine copy (%d files) in %.2fs", target, n_files, time.time() - start)
+
+	def is_unmodified(self, target, readonly = False):
+		"""Check whether target still matches a fresh checkout, by comparing file
+		metadata with the manifest."""
+		self.ensure()
+		if not os.path.isdir(target):
+			return False
+		return _same_contents(scan_tree(target), self.manifest, readonly)
+
+	def restore(self, target, readonly = False):
+		"""Make target a fresh copy of the archive's contents again, keeping the
+		existing tree if it hasn't been modified."""
+		if self.is_unmodified(target, readonly):
+			info("%s is unmodified; not recreating it", target)
+			return
+		if os.path.exists(target):
+			support.remove_tree(target)
+		# A hard-linked copy may have modified the pristine tree too, so check that again
+		self.manifest = None
+		self.checkout(target, readonly)
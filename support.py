@@ -1,20 +1,20 @@
 # Copyright (C) 2007, Thomas Leonard
 # See the README file for details, or visit http://0install.net.
 
-import copy
-import os, subprocess, tarfile, platform
-import urllib.parse, ftplib, http.client
-from xml.dom import minidom
+import os, sys, subprocess, platform, stat, shutil, time, threading
+from concurrent import futures
+import urllib.parse
 
 from zeroinstall import SafeException
-from zeroinstall.injector import model, qdom, namespaces
-from zeroinstall.support import ro_rmtree, portable_rename
+from zeroinstall.injector import model, qdom
+from zeroinstall.support import portable_rename
 from logging import info
 
 release_status_file = os.path.abspath('release-status')
 
 def check_call(*args, **kwargs):
-	exitstatus = subprocess.call(*args, **kwargs)
+	import tracing
+	exitstatus = tracing.call(*args, **kwargs)
 	if exitstatus != 0:
 		if type(args[0]) == str:
 			cmd = args[0]
@@ -22,9 +22,16 @@ def check_call(*args, **kwargs):
 			cmd = ' '.join(args[0])
 		raise SafeException("Command failed with exit code %d:\n%s" % (exitstatus, cmd))
 
-def show_and_run(cmd, args):
-	print("Executing: %s %s" % (cmd, ' '.join("[%s]" % x for x in args)))
-	check_call(['sh', '-c', cmd, '-'] + args)
+def log_redirect(log):
+	"""Keyword arguments for subprocess to send all output to log (if not None)."""
+	if log is None:
+		return {}
+	log.flush()
+	return {'stdout': log, 'stderr': subprocess.STDOUT}
+
+def show_and_run(cmd, args, log = None):
+	print("Executing: %s %s" % (cmd, ' '.join("[%s]" % x for x in args)), file = log or sys.stdout)
+	check_call(['sh', '-c', cmd, '-'] + args, **log_redirect(log))
 
 def suggest_release_version(snapshot_version):
 	"""Given a snapshot version, suggest a suitable release version.
@@ -74,10 +81,7 @@ def backup_if_exists(name):
 	backup = name + '~'
 	if os.path.exists(backup):
 		print("(deleting old backup %s)" % backup)
-		if os.path.isdir(backup):
-			ro_rmtree(backup)
-		else:
-			os.unlink(backup)
+		remove_tree(backup)
 	portable_rename(name, backup)
 	print("(renamed old %s as %s; will delete on next run)" % (name, backup))
 
@@ -92,23 +96,11 @@ def get_choice(options):
 def make_archive_name(feed_name, version):
 	return feed_name.lower().replace(' ', '-') + '-' + version
 
-def in_PATH(prog):
-	for x in os.environ['PATH'].split(':'):
-		if os.path.isfile(os.path.join(x, prog)):
-			return True
-	return False
-
-def show_diff(from_dir, to_dir):
-	for cmd in [['meld'], ['xxdiff'], ['diff', '-ur']]:
-		if in_PATH(cmd[0]):
-			code = os.spawnvp(os.P_WAIT, cmd[0], cmd + [from_dir, to_dir])
-			if code:
-				print("WARNING: command %s failed with exit code %d" % (cmd, code))
-			return
-
 class Status(object):
 	__slots__ = ['old_snapshot_version', 'release_version', 'head_before_release', 'new_snapshot_version',
-		     'head_at_release', 'created_archive', 'src_tests_passed', 'tagged']
+		     'head_at_release', 'created_archive', 'archive_digest', 'src_tests_passed', 'completed_stages', 'tagged']
+	_save_lock = threading.Lock()	# (stages of a release may run in parallel)
+
 	def __init__(self):
 		for name in self.__slots__:
 			setattr(self, name, None)
@@ -123,50 +115,101 @@ class Status(object):
 					info("Loaded status %s=%s", name, value)
 
 	def save(self):
-		tmp_name = release_status_file + '.new'
-		try:
-			with open(tmp_name, 'w') as tmp:
-				lines = ["%s=%s\n" % (name, getattr(self, name)) for name in self.__slots__ if getattr(self, name)]
-				tmp.write(''.join(lines))
-			portable_rename(tmp_name, release_status_file)
-			info("Wrote status to %s", release_status_file)
-		except:
-			os.unlink(tmp_name)
-			raise
-
-def unpack_tarball(archive_file):
-	tar = tarfile.open(archive_file, 'r:bz2')
-	members = [m for m in tar.getmembers() if m.name != 'pax_global_header']
-	#tar.extractall('.', members = members) # Python >= 2.5 only
-	for tarinfo in members:
-		tarinfo = copy.copy(tarinfo)
-		tarinfo.mode |= 0o600
-		tarinfo.mode &= 0o755
-		tar.extract(tarinfo, '.')
+		with self._save_lock:
+			tmp_name = release_status_file + '.new'
+			try:
+				with open(tmp_name, 'w') as tmp:
+					lines = ["%s=%s\n" % (name, getattr(self, name)) for name in self.__slots__ if getattr(self, name)]
+					tmp.write(''.join(lines))
+				portable_rename(tmp_name, release_status_file)
+				info("Wrote status to %s", release_status_file)
+			except:
+				os.unlink(tmp_name)
+				raise
+
+def unpack_tarball(archive_file, readonly = False):
+	import archive
+	archive.extract_tarball(archive_file, '.', readonly = readonly)
+
+# Absolute path -> ((mtime, size), path, feed)
+_feed_cache = {}
 
 def load_feed(path):
+	"""Parse the feed at path. The result is shared with other callers loading the
+	same file, until the file is changed (so it must not be modified)."""
+	abs_path = os.path.abspath(path)
+	st = os.stat(abs_path)
+	stamp = (st.st_mtime_ns, st.st_size)
+	cached = _feed_cache.get(abs_path)
+	if cached is not None and cached[0] == stamp and cached[1] == path:
+		info("Using cached copy of feed %s", path)
+		return cached[2]
 	with open(path, 'rb') as stream:
-		return model.ZeroInstallFeed(qdom.parse(stream), local_path = path)
+		feed = model.ZeroInstallFeed(qdom.parse(stream), local_path = path)
+	_feed_cache[abs_path] = (stamp, path, feed)
+	return feed
 
 def get_archive_basename(impl):
 	# "2" means "path" (for Python 2.4)
 	return os.path.basename(urllib.parse.urlparse(impl.download_sources[0].url)[2])
 
+def _chmod_dir(path, change_mode):
+	"""Apply change_mode to the entries in directory path (not following symlinks).
+	@return: (number of entries, subdirectories)"""
+	n_entries = 0
+	subdirs = []
+	with os.scandir(path) as entries:
+		for entry in entries:
+			n_entries += 1
+			if entry.is_symlink(): continue
+			mode = entry.stat(follow_symlinks = False).st_mode
+			new_mode = change_mode(mode)
+			if new_mode != stat.S_IMODE(mode):
+				os.chmod(entry.path, new_mode)
+			if stat.S_ISDIR(mode):
+				subdirs.append(entry.path)
+	return n_entries, subdirs
+
+def _chmod_recursive(path, change_mode, description):
+	"""Apply change_mode to everything under path, using a pool of threads which each
+	process one directory at a time."""
+	start = time.time()
+	total = 0
+	with futures.ThreadPoolExecutor() as pool:
+		pending = {pool.submit(_chmod_dir, path, change_mode)}
+		while pending:
+			done, pending = futures.wait(pending, return_when = futures.FIRST_COMPLETED)
+			for future in done:
+				n_entries, subdirs = future.result()
+				total += n_entries
+				pending |= {pool.submit(_chmod_dir, subdir, change_mode) for subdir in subdirs}
+	taken = time.time() - start
+	info("%s %s: %d entries in %.2fs (%d entries/s)", description, path, total, taken, total / max(taken, 1e-6))
+
 def make_readonly_recursive(path):
-	for root, dirs, files in os.walk(path):
-		for d in dirs + files:
-			full = os.path.join(root, d)
-			mode = os.stat(full).st_mode
-			os.chmod(full, mode & 0o555)
-
-def make_archives_relative(feed):
-	with open(feed, 'rb') as stream:
-		doc = minidom.parse(stream)
-	for elem in doc.getElementsByTagNameNS(namespaces.XMLNS_IFACE, 'archive') + doc.getElementsByTagNameNS(namespaces.XMLNS_IFACE, 'file'):
-		href = elem.getAttribute('href')
-		assert href, 'Missing href on %r' % elem
-		if '/' in href:
-			elem.setAttribute('href', href.rsplit('/', 1)[1])
-	with open(feed, 'w') as stream:
-		doc.writexml(stream)
-		stream.write('\n')
+	"""Remove write permission from everything under path (but not path itself)."""
+	_chmod_recursive(path, lambda mode: stat.S_IMODE(mode) & 0o555, "Made read-only")
+
+def make_writable_recursive(path):
+	"""Undo make_readonly_recursive, giving the owner write permission again."""
+	_chmod_recursive(path, lambda mode: stat.S_IMODE(mode) | 0o200, "Made writable")
+
+def link_or_copy(src, dst):
+	"""Make dst a copy of src (replacing it), sharing the data with a hard link if possible."""
+	if os.path.lexists(dst):
+		os.unlink(dst)
+	try:
+		os.link(src, dst)
+	except OSError:
+		shutil.copy2(src, dst)
+
+def remove_tree(path):
+	"""Like shutil.rmtree, but also works for trees made by make_readonly_recursive
+	(or unpack_tarball with readonly set, or a read-only snapshot checkout)."""
+	if os.path.isdir(path) and not os.path.islink(path):
+		os.chmod(path, 0o700)
+		# (only the directories need to be writable to delete their contents)
+		_chmod_recursive(path, lambda mode: stat.S_IMODE(mode) | 0o700 if stat.S_ISDIR(mode) else stat.S_IMODE(mode), "Preparing to delete")
+		shutil.rmtree(path)
+	else:
+		os.unlink(path)
@@ -0,0 +1,70 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+import bisect
+from logging import info
+from zeroinstall import SafeException
+from zeroinstall.injector import model
+
+class TagIndex:
+	"""A sorted index of the versions of a project's release tags.
+	>>> index = TagIndex(['0.1', '0.10', '0.2', '1.0-rc1'])
+	>>> index.previous('0.10')
+	'0.2'
+	>>> index.next('0.10')
+	'1.0-rc1'
+	>>> index.exists('0.2'), index.exists('0.3')
+	(True, False)
+	>>> index.range('0.2', '1.0')
+	['0.2', '0.10', '1.0-rc1']
+	"""
+
+	def __init__(self, versions, parsed = None):
+		"""@param versions: version strings (tag names without the 'v')
+		@param parsed: the results of model.parse_version for each version (or None if invalid), if already known"""
+		if parsed is None:
+			parsed = [_parse(v) for v in versions]
+		self._parsed = dict(zip(versions, parsed))
+		self.all_versions = set(versions)
+		entries = sorted((p, v) for p, v in zip(parsed, versions) if p is not None)
+		self._keys = [p for p, v in entries]
+		self.versions = [v for p, v in entries]
+
+	def exists(self, version):
+		"""Is there a tag for exactly this version string?"""
+		return version in self.all_versions
+
+	def previous(self, version):
+		"""The highest tagged version before version, or None."""
+		i = bisect.bisect_left(self._keys, model.parse_version(version))
+		if i == 0:
+			return None
+		return self.versions[i - 1]
+
+	def next(self, version):
+		"""The lowest tagged version after version, or None."""
+		i = bisect.bisect_right(self._keys, model.parse_version(version))
+		if i == len(self.versions):
+			return None
+		return self.versions[i]
+
+	def range(self, low = None, high = None):
+		"""The tagged versions v with low <= v < high, in order (either limit may be None)."""
+		start = 0 if low is None else bisect.bisect_left(self._keys, model.parse_version(low))
+		end = len(self.versions) if high is None else bisect.bisect_left(self._keys, model.parse_version(high))
+		return self.versions[start:end]
+
+	def to_json(self):
+		versions = sorted(self.all_versions)
+		return {'versions': versions, 'parsed': [self._parsed[v] for v in versions]}
+
+	@staticmethod
+	def from_json(data):
+		return TagIndex(data['versions'], data['parsed'])
+
+def _parse(version):
+	try:
+		return model.parse_version(version)
+	except SafeException:
+		info("Ignoring tag 'v%s' (not a valid version number)", version)
+		return None
@@ -0,0 +1,163 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+import hashlib, base64, tarfile
+
+# The archive is read this many bytes at a time
+READ_SIZE = 1024 * 1024
+
+def _get_id(digest):
+	# (same as zeroinstall's sha256new getID)
+	return 'sha256new_' + base64.b32encode(digest.digest()).decode('ascii').rstrip('=')
+
+class HashingReader:
+	"""Wraps a file, keeping a sha256 digest of everything read from it."""
+	def __init__(self, stream):
+		self.stream = stream
+		self.digest = hashlib.sha256()
+
+	def read(self, size = -1):
+		data = self.stream.read(size)
+		self.digest.update(data)
+		return data
+
+class TeeReader:
+	"""Wraps a file, copying everything read from it to sink."""
+	def __init__(self, stream, sink):
+		self.stream = stream
+		self.sink = sink
+
+	def read(self, size = -1):
+		data = self.stream.read(size)
+		if data:
+			self.sink.write(data)
+		return data
+
+	def drain(self):
+		"""Copy the rest of the input to sink."""
+		while self.read(READ_SIZE):
+			pass
+
+class ManifestBuilder:
+	"""Calculates the sha256new manifest of the directory extract within a tar archive
+	from the archive's members, giving the same result as extracting it and running
+	"0store manifest" on the directory, but without writing anything to disk.
+	Members may be added in any order.
+
+	>>> builder = ManifestBuilder('foo-1.0')
+	>>> for name, data, mode in [('foo-1.0/run', b'#!/bin/sh\\n', 0o755), ('foo-1.0/lib/a.py', b'', 0o644), ('other', b'x', 0o644)]:
+	...     member = tarfile.TarInfo(name)
+	...     member.mode, member.mtime, member.size = mode, 100, len(data)
+	...     builder.add_file(member, hashlib.sha256(data).hexdigest())
+	>>> for line in builder.get_manifest(): print(' '.join(word[:10] for word in line.split()))
+	X a8076d3d28 100 10 run
+	D /lib
+	F e3b0c44298 100 0 a.py
+	"""
+
+	def __init__(self, extract = None):
+		self.prefix = extract.strip('/') + '/' if extract else ''
+		self.dirs = {'': {}}		# Relative path -> {leaf: manifest line, or None for subdirectories}
+		self.files = {}			# Relative path -> (type, hash, mtime, size), for hard links
+
+	def _get_relative(self, name):
+		"""The path of the member called name relative to extract, or None if it isn't inside it."""
+		while name.startswith('./'):
+			name = name[2:]
+		name = name.strip('/')
+		if not self.prefix:
+			return name
+		if name + '/' == self.prefix:
+			return ''
+		if name.startswith(self.prefix):
+			return name[len(self.prefix):]
+		return None
+
+	def _add_dir(self, path):
+		if path in self.dirs:
+			return
+		parent, leaf = path.rsplit('/', 1) if '/' in path else ('', path)
+		self._add_dir(parent)
+		self.dirs[parent][leaf] = None
+		self.dirs[path] = {}
+
+	def _add_entry(self, path, line):
+		parent, leaf = path.rsplit('/', 1) if '/' in path else ('', path)
+		self._add_dir(parent)
+		self.dirs[parent][leaf] = line
+
+	def add_file(self, member, sha256):
+		"""Add a regular file whose contents have the given (hex) sha256 digest."""
+		path = self._get_relative(member.name)
+		if not path or path == '.manifest':
+			return
+		entry = ('X' if member.mode & 0o111 else 'F', sha256, int(member.mtime), member.size)
+		self.files[path] = entry
+		self._add_entry(path, "%s %s %s %s" % entry)
+
+	def add(self, member, stream = None):
+		"""Add a member of the archive.
+		@param stream: the contents, for regular files (e.g. from TarFile.extractfile)"""
+		path = self._get_relative(member.name)
+		if not path:
+			return		# Outside extract, or extract itself
+
+		if member.isfile():
+			digest = hashlib.sha256()
+			while True:
+				data = stream.read(READ_SIZE)
+				if not data: break
+				digest.update(data)
+			self.add_file(member, digest.hexdigest())
+			return
+
+		if member.isdir():
+			self._add_dir(path)
+		elif member.issym():
+			target = member.linkname.encode('utf-8', 'surrogateescape')
+			self._add_entry(path, "S %s %s" % (hashlib.sha256(target).hexdigest(), len(target)))
+		elif member.islnk():
+			target = self._get_relative(member.linkname)
+			if target in self.files:
+				self.files[path] = self.files[target]
+				self._add_entry(path, "%s %s %s %s" % self.files[target])
+
+	def get_manifest(self):
+		"""Generate the lines of the manifest, in the order used by sha256new."""
+		def recurse(path):
+			entries = self.dirs[path]
+			subdirs = []
+			for leaf in sorted(entries):
+				line = entries[leaf]
+				if line is None:
+					subdirs.append(leaf)
+				else:
+					yield line + ' ' + leaf
+			for leaf in subdirs:
+				sub = path + '/' + leaf if path else leaf
+				yield 'D /' + sub
+				yield from recurse(sub)
+		return recurse('')
+
+	def get_id(self):
+		"""The implementation ID (e.g. "sha256new_...") for the manifest."""
+		digest = hashlib.sha256()
+		for line in self.get_manifest():
+			digest.update((line + '\n').encode('utf-8', 'surrogateescape'))
+		return _get_id(digest)
+
+def digest_tar_stream(stream, extract = None, sink = None):
+	"""Calculate the manifest digest of the directory extract within the uncompressed
+	tar archive read from stream, optionally copying the archive to sink as it is read.
+	@return: the implementation ID"""
+	builder = ManifestBuilder(extract)
+	if sink is not None:
+		stream = TeeReader(stream, sink)
+	with tarfile.open(fileobj = stream, mode = 'r|') as tar:
+		for member in iter(tar.next, None):
+			tar.members = []	# (don't keep every member in memory; see archive.iter_members)
+			builder.add(member, tar.extractfile(member) if member.isfile() else None)
+	if sink is not None:
+		# Copy the end-of-archive blocks too
+		stream.drain()
+	return builder.get_id()
@@ -0,0 +1,138 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Runs the self-tests for a release candidate, optionally split into shards which
+# run in parallel, remembering which source trees have already passed.
+
+import os, json, time, threading
+from concurrent import futures
+from logging import info, warn
+from zeroinstall import SafeException
+from zeroinstall.support import basedir, portable_rename
+
+import tracing
+
+# Exit status of the test command when the feed has no tests
+NO_TESTS = 2
+
+# Forget results not used for this long
+MAX_AGE = 90 * 24 * 60 * 60
+
+def get_result_key(digest, test_command, shard, shards):
+	"""The cache key for a passing run of one shard of the tests for the tree with this digest.
+	>>> get_result_key('sha256new_ABC', '0test', 1, 4)
+	'sha256new_ABC 0test 1/4'
+	"""
+	return '%s %s %d/%d' % (digest, test_command, shard, shards)
+
+class ResultCache:
+	"""Records which test runs have passed, in a JSON file mapping keys to the time
+	they were last used. Safe to use from several threads."""
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		try:
+			with open(path, 'r') as stream:
+				self.results = json.load(stream)
+		except (OSError, ValueError):
+			self.results = {}
+
+	def has_passed(self, key):
+		with self.lock:
+			if key not in self.results:
+				return False
+			self.results[key] = time.time()
+			return True
+
+	def record_pass(self, key):
+		with self.lock:
+			self.results[key] = time.time()
+			self._save()
+
+	def _save(self):
+		cutoff = time.time() - MAX_AGE
+		self.results = {key: when for key, when in self.results.items() if when >= cutoff}
+		try:
+			os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok = True)
+			tmp_name = self.path + '.new'
+			with open(tmp_name, 'w') as stream:
+				json.dump(self.results, stream)
+			portable_rename(tmp_name, self.path)
+		except OSError as ex:
+			warn("Failed to save test results to %s: %s", self.path, ex)
+
+def get_result_cache():
+	return ResultCache(os.path.join(basedir.xdg_cache_home, '0install.net', '0release', 'test-results.json'))
+
+class TestRunner:
+	"""Runs "test_command -- feed" as shards separate processes, all at once. Each process
+	gets RELEASE_TEST_SHARD (0 to shards - 1) and RELEASE_TEST_SHARDS in its environment
+	and should run only its own share of the tests.
+	@ivar results: if not None, a ResultCache used to skip shards which already passed for digest"""
+
+	def __init__(self, test_command, shards = 1, results = None):
+		self.test_command = test_command
+		self.shards = max(shards, 1)
+		self.results = results
+
+	def get_log_file(self, shard):
+		return 'test-shard-%d.log' % shard
+
+	def _run_shard(self, feed, shard, log = None):
+		env = os.environ.copy()
+		env['RELEASE_TEST_SHARD'] = str(shard)
+		env['RELEASE_TEST_SHARDS'] = str(self.shards)
+		kwargs = {}
+		if log is not None:
+			kwargs = {'stdout': log, 'stderr': log}
+		with tracing.phase('tests (shard %d/%d)' % (shard + 1, self.shards)):
+			return tracing.call([self.test_command, '--', feed], env = env, **kwargs)
+
+	def _run_logged(self, feed, shard):
+		with open(self.get_log_file(shard), 'w') as log:
+			return self._run_shard(feed, shard, log)
+
+	def run(self, feed, digest = None):
+		"""Run the tests for feed (whose implementation has the given digest).
+		@raise SafeException: if any shard fails"""
+		keys = [get_result_key(digest, self.test_command, shard, self.shards) for shard in range(self.shards)]
+		pending = []
+		for shard, key in enumerate(keys):
+			if digest and self.results is not None and self.results.has_passed(key):
+				info("Tests for shard %d already passed for %s", shard, digest)
+			else:
+				pending.append(shard)
+		if not pending:
+			print("Self-tests already passed for this source tree (%s) - not running again" % digest)
+			return
+
+		if self.shards == 1:
+			statuses = {0: self._run_shard(feed, 0)}
+		else:
+			print("Running %d of %d test shards in parallel (logs in test-shard-*.log)..." % (len(pending), self.shards))
+			with futures.ThreadPoolExecutor(max_workers = len(pending)) as pool:
+				running = {shard: pool.submit(self._run_logged, feed, shard) for shard in pending}
+				statuses = {shard: future.result() for shard, future in running.items()}
+
+		if all(code == NO_TESTS for code in statuses.values()):
+			print("SKIPPED unit tests for %s (no 'test' command)" % feed)
+			return
+
+		failed = []
+		for shard in sorted(statuses):
+			code = statuses[shard]
+			if code == 0:
+				if digest and self.results is not None:
+					self.results.record_pass(keys[shard])
+			else:
+				failed.append(shard)
+				if self.shards > 1:
+					print("Test shard %d FAILED with exit status %d (see %s)" % (shard, code, self.get_log_file(shard)))
+
+		if failed:
+			if self.shards == 1:
+				raise SafeException("Self-test failed with exit status %d" % statuses[0])
+			raise SafeException("Self-test failed for %d of %d shard(s)" % (len(failed), self.shards))
+		if self.shards > 1:
+			print("All %d test shards passed" % self.shards)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Times the stages of the release pipeline on a generated git repository,
+# so that different versions of 0release can be compared. Not run by testall.py
+# (testbenchmark.py only checks that it works, with small parameters).
+#
+# Runs offline: unless they are already set, ZI_PUBLISH, ZI_TEST and
+# RELEASE_0REPO are pointed at minimal local stand-ins.
+#
+# Examples:
+#   benchmark.py --files 20000 --size-mb 200 --output new.json
+#   benchmark.py --compare old.json new.json
+
+import sys, os, time, random, subprocess, tempfile, io, json, re, shutil
+from optparse import OptionParser, Values
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(my_dir, '..'))
+
+FEED_NS = 'http://zero-install.sourceforge.net/2004/injector/interface'
+
+STANDIN_0PUBLISH = """#!%s
+# Stand-in for 0publish: just applies --set-version and --set-released
+import sys
+from xml.dom import minidom
+args = sys.argv[1:]
+feed = args.pop()
+with open(feed, 'rb') as stream:
+	doc = minidom.parse(stream)
+settings = dict(zip(args[::2], args[1::2]))
+for impl in doc.getElementsByTagNameNS('%s', 'implementation'):
+	if '--set-version' in settings: impl.setAttribute('version', settings['--set-version'])
+	if '--set-released' in settings: impl.setAttribute('released', settings['--set-released'])
+with open(feed, 'w') as stream:
+	doc.writexml(stream)
+""" % (sys.executable, FEED_NS)
+
+STANDIN_0TEST = """#!/bin/sh
+exit 0
+"""
+
+# Stand-in for 0repo's merge: copy the implementations across
+STANDIN_0REPO = {
+	'__init__.py': '',
+	'registry.py': 'def lookup(uri, missing_ok = False):\n\treturn None\n',
+	'cmd.py': 'def main(argv):\n\tpass\n',
+	'merge.py': """def merge(master_doc, local_doc):
+	for impl in local_doc.getElementsByTagNameNS('%s', 'implementation'):
+		master_doc.documentElement.appendChild(master_doc.importNode(impl, True))
+""" % FEED_NS,
+}
+
+FEED_TEMPLATE = """<?xml version="1.0" ?>
+<interface xmlns="%s">
+  <name>Bench</name>
+  <summary>benchmark project</summary>
+  <feed-for interface="http://example.com/bench.xml"/>
+  <implementation id="." version="1.0-post" arch="%%s"/>
+</interface>
+""" % FEED_NS
+
+def make_data(size, rand):
+	"""Generate size bytes of text that compresses roughly like source code."""
+	words = [''.join(rand.choice('abcdefghijklmnopqrstuvwxyz_') for i in range(rand.randint(2, 12))) for j in range(2000)]
+	chunks = []
+	total = 0
+	while total < size:
+		line = '\t' * rand.randint(0, 3) + ' '.join(rand.choice(words) for i in range(rand.randint(1, 10))) + '\n'
+		chunks.append(line)
+		total += len(line)
+	return ''.join(chunks).encode('ascii')[:size]
+
+def setup_environment(tmpdir):
+	"""Point ZI_PUBLISH, ZI_TEST and RELEASE_0REPO at stand-ins, unless already set."""
+	bindir = os.path.join(tmpdir, 'bin')
+	os.mkdir(bindir)
+	for var, name, script in [('ZI_PUBLISH', '0publish', STANDIN_0PUBLISH), ('ZI_TEST', '0test', STANDIN_0TEST)]:
+		if var not in os.environ:
+			path = os.path.join(bindir, name)
+			with open(path, 'w') as stream:
+				stream.write(script)
+			os.chmod(path, 0o755)
+			os.environ[var] = path
+	if 'RELEASE_0REPO' not in os.environ:
+		repo_dir = os.path.join(tmpdir, '0repo', 'repo')
+		os.makedirs(repo_dir)
+		for name, contents in STANDIN_0REPO.items():
+			with open(os.path.join(repo_dir, name), 'w') as stream:
+				stream.write(contents)
+		os.environ['RELEASE_0REPO'] = os.path.dirname(repo_dir)
+
+def git(args, cwd, **kwargs):
+	subprocess.run(['git', '-c', 'protocol.file.allow=always'] + args, cwd = cwd, check = True, **kwargs)
+
+def fast_import(repo, files, depth, tags, rand, gitlinks = (), mutable = None):
+	"""Create a repository whose first commit contains files (a dict of path -> bytes),
+	followed by depth - 1 commits that each change one file, with tags spread over the history.
+	@param mutable: the paths which the later commits may change (default: all of files)"""
+	os.mkdir(repo)
+	git(['init', '-q', repo], cwd = os.path.dirname(repo))
+	stream = io.BytesIO()
+	def data(contents):
+		stream.write(b'data %d\n' % len(contents))
+		stream.write(contents)
+		stream.write(b'\n')
+	def commit(mark, message, changes):
+		stream.write(b'commit refs/heads/master\nmark :%d\n' % mark)
+		stream.write(b'committer Bench <bench@example.com> %d +0000\n' % (1500000000 + mark))
+		data(message)
+		if mark > 1:
+			stream.write(b'from :%d\n' % (mark - 1))
+		stream.write(changes)
+
+	changes = io.BytesIO()
+	for path, contents in sorted(files.items()):
+		changes.write(b'M 644 inline %s\n' % path.encode('utf-8'))
+		changes.write(b'data %d\n%s\n' % (len(contents), contents))
+	for path, sha in gitlinks:
+		changes.write(b'M 160000 %s %s\n' % (sha.encode('ascii'), path.encode('utf-8')))
+	commit(1, b'Initial commit', changes.getvalue())
+
+	paths = sorted(files if mutable is None else mutable)
+	for i in range(2, depth + 1):
+		path = rand.choice(paths)
+		files[path] += b'change %d\n' % i
+		commit(i, b'Change %d' % i, b'M 644 inline %s\ndata %d\n%s\n' % (path.encode('utf-8'), len(files[path]), files[path]))
+
+	for i in range(tags):
+		stream.write(b'reset refs/tags/v0.%d\nfrom :%d\n\n' % (i + 1, 1 + (i * depth) // max(tags, 1)))
+
+	git(['fast-import', '--quiet'], cwd = repo, input = stream.getvalue())
+	git(['checkout', '-q', '-f', 'master'], cwd = repo)
+
+def make_repository(tmpdir, params):
+	"""Generate the test repository described by params.
+	@return: the path of the repository's local feed"""
+	rand = random.Random(42)
+	n_files = max(params.files, 1)
+	data = make_data(params.size_mb * 1000 * 1000, rand)
+	chunk = max(len(data) // n_files, 1)
+
+	gitlinks = []
+	gitmodules = b''
+	for i in range(params.submodules):
+		sub_repo = os.path.join(tmpdir, 'sub%d' % i)
+		sub_files = {'sub/file%d.txt' % j: data[j * chunk:(j + 1) * chunk] for j in range(min(n_files, 50))}
+		fast_import(sub_repo, sub_files, 2, 0, rand)
+		sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = sub_repo, encoding = 'utf-8').strip()
+		gitlinks.append(('vendor/sub%d' % i, sha))
+		gitmodules += b'[submodule "vendor/sub%d"]\n\tpath = vendor/sub%d\n\turl = %s\n' % (i, i, sub_repo.encode('utf-8'))
+
+	files = {}
+	for i in range(n_files):
+		files['src/dir%d/file%d.txt' % (i // 100, i)] = data[i * chunk:(i + 1) * chunk]
+	# (only the data files change in later commits; appending to the feed would break it)
+	data_files = sorted(files)
+	for i in range(params.version_files):
+		files['src/version%d.py' % i] = b"# Generated\nversion = '1.0-post'\n"
+	files['bench.xml'] = (FEED_TEMPLATE % '*-*').encode('utf-8')
+	if gitmodules:
+		files['.gitmodules'] = gitmodules
+
+	repo = os.path.join(tmpdir, 'bench')
+	fast_import(repo, files, max(params.depth, 1), params.tags, rand, gitlinks, mutable = data_files)
+	if params.submodules:
+		git(['submodule', '--quiet', 'update', '--init'], cwd = repo)
+	return os.path.join(repo, 'bench.xml')
+
+class Timer:
+	def __init__(self):
+		self.results = {}
+
+	def time(self, name, fn, *args, data_size = None, **kwargs):
+		"""Time fn(*args, **kwargs). If data_size (in bytes) is given, also report MB/s."""
+		start = time.time()
+		result = fn(*args, **kwargs)
+		taken = self.results[name] = time.time() - start
+		if data_size is None:
+			print("%-28s %8.3fs" % (name, taken))
+		else:
+			print("%-28s %8.3fs %8.1f MB/s" % (name, taken, data_size / max(taken, 1e-6) / 1e6))
+		return result
+
+def run_pipeline(tmpdir, params):
+	local_feed_path = make_repository(tmpdir, params)
+	repo = os.path.dirname(local_feed_path)
+
+	import support, scm, release, feededit
+
+	options = Values({'key': None, 'compression_jobs': params.jobs, 'public_scm_repository': None})
+	git_scm = scm.GIT(repo, options)
+	timer = Timer()
+
+	workdir = os.path.join(tmpdir, 'release')
+	os.mkdir(workdir)
+	os.chdir(workdir)
+
+	archive_file = os.path.join(workdir, 'bench-1.0.tar.bz2')
+	head = git_scm.get_head_revision()
+
+	# (compression speeds are in MB/s of uncompressed tar data)
+	child = subprocess.Popen(['git', 'archive', '--format=tar', '--prefix=bench-1.0/', head], cwd = repo, stdout = subprocess.PIPE)
+	tar_size = sum(len(chunk) for chunk in iter(lambda: child.stdout.read(1024 * 1024), b''))
+	assert child.wait() == 0
+
+	def old_export():
+		# The pipeline used by 0release <= 0.17, for comparison
+		with open(archive_file, 'wb') as stream:
+			child = subprocess.Popen(['git', 'archive', '--format=tar', '--prefix=bench-1.0/', head], cwd = repo, stdout = subprocess.PIPE)
+			subprocess.check_call(['bzip2', '-'], stdin = child.stdout, stdout = stream)
+			assert child.wait() == 0
+	timer.time('git archive | bzip2 -', old_export, data_size = tar_size)
+	timer.time('GIT.export', git_scm.export, 'bench-1.0', archive_file, head, data_size = tar_size)
+	timer.time('unpack_tarball', support.unpack_tarball, archive_file, data_size = tar_size)
+	timer.time('make_readonly_recursive', support.make_readonly_recursive, 'bench-1.0')
+	timer.time('make_writable_recursive', support.make_writable_recursive, 'bench-1.0')
+	support.remove_tree('bench-1.0')
+	timer.time('unpack_tarball (read-only)', support.unpack_tarball, archive_file, readonly = True)
+	if params.submodules:
+		timer.time('GIT.export (with submodules)', git_scm.export, 'bench-1.0', archive_file, head, submodules = True)
+	timer.time('remove_tree', support.remove_tree, 'bench-1.0')
+
+	substitutions = [('src/version%d.py' % i, re.compile("^version = '([^']*)'$", re.MULTILINE)) for i in range(params.version_files)]
+	timer.time('do_version_substitutions', release.do_version_substitutions, repo, substitutions, '1.0')
+
+	timer.time('get_previous_release (cold)', lambda: scm.GIT(repo, options).get_tag_index().previous('1.0'))
+	timer.time('get_previous_release (warm)', lambda: scm.GIT(repo, options).get_tag_index().previous('1.0'))
+
+	src_feed = os.path.join(workdir, 'bench-1.0.xml')
+	shutil.copyfile(local_feed_path, src_feed)
+	timer.time('publish (set version)', support.publish, src_feed, set_released = 'today', set_version = '1.0')
+
+	def edit_feed():
+		editor = feededit.FeedEditor(src_feed)
+		editor.set_version('1.0')
+		editor.set_released('2026-01-01')
+		editor.save()
+	timer.time('FeedEditor (set version)', edit_feed)
+
+	binary_feeds = []
+	for i in range(params.binary_feeds):
+		path = os.path.join(workdir, 'binary-%d.xml' % i)
+		with open(path, 'w') as stream:
+			stream.write(FEED_TEMPLATE.replace('id="."', 'id="sha1new=%040x"' % i) % ('Linux-arch%d' % i))
+		binary_feeds.append(path)
+
+	def merge_feeds():
+		editor = feededit.FeedEditor(src_feed)
+		from repo import merge
+		editor.merge_feeds(binary_feeds, merge.merge)
+		editor.make_archives_relative()
+		editor.save('merged.xml')
+	timer.time('merge feeds', merge_feeds)
+
+	timer.results['git processes'] = scm.SCM.processes_spawned
+	return timer.results
+
+def get_0release_version():
+	with open(os.path.join(my_dir, '..', '0release'), 'r') as stream:
+		match = re.search(r"^version = '(.*)'$", stream.read(), re.MULTILINE)
+	return match.group(1) if match else None
+
+def compare(old_path, new_path):
+	with open(old_path, 'r') as stream:
+		old = json.load(stream)
+	with open(new_path, 'r') as stream:
+		new = json.load(stream)
+	if old['params'] != new['params']:
+		print("WARNING: the runs used different parameters:\n  %s\n  %s" % (old['params'], new['params']))
+	print("%-28s %10s %10s %8s" % ('Stage', old['version'], new['version'], 'Change'))
+	for name in old['results']:
+		if name in new['results']:
+			a, b = old['results'][name], new['results'][name]
+			change = '%+.0f%%' % ((b - a) * 100.0 / a) if a else ''
+			print("%-28s %10.3f %10.3f %8s" % (name, a, b, change))
+
+def main():
+	parser = OptionParser(usage = "usage: %prog [options]\n       %prog --compare OLD.json NEW.json")
+	parser.add_option("", "--files", help="number of files in the repository", type='int', default=2000)
+	parser.add_option("", "--size-mb", help="total size of the files", type='int', default=20)
+	parser.add_option("", "--submodules", help="number of submodules", type='int', default=0)
+	parser.add_option("", "--tags", help="number of release tags", type='int', default=500)
+	parser.add_option("", "--depth", help="number of commits", type='int', default=100)
+	parser.add_option("", "--version-files", help="number of files with version substitutions", type='int', default=20)
+	parser.add_option("", "--binary-feeds", help="number of binary feeds to merge", type='int', default=10)
+	parser.add_option("", "--jobs", help="compression processes", type='int')
+	parser.add_option("-o", "--output", help="save the results as JSON", metavar='FILE')
+	parser.add_option("", "--compare", help="compare two saved results", action='store_true')
+	(options, args) = parser.parse_args()
+
+	if options.compare:
+		if len(args) != 2:
+			parser.error("--compare needs two result files")
+		compare(*args)
+		return
+
+	params = {name: getattr(options, name) for name in ['files', 'size_mb', 'submodules', 'tags', 'depth', 'version_files', 'binary_feeds']}
+	print("Benchmarking with %s" % params)
+
+	oldcwd = os.getcwd()
+	tmpdir = tempfile.mkdtemp(prefix = '0release-bench-')
+	try:
+		setup_environment(tmpdir)
+		results = run_pipeline(tmpdir, options)
+	finally:
+		os.chdir(oldcwd)
+		subprocess.call(['chmod', '-R', 'u+w', tmpdir])
+		shutil.rmtree(tmpdir)
+
+	if options.output:
+		with open(options.output, 'w') as stream:
+			json.dump({'version': get_0release_version(), 'params': params, 'results': results}, stream, indent = 1)
+		print("Results saved to %s" % options.output)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, io, bz2, tarfile, tempfile, subprocess
+import unittest
+from optparse import Values
+
+sys.path.insert(0, '..')
+import archive, support, scm
+
+class TestArchive(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-test-')
+		self.tar_file = os.path.join(self.tmp, 'hello-1.0.tar')
+		with tarfile.open(self.tar_file, 'w') as tar:
+			for i in range(3):
+				data = os.urandom(1000000)
+				member = tarfile.TarInfo('hello-1.0/file%d' % i)
+				member.size = len(data)
+				tar.addfile(member, io.BytesIO(data))
+
+	def tearDown(self):
+		support.remove_tree(self.tmp)
+
+	def testMissingCommand(self):
+		missing = archive.Format('tar.missing', 1, None, None, None, command = 'no-such-0release-compressor')
+		self.assertFalse(missing.is_available())
+		self.assertTrue(archive.get_format('tar.bz2').is_available())
+
+	def testBenchmarkFormats(self):
+		formats = [f for f in archive.formats if f.command is None]
+		results = archive.benchmark_formats(self.tar_file, 2, formats)
+		self.assertEqual(formats, [archive_format for archive_format, size, compress_time, decompress_time in results])
+
+	def testBlocks(self):
+		# Several independently compressed blocks must read back as one stream
+		for archive_format in archive.formats:
+			if not archive_format.is_available(): continue
+			archive_file = os.path.join(self.tmp, 'hello-1.0.' + archive_format.extension)
+			with open(self.tar_file, 'rb') as source:
+				archive.compress_stream(source, archive_file, 2)
+			target = os.path.join(self.tmp, archive_format.extension)
+			archive.extract_tarball(archive_file, target)
+			self.assertEqual(['file0', 'file1', 'file2'], sorted(os.listdir(os.path.join(target, 'hello-1.0'))))
+
+	def testSameBytes(self):
+		# An archive regenerated from an exported tree is identical to the export
+		repo = os.path.join(self.tmp, 'repo')
+		for path, contents in [('a/x', '1'), ('a-b/c/y', '2'), ('a.b/q', '3'), ('a0', '4')]:
+			os.makedirs(os.path.dirname(os.path.join(repo, path)), exist_ok = True)
+			with open(os.path.join(repo, path), 'w') as stream:
+				stream.write(contents)
+		os.symlink('a/x', os.path.join(repo, 'link'))
+		git = ['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com']
+		subprocess.check_call(git + ['init', '-q'], cwd = repo)
+		subprocess.check_call(git + ['add', '-A'], cwd = repo)
+		subprocess.check_call(git + ['commit', '-q', '-m', 'Initial'], cwd = repo)
+
+		git_scm = scm.GIT(repo, Values({'compression_jobs': 2}))
+		try:
+			exported = os.path.join(self.tmp, 'exported.tar.bz2')
+			digest = git_scm.export('hello-1.0', exported, git_scm.get_head_revision(), extract = 'hello-1.0', mtime = 1234567890)
+		finally:
+			git_scm.close()
+
+		extracted = os.path.join(self.tmp, 'extracted')
+		archive.extract_tarball(exported, extracted)
+		regenerated = os.path.join(self.tmp, 'regenerated.tar.bz2')
+		oldcwd = os.getcwd()
+		os.chdir(extracted)
+		try:
+			self.assertEqual(digest, archive.create_tarball(regenerated, 'hello-1.0', 2, mtime = 1234567890))
+		finally:
+			os.chdir(oldcwd)
+
+		with open(exported, 'rb') as a, open(regenerated, 'rb') as b:
+			self.assertEqual(bz2.decompress(a.read()), bz2.decompress(b.read()))
+
+if __name__ == '__main__':
+	unittest.main()
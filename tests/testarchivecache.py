@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, json, tempfile, time
+import unittest
+
+sys.path.insert(0, '..')
+import archivecache, support
+
+class TestArchiveCache(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-test-')
+		self.cache = archivecache.ArchiveCache(os.path.join(self.tmp, 'cache'))
+		self.archive_file = os.path.join(self.tmp, 'hello-1.0.tar.bz2')
+		with open(self.archive_file, 'wb') as stream:
+			stream.write(b'archive data')
+		self.key = archivecache.get_key('4b825dc', 'hello-1.0', 'hello-1.0', [], 'tar.bz2', None, 0)
+
+	def tearDown(self):
+		support.remove_tree(self.tmp)
+
+	def fetch(self):
+		target = os.path.join(self.tmp, 'out', 'hello-1.0.tar.bz2')
+		os.makedirs(os.path.dirname(target), exist_ok = True)
+		return self.cache.fetch(self.key, target), target
+
+	def testHit(self):
+		self.assertEqual(None, self.fetch()[0])
+		self.cache.store(self.key, self.archive_file, 'sha256new_ABC')
+		digest, target = self.fetch()
+		self.assertEqual('sha256new_ABC', digest)
+		with open(target, 'rb') as stream:
+			self.assertEqual(b'archive data', stream.read())
+
+	def testOldEntry(self):
+		self.cache.store(self.key, self.archive_file, 'sha256new_ABC')
+		info_file = os.path.join(self.cache.cache_dir, self.key, 'info.json')
+		for details in [{}, [], 'not json']:
+			with open(info_file, 'w') as stream:
+				if details == 'not json':
+					stream.write(details)
+				else:
+					json.dump(details, stream)
+			digest, target = self.fetch()
+			self.assertEqual(None, digest)
+			self.assertFalse(os.path.exists(target))
+
+	def testMissingArchive(self):
+		self.cache.store(self.key, self.archive_file, 'sha256new_ABC')
+		os.unlink(os.path.join(self.cache.cache_dir, self.key, 'hello-1.0.tar.bz2'))
+		self.assertEqual(None, self.fetch()[0])
+
+	def testEvict(self):
+		for i in range(archivecache.MAX_ENTRIES + 2):
+			self.cache.store('key%d' % i, self.archive_file, 'digest%d' % i)
+			info_file = os.path.join(self.cache.cache_dir, 'key%d' % i, 'info.json')
+			os.utime(info_file, (time.time() - 100 + i, time.time() - 100 + i))
+		self.cache.evict()
+		self.assertEqual(['key%d' % i for i in range(2, archivecache.MAX_ENTRIES + 2)],
+				 sorted(os.listdir(self.cache.cache_dir), key = lambda name: int(name[3:])))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, io, tarfile, tempfile
+import unittest
+
+sys.path.insert(0, '..')
+import archivediff, support
+
+def make_archive(path, top, files):
+	"""Write a tar.bz2 containing top/<name> for each (name, contents or link target, mode) in files.
+	Names ending in '/' are directories; modes of None are symlinks."""
+	with tarfile.open(path, 'w:bz2') as tar:
+		for name, contents, mode in files:
+			member = tarfile.TarInfo(top + '/' + name.rstrip('/'))
+			if name.endswith('/'):
+				member.type = tarfile.DIRTYPE
+				member.mode = mode
+				tar.addfile(member)
+			elif mode is None:
+				member.type = tarfile.SYMTYPE
+				member.linkname = contents
+				tar.addfile(member)
+			else:
+				member.size = len(contents)
+				member.mode = mode
+				tar.addfile(member, io.BytesIO(contents))
+
+class TestArchiveDiff(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-test-')
+		self.old = os.path.join(self.tmp, 'hello-1.0.tar.bz2')
+		self.new = os.path.join(self.tmp, 'hello-1.1.tar.bz2')
+		make_archive(self.old, 'hello-1.0', [
+			('src/', None, 0o755),
+			('src/hello.py', b'print("hello")\n', 0o644),
+			('run', b'#!/bin/sh\n', 0o644),
+			('logo.png', b'\x89PNG\0old', 0o644),
+			('README', b'Old readme\n', 0o644),
+			('link', 'README', None),
+		])
+		make_archive(self.new, 'hello-1.1', [
+			('src/', None, 0o755),
+			('src/hello.py', b'print("hello")\nprint("world")\n', 0o644),
+			('run', b'#!/bin/sh\n', 0o755),
+			('logo.png', b'\x89PNG\0new', 0o644),
+			('NEWS', b'New\n', 0o644),
+			('link', 'NEWS', None),
+		])
+
+	def tearDown(self):
+		support.remove_tree(self.tmp)
+
+	def testDiff(self):
+		diff = archivediff.ArchiveDiff(self.old, self.new)
+		self.assertEqual(['NEWS'], diff.added)
+		self.assertEqual(['README'], diff.removed)
+		self.assertEqual(['link', 'logo.png', 'src/hello.py'], diff.changed)
+		self.assertEqual(['run'], diff.mode_changed)
+
+		summary = io.StringIO()
+		diff.write_summary(summary)
+		summary = summary.getvalue()
+		assert '  A NEWS (4 bytes)\n' in summary, summary
+		assert '  D README\n' in summary, summary
+		assert '  M src/hello.py (+15 bytes)\n' in summary, summary
+		assert '  P run (644 -> 755)\n' in summary, summary
+		assert '1 added, 1 removed, 3 changed, 1 permission changes' in summary, summary
+
+		diffs = io.StringIO()
+		diff.write_unified_diffs(diffs)
+		diffs = diffs.getvalue()
+		assert 'Binary file logo.png differs\n' in diffs, diffs
+		assert '--- a/src/hello.py\n+++ b/src/hello.py\n' in diffs, diffs
+		assert '+print("world")\n' in diffs, diffs
+		assert 'README' not in diffs, diffs
+
+	def testSame(self):
+		diff = archivediff.ArchiveDiff(self.old, self.old)
+		self.assertEqual(([], [], [], []), (diff.added, diff.removed, diff.changed, diff.mode_changed))
+
+		diffs = io.StringIO()
+		diff.write_unified_diffs(diffs)
+		self.assertEqual('', diffs.getvalue())
+
+if __name__ == '__main__':
+	unittest.main()
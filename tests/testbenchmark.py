@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, subprocess
+import unittest
+
+mydir = os.path.realpath(os.path.dirname(__file__))
+
+class TestBenchmark(unittest.TestCase):
+	def run_benchmark(self, *args):
+		child = subprocess.Popen([sys.executable, os.path.join(mydir, 'benchmark.py')] + list(args),
+				stdout = subprocess.PIPE, stderr = subprocess.STDOUT, universal_newlines = True)
+		output, unused = child.communicate()
+		assert child.returncode == 0, output
+		return output
+
+	def testSmall(self):
+		# With few files, the history commits used to append to bench.xml or .gitmodules
+		output = self.run_benchmark('--files', '200', '--size-mb', '2', '--submodules', '2', '--tags', '50', '--binary-feeds', '2')
+		assert 'merge feeds' in output, output
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, json, tempfile, time
+import unittest
+
+sys.path.insert(0, '..')
+import buildcache, support
+
+class TestBuildCache(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-test-')
+		self.cache = buildcache.BuildCache(os.path.join(self.tmp, 'cache'), max_size = 1000, max_age = 3600)
+		self.build_dir = os.path.join(self.tmp, 'build')
+		os.mkdir(self.build_dir)
+		self.archive_file = self.write('build', 'hello-linux-x86_64-1.0.tar.bz2', b'binary archive')
+		self.binary_feed = self.write('build', 'hello-linux-x86_64-1.0.xml', b'<interface/>')
+		self.key = buildcache.get_key('sha256new_ABC', 'host', ['', 'make', ''])
+
+	def tearDown(self):
+		support.remove_tree(self.tmp)
+
+	def write(self, dir_name, name, contents):
+		path = os.path.join(self.tmp, dir_name, name)
+		with open(path, 'wb') as stream:
+			stream.write(contents)
+		return path
+
+	def fetch(self, key):
+		out = os.path.join(self.tmp, 'out')
+		if not os.path.isdir(out):
+			os.mkdir(out)
+		return self.cache.fetch(key, os.path.join(out, 'binary.xml'))
+
+	def testHit(self):
+		self.assertFalse(self.fetch(self.key))
+		self.cache.store(self.key, self.binary_feed, self.archive_file, target = 'host')
+		self.assertTrue(self.fetch(self.key))
+		with open(os.path.join(self.tmp, 'out', 'binary.xml'), 'rb') as stream:
+			self.assertEqual(b'<interface/>', stream.read())
+		with open(os.path.join(self.tmp, 'out', 'hello-linux-x86_64-1.0.tar.bz2'), 'rb') as stream:
+			self.assertEqual(b'binary archive', stream.read())
+		self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+		# A different source or build command is a different build
+		self.assertFalse(self.fetch(buildcache.get_key('sha256new_DEF', 'host', ['', 'make', ''])))
+		self.assertFalse(self.fetch(buildcache.get_key('sha256new_ABC', 'host', ['', 'make -j4', ''])))
+		assert '1 hit(s), 3 miss(es); 1 entries' in self.cache.format_stats(), self.cache.format_stats()
+
+	def testBadEntry(self):
+		self.cache.store(self.key, self.binary_feed, self.archive_file)
+		info_file = os.path.join(self.cache.cache_dir, self.key, 'info.json')
+		for details in [{}, [], 'not json']:
+			with open(info_file, 'w') as stream:
+				if details == 'not json':
+					stream.write(details)
+				else:
+					json.dump(details, stream)
+			self.assertFalse(self.fetch(self.key))
+
+		self.cache.store(self.key, self.binary_feed, self.archive_file)
+		os.unlink(os.path.join(self.cache.cache_dir, self.key, 'binary.xml'))
+		self.assertFalse(self.fetch(self.key))
+
+	def testEvict(self):
+		now = time.time()
+		for i, age in enumerate([7200, 300, 200, 100]):
+			self.cache.store('key%d' % i, self.binary_feed, self.archive_file)
+			info_file = os.path.join(self.cache.cache_dir, 'key%d' % i, 'info.json')
+			os.utime(info_file, (now - age, now - age))
+		# (an incomplete entry, left by a crash)
+		os.mkdir(os.path.join(self.cache.cache_dir, 'tmp-crashed'))
+		os.utime(os.path.join(self.cache.cache_dir, 'tmp-crashed'), (now - 7200, now - 7200))
+
+		# key0 and tmp-crashed are too old; each entry is 26 bytes, so only key2 and key3 fit in 60 bytes
+		self.cache.max_size = 60
+		self.assertEqual(3, self.cache.evict())
+		self.assertEqual(['key2', 'key3'], sorted(os.listdir(self.cache.cache_dir)))
+
+		# Using an entry makes it the most recent
+		self.assertTrue(self.fetch('key2'))
+		self.cache.max_size = 30
+		self.assertEqual(1, self.cache.evict())
+		self.assertEqual(['key2'], os.listdir(self.cache.cache_dir))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, io, contextlib, tempfile, threading, time
+import unittest
+
+sys.path.insert(0, '..')
+import compile, support
+from zeroinstall import SafeException
+
+class Source:
+	def __init__(self, url):
+		self.url = url
+
+class SourceImpl:
+	id = 'sha256new_ABC'
+	download_sources = [Source('http://example.com/releases/hello-1.0.tar.bz2')]
+
+class TestCompiler(compile.Compiler):
+	"""A Compiler whose builders just log a message, taking a little while.
+	Builders named in fail raise an exception instead."""
+	def __init__(self, targets, max_concurrent_builds, fail = ()):
+		self.targets = targets
+		self.max_concurrent_builds = max_concurrent_builds
+		self.build_cache = None
+		self.src_impl = SourceImpl()
+		self.fail = fail
+		self.lock = threading.Lock()
+		self.running = 0
+		self.max_running = 0
+
+	def build_target(self, target, archive_file, log = None):
+		with self.lock:
+			self.running += 1
+			self.max_running = max(self.max_running, self.running)
+		try:
+			print("Building %s from %s" % (target, archive_file), file = log or sys.stdout)
+			time.sleep(0.2)
+			if target in self.fail:
+				raise SafeException("compiler error")
+			with open('binary-%s.xml' % target, 'w'):
+				pass
+		finally:
+			with self.lock:
+				self.running -= 1
+
+class TestCompile(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-test-')
+		self.old_dir = os.getcwd()
+		os.chdir(self.tmp)
+
+	def tearDown(self):
+		os.chdir(self.old_dir)
+		support.remove_tree(self.tmp)
+
+	def build(self, compiler):
+		output = io.StringIO()
+		try:
+			with contextlib.redirect_stdout(output):
+				compiler.build_binaries()
+		finally:
+			self.output = output.getvalue()
+
+	def read(self, path):
+		with open(path) as stream:
+			return stream.read()
+
+	def testConcurrent(self):
+		compiler = TestCompiler(['linux', 'windows', 'macos'], 0)
+		self.build(compiler)
+		self.assertEqual(3, compiler.max_running)
+		assert 'Building 3 binaries, up to 3 at a time' in self.output, self.output
+		for target in compiler.targets:
+			self.assertEqual('Building %s from hello-1.0.tar.bz2\n' % target, self.read('build-%s.log' % target))
+			assert "Builder '%s' finished" % target in self.output, self.output
+		assert 'Building linux from' not in self.output, self.output
+
+		# Existing binaries aren't built again
+		os.unlink('binary-windows.xml')
+		compiler = TestCompiler(['linux', 'windows', 'macos'], 0)
+		self.build(compiler)
+		assert 'Feed binary-linux.xml already exists; not rebuilding' in self.output, self.output
+		assert 'Building windows from hello-1.0.tar.bz2\n' in self.output, self.output
+		assert 'Building linux from' not in self.output, self.output
+		self.assertEqual(1, compiler.max_running)
+
+	def testLimit(self):
+		compiler = TestCompiler(['a', 'b', 'c', 'd'], 2)
+		self.build(compiler)
+		self.assertEqual(2, compiler.max_running)
+
+		# With one at a time, the output isn't logged
+		for name in os.listdir('.'):
+			os.unlink(name)
+		compiler = TestCompiler(['a', 'b'], 1)
+		self.build(compiler)
+		self.assertEqual(1, compiler.max_running)
+		assert 'Building a from hello-1.0.tar.bz2\n' in self.output, self.output
+		self.assertEqual([], [name for name in os.listdir('.') if name.endswith('.log')])
+
+	def testFailure(self):
+		compiler = TestCompiler(['linux', 'windows', 'macos'], 0, fail = ['windows'])
+		try:
+			self.build(compiler)
+			assert 0
+		except SafeException as ex:
+			self.assertEqual('Build failed for builder(s): windows', str(ex))
+		assert "Builder 'windows' FAILED: compiler error (see build-windows.log)" in self.output, self.output
+		# (the other builds still finish)
+		self.assertEqual(['binary-linux.xml', 'binary-macos.xml'], sorted(name for name in os.listdir('.') if name.endswith('.xml')))
+
+if __name__ == '__main__':
+	unittest.main()
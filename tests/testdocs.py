@@ -7,12 +7,12 @@ import doctest
 
 sys.path.insert(0, '..')
 
-import support
+import support, archive, tagindex, tardigest, buildcache, testrunner, archivecache, versionsubst, scm, pipeline
 
 main_dir = os.path.join(os.path.dirname(__file__), '..')
 
 suite = unittest.TestSuite()
-for x in [support]:
+for x in [support, archive, tagindex, tardigest, buildcache, testrunner, archivecache, versionsubst, scm, pipeline]:
 	suite.addTest(doctest.DocTestSuite(x))
 
 if __name__ == '__main__':
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, tempfile
+import unittest
+
+sys.path.insert(0, '..')
+import feededit, support
+
+FEED = """<?xml version="1.0" ?>
+<?xml-stylesheet type='text/xsl' href='interface.xsl'?>
+<interface xmlns="http://zero-install.sourceforge.net/2004/injector/interface">
+  <name>HelloWorld</name>
+  <!-- A comment -->
+  <feed-for interface="http://0install.net/tests/HelloWorld.xml"/>
+
+  <group main="hello.py">
+    <implementation id="." version="0.1-pre" local-path="."/>
+  </group>
+</interface>
+"""
+
+# (written with minidom, as 0publish does, keeping the stylesheet on its own line)
+RELEASED = """<?xml version="1.0" ?>
+<?xml-stylesheet type='text/xsl' href='interface.xsl'?>
+<interface xmlns="http://zero-install.sourceforge.net/2004/injector/interface">
+  <name>HelloWorld</name>
+  <!-- A comment -->
+  <feed-for interface="http://0install.net/tests/HelloWorld.xml"/>
+
+  <group main="hello.py">
+    <implementation id="sha256new_ABC" version="0.1" released="2026-01-02" main="bin/hello">\
+<manifest-digest sha256new="ABC"/><archive href="http://example.com/hello-0.1.tar.bz2" size="1234" extract="hello-0.1"/>\
+</implementation>
+  </group>
+</interface>
+"""
+
+class TestFeedEdit(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-test-')
+		self.feed = os.path.join(self.tmp, 'HelloWorld.xml')
+		self.write(self.feed, FEED)
+
+	def tearDown(self):
+		support.remove_tree(self.tmp)
+
+	def write(self, path, contents):
+		with open(path, 'w') as stream:
+			stream.write(contents)
+
+	def read(self, path):
+		with open(path) as stream:
+			return stream.read()
+
+	def testEdit(self):
+		editor = feededit.FeedEditor(self.feed)
+		editor.set_version('0.1')
+		editor.set_released('2026-01-02')
+		editor.set_main('bin/hello')
+		editor.add_archive('http://example.com/hello-0.1.tar.bz2', 1234, 'hello-0.1', 'sha256new_ABC')
+		released = os.path.join(self.tmp, 'released.xml')
+		editor.save(released)
+		self.assertEqual(RELEASED, self.read(released))
+		self.assertEqual(FEED, self.read(self.feed))
+
+		editor = feededit.FeedEditor(released)
+		editor.set_released('')
+		editor.make_archives_relative()
+		editor.save()
+		result = self.read(released)
+		assert 'released=' not in result, result
+		assert '<archive href="hello-0.1.tar.bz2"' in result, result
+		self.assertEqual([], [name for name in os.listdir(self.tmp) if name.endswith('.new')])
+
+	def testSigned(self):
+		self.assertFalse(feededit.is_signed(self.feed))
+		signed = os.path.join(self.tmp, 'signed.xml')
+		self.write(signed, FEED + "<!-- Base64 Signature\nABCD\n-->\n")
+		self.assertTrue(feededit.is_signed(signed))
+
+	def testMerge(self):
+		paths = []
+		for i in range(10):
+			path = os.path.join(self.tmp, 'binary-%d.xml' % i)
+			self.write(path, FEED.replace('version="0.1-pre"', 'version="0.1" arch="Linux-%d"' % i))
+			paths.append(path)
+		merged = []
+		def merge(master, doc):
+			self.assertIs(editor.doc, master)
+			impl, = doc.getElementsByTagName('implementation')
+			merged.append(impl.getAttribute('arch'))
+		editor = feededit.FeedEditor(self.feed)
+		editor.merge_feeds(paths, merge)
+		# (in order, although they are parsed in parallel)
+		self.assertEqual(['Linux-%d' % i for i in range(10)], merged)
+
+	def testMultipleImplementations(self):
+		self.write(self.feed, FEED.replace('</group>', '<implementation id="other" version="0.2"/></group>'))
+		editor = feededit.FeedEditor(self.feed)
+		try:
+			editor.set_version('0.1')
+			assert 0
+		except feededit.SafeException as ex:
+			assert 'contains 2 implementations' in str(ex), ex
+
+if __name__ == '__main__':
+	unittest.main()
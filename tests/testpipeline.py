@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys
+import unittest
+
+from zeroinstall import SafeException
+
+sys.path.insert(0, '..')
+import pipeline
+
+class FakeStatus:
+	def __init__(self):
+		self.completed_stages = None
+		self.saves = 0
+
+	def save(self):
+		self.saves += 1
+
+class TestPipeline(unittest.TestCase):
+	def make_pipeline(self, status, ran, fail_build = False):
+		def build():
+			ran.append('build binaries')
+			if fail_build:
+				raise SafeException("build failed")
+		p = pipeline.Pipeline(status)
+		p.add('load feed', lambda: ran.append('load feed'))
+		p.add('unit tests', lambda unused: ran.append('unit tests'), inputs = ['load feed'], resumable = True)
+		p.add('build binaries', build, after = ['unit tests'])
+		return p
+
+	def testResume(self):
+		status = FakeStatus()
+		ran = []
+		self.assertRaises(SafeException, self.make_pipeline(status, ran, fail_build = True).run)
+		self.assertEqual(['load feed', 'unit tests', 'build binaries'], ran)
+		self.assertEqual('unit tests', status.completed_stages)
+
+		# The tests have passed, so only the other stages run again
+		ran = []
+		self.make_pipeline(status, ran).run()
+		self.assertEqual(['load feed', 'build binaries'], ran)
+
+	def testSeparatorInName(self):
+		p = pipeline.Pipeline()
+		self.assertRaises(SafeException, p.add, 'tests' + pipeline.COMPLETED_SEPARATOR + 'docs', lambda: None)
+
+	def testOnError(self):
+		for ex, called in [(SafeException("tests failed"), True),
+				   (KeyError('oops'), False),
+				   (KeyboardInterrupt(), False)]:
+			errors = []
+			def fail():
+				raise ex
+			p = pipeline.Pipeline()
+			p.add('tests', fail, on_error = lambda: errors.append('tests'))
+			self.assertRaises(type(ex), p.run)
+			self.assertEqual(called, bool(errors))
+
+	def testDependencies(self):
+		p = pipeline.Pipeline()
+		self.assertRaises(SafeException, p.add, 'b', lambda a: a, inputs = ['a'])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -107,6 +107,7 @@ class TestRelease(unittest.TestCase):
 		if 'ZEROINSTALL_PORTABLE_BASE' in os.environ:
 			del os.environ['ZEROINSTALL_PORTABLE_BASE']
 		os.environ['XDG_CONFIG_HOME'] = config_dir
+		os.environ['XDG_CACHE_HOME'] = os.path.join(self.tmp, 'cache')
 		imp.reload(basedir)
 		assert basedir.xdg_config_home == config_dir
 
@@ -195,6 +196,48 @@ class TestRelease(unittest.TestCase):
 
 		self.assertEqual("Hello from C! (version 1.1)\n", output)
 
+	def testResumeAfterTests(self):
+		support.check_call(['tar', 'xzf', test_repo_c])
+		make_releases_dir(src_feed = '../c-prog/c-prog.xml')
+
+		# The build fails after the tests have passed...
+		call_with_output_suppressed(['./make-release', '-k', 'Testing', '--builders=missing'], '\n',
+					expect_failure = True, stderr = subprocess.PIPE)
+		assert os.path.exists('release-status')
+		assert 'unit tests' in file_contents('release-status')
+
+		# ... so resuming doesn't run them again
+		stdout, unused = call_with_output_suppressed(['./make-release', '-k', 'Testing', '--builders=host'], 'P\n\n')
+		assert "Stage 'unit tests' already done - skipping" in stdout, stdout
+		assert "Running self-tests" not in stdout, stdout
+
+		feed = self.get_public_feed('HelloWorld-in-C.xml', 'c-prog.xml')
+		assert len(feed.implementations) == 2
+
+	def testBatch(self):
+		support.check_call(['tar', 'xzf', test_repo])
+		# A second project in the same repository
+		with open('hello/HelloWorld.xml') as stream:
+			feed = stream.read()
+		with open('hello/HelloAgain.xml', 'w') as stream:
+			stream.write(feed.replace('HelloWorld', 'HelloAgain'))
+		support.check_call(['git', 'add', 'HelloAgain.xml'], cwd = 'hello')
+		support.check_call(['git', 'commit', '-m', 'Added HelloAgain'], cwd = 'hello', stdout = subprocess.PIPE)
+
+		os.chdir('releases')
+		call_with_output_suppressed(['0release', '--release', '-k', 'Testing',
+					     '../hello/HelloWorld.xml', '../hello/HelloAgain.xml'], '\nP\n\nP\n\n')
+
+		# Each project has its own release tags, so both can release 0.1
+		tags = subprocess.check_output(['git', 'tag', '-l'], cwd = '../hello', encoding = 'utf-8').split()
+		self.assertEqual(['HelloAgain-v0.1', 'HelloWorld-v0.1'], sorted(tags))
+		assert os.path.isfile('HelloWorld/0.1/changelog-0.1')
+		assert os.path.isfile('HelloAgain/0.1/changelog-0.1')
+
+		for uri_basename in ['HelloWorld.xml', 'HelloAgain.xml']:
+			feed = self.get_public_feed(uri_basename, uri_basename)
+			self.assertEqual(['0.1'], [impl.get_version() for impl in feed.implementations.values()])
+
 	def get_public_feed(self, name, uri_basename):
 		with open(os.path.join(self.tmp, 'my-repo', 'public', uri_basename), 'rb') as stream:
 			return model.ZeroInstallFeed(qdom.parse(stream))
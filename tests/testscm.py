@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, io, contextlib, subprocess, tempfile
+import unittest
+
+sys.path.insert(0, '..')
+import scm, support
+from zeroinstall import SafeException
+
+class Options:
+	key = None
+	public_scm_repository = None
+
+def git(repo, *args):
+	return subprocess.check_output(['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com'] + list(args),
+			cwd = repo, encoding = 'utf-8')
+
+def commit(repo, message, files):
+	for name, contents in files.items():
+		path = os.path.join(repo, name)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, 'w') as stream:
+			stream.write(contents)
+		git(repo, 'add', name)
+	git(repo, 'commit', '-q', '-m', message)
+
+class TestSCM(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-test-')
+		self.repo = os.path.join(self.tmp, 'repo')
+		os.mkdir(self.repo)
+		git(self.repo, 'init', '-q')
+
+	def tearDown(self):
+		support.remove_tree(self.tmp)
+
+	def testTagPrefix(self):
+		commit(self.repo, 'First', {'a': 'a\n'})
+		git(self.repo, 'tag', 'v0.1')
+		git(self.repo, 'tag', 'hello-v0.2')
+		commit(self.repo, 'Second', {'a': 'b\n'})
+		git(self.repo, 'tag', 'other-v0.3')
+
+		repo = scm.GIT(self.repo, Options())
+		self.assertEqual(['0.1'], repo.get_tagged_versions())
+		repo.close()
+
+		hello = scm.GIT(self.repo, Options())
+		hello.tag_prefix = 'hello-v'
+		self.assertEqual('hello-v0.3', hello.make_tag('0.3'))
+		self.assertEqual(['0.2'], hello.get_tagged_versions())
+		self.assertEqual('0.2', hello.get_tag_index().previous('0.3'))
+		hello.ensure_no_tag('0.1')
+		try:
+			hello.ensure_no_tag('0.2')
+			assert 0
+		except SafeException as ex:
+			assert 'git tag -d hello-v0.2' in str(ex), ex
+
+		with tempfile.TemporaryFile('w+') as stream:
+			hello.export_changelog('0.2', 'HEAD', stream)
+			stream.seek(0)
+			changelog = stream.read()
+		assert 'Second' in changelog, changelog
+		assert 'First' not in changelog, changelog
+		hello.close()
+
+	def grep_changed(self, repo, since):
+		output = io.StringIO()
+		with contextlib.redirect_stdout(output):
+			found = repo.grep_changed('TODO', since)
+		return found, output.getvalue()
+
+	def testGrepChanged(self):
+		commit(self.repo, 'First', {'a.py': 'one\n# TODO: old\nthree\n', 'b.py': '# TODO: also old\n'})
+		git(self.repo, 'tag', 'v0.1')
+		commit(self.repo, 'Second', {'a.py': 'one\n# TODO: old\nthree\n# TODO: new\n', 'sub dir/c.py': 'x\n# TODO: new file\n'})
+
+		repo = scm.GIT(self.repo, Options())
+		found, output = self.grep_changed(repo, '0.1')
+		self.assertEqual(2, found)
+		self.assertEqual('a.py:4:# TODO: new\nsub dir/c.py:2:# TODO: new file\n', output)
+
+		# The second search uses the cache
+		self.assertTrue(os.path.exists(os.path.join(self.repo, '.git', '0release-grep.json')))
+		self.assertEqual((found, output), self.grep_changed(repo, '0.1'))
+
+		# A changed blob is searched again
+		commit(self.repo, 'Third', {'b.py': '# TODO: also old\n# TODO: newer\n'})
+		found, output = self.grep_changed(repo, '0.1')
+		self.assertEqual(3, found)
+		assert 'b.py:2:# TODO: newer\n' in output, output
+		repo.close()
+
+	def check_health(self, tracked = ()):
+		repo = scm.GIT(self.repo, Options())
+		try:
+			return repo.check_health(tracked)
+		finally:
+			repo.close()
+
+	def testCheckHealth(self):
+		lib = os.path.join(self.tmp, 'lib')
+		os.mkdir(lib)
+		git(lib, 'init', '-q')
+		commit(lib, 'Library', {'lib.py': 'one\n'})
+		commit(self.repo, 'First', {'main.py': 'main\n'})
+		git(self.repo, '-c', 'protocol.file.allow=always', 'submodule', '-q', 'add', lib, 'lib')
+		git(self.repo, 'commit', '-q', '-m', 'Added lib')
+		submodule = os.path.join(self.repo, 'lib')
+
+		report = self.check_health([os.path.join(self.repo, 'main.py')])
+		self.assertEqual(['', 'lib'], [repo.rel_path for repo in report.repos])
+		self.assertEqual([], report.get_problems())
+		report.check()
+
+		# Problems in any repository are all reported together
+		with open(os.path.join(submodule, 'lib.py'), 'w') as stream:
+			stream.write('changed\n')
+		with open(os.path.join(self.repo, 'untracked.py'), 'w') as stream:
+			stream.write('new\n')
+		report = self.check_health([os.path.join(self.repo, 'untracked.py')])
+		problems = report.get_problems()
+		# (the superproject sees the submodule's change too)
+		self.assertEqual(['', '', 'lib'], sorted(rel_path for rel_path, problem in problems))
+		assert any('not under version control' in problem for rel_path, problem in problems), problems
+		assert any('M lib.py' in problem for rel_path, problem in problems), problems
+		try:
+			report.check()
+			assert 0
+		except SafeException as ex:
+			assert 'Submodule lib: Uncommitted changes' in str(ex), ex
+
+		# A submodule on a different commit to the one recorded
+		git(submodule, 'checkout', '-q', 'lib.py')
+		commit(submodule, 'Unrecorded', {'lib.py': 'two\n'})
+		report = self.check_health()
+		problems = dict(report.get_problems())
+		self.assertEqual(['', 'lib'], sorted(problems))
+		assert 'M lib' in problems[''], problems
+		assert 'the parent repository records' in problems['lib'], problems
+
+		# Detached HEAD
+		git(submodule, 'checkout', '-q', 'HEAD~')
+		git(self.repo, 'checkout', '-q', '--detach')
+		report = self.check_health()
+		self.assertEqual([('', "not on a branch (detached HEAD)")], report.get_problems())
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, io, tarfile, tempfile, shutil
+import unittest
+
+sys.path.insert(0, '..')
+import snapshot, support
+
+def make_archive(path, files):
+	"""Write a tar.gz containing hello-1.0/<name> for each (name, contents, mode) in files."""
+	with tarfile.open(path, 'w:gz') as tar:
+		for name, contents, mode in files:
+			member = tarfile.TarInfo('hello-1.0/' + name)
+			member.size = len(contents)
+			member.mode = mode
+			member.mtime = 1000000000
+			tar.addfile(member, io.BytesIO(contents))
+
+class TestSnapshot(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-test-')
+		self.archive_file = os.path.join(self.tmp, 'hello-1.0.tar.gz')
+		make_archive(self.archive_file, [('hello', b'#!/bin/sh\necho hello\n', 0o755),
+						 ('doc/README', b'Say hello\n', 0o644)])
+		self.cache = os.path.join(self.tmp, 'pristine')
+		self.pristine_hello = os.path.join(self.cache, 'hello-1.0.tar.gz', 'hello-1.0', 'hello')
+
+	def tearDown(self):
+		support.remove_tree(self.tmp)
+
+	def ensure(self):
+		s = snapshot.Snapshot(self.archive_file, self.cache, 'hello-1.0')
+		s.ensure()
+		return s
+
+	def testReuse(self):
+		self.ensure()
+		# (a marker which re-extracting would remove)
+		marker = os.path.join(self.cache, 'hello-1.0.tar.gz', 'marker')
+		with open(marker, 'w'):
+			pass
+		self.ensure()
+		self.assertTrue(os.path.exists(marker))
+
+	def testPristineEdited(self):
+		self.ensure()
+		os.chmod(self.pristine_hello, 0o755)
+		with open(self.pristine_hello, 'r+b') as stream:
+			stream.write(b'#!/bin/sh\necho HELLO\n')
+		os.chmod(self.pristine_hello, 0o555)
+		self.ensure()
+		with open(self.pristine_hello, 'rb') as stream:
+			self.assertEqual(b'#!/bin/sh\necho hello\n', stream.read())
+
+	def testPristineChmod(self):
+		# (as through a hard-linked checkout)
+		self.ensure()
+		os.chmod(self.pristine_hello, 0o444)
+		self.ensure()
+		self.assertEqual(0o555, os.stat(self.pristine_hello).st_mode & 0o777)
+
+	def testRestore(self):
+		s = snapshot.Snapshot(self.archive_file, self.cache, 'hello-1.0')
+		target = os.path.join(self.tmp, 'hello-1.0')
+		s.checkout(target, readonly = True)
+		hello = os.path.join(target, 'hello')
+		self.assertEqual(0o555, os.stat(hello).st_mode & 0o777)
+		self.assertEqual(0o444, os.stat(os.path.join(target, 'doc', 'README')).st_mode & 0o777)
+		self.assertTrue(s.is_unmodified(target, readonly = True))
+		self.assertFalse(s.is_unmodified(target, readonly = False))
+
+		os.chmod(hello, 0o444)
+		self.assertFalse(s.is_unmodified(target, readonly = True))
+		s.restore(target, readonly = True)
+		self.assertTrue(s.is_unmodified(target, readonly = True))
+
+		os.chmod(target, 0o755)
+		with open(os.path.join(target, 'new-file'), 'w'):
+			pass
+		self.assertFalse(s.is_unmodified(target, readonly = True))
+		s.restore(target, readonly = True)
+		self.assertFalse(os.path.exists(os.path.join(target, 'new-file')))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, io, json, contextlib, tempfile, time
+import unittest
+
+sys.path.insert(0, '..')
+import testrunner, support
+from zeroinstall import SafeException
+
+# Each shard records that it ran, waits for all the others to start (so they
+# must run in parallel) and then exits with the status in status-SHARD (if any).
+TEST_COMMAND = """#!/bin/sh
+# (a single shard's output isn't logged, but goes to the terminal)
+[ "$RELEASE_TEST_SHARDS" = 1 ] || echo "shard $RELEASE_TEST_SHARD of $RELEASE_TEST_SHARDS: $*"
+echo "$RELEASE_TEST_SHARD" >> runs
+touch started-$RELEASE_TEST_SHARD
+for i in $(seq 100); do
+	[ $(ls started-* | wc -l) -ge $WAIT_FOR ] && break
+	sleep 0.1
+done
+[ -f status-$RELEASE_TEST_SHARD ] && exit $(cat status-$RELEASE_TEST_SHARD)
+exit 0
+"""
+
+class TestTestRunner(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-test-')
+		self.old_dir = os.getcwd()
+		os.chdir(self.tmp)
+		self.test_command = os.path.join(self.tmp, 'run-tests')
+		with open(self.test_command, 'w') as stream:
+			stream.write(TEST_COMMAND)
+		os.chmod(self.test_command, 0o755)
+		self.results = testrunner.ResultCache(os.path.join(self.tmp, 'cache', 'results.json'))
+
+	def tearDown(self):
+		os.chdir(self.old_dir)
+		os.environ.pop('WAIT_FOR', None)
+		support.remove_tree(self.tmp)
+
+	def run_tests(self, shards, digest = 'sha256new_ABC', wait_for = None):
+		"""@return: the shards which ran, sorted (the output is left in self.output)"""
+		for name in os.listdir('.'):
+			if name.startswith('started-') or name == 'runs':
+				os.unlink(name)
+		os.environ['WAIT_FOR'] = str(wait_for or shards)
+		runner = testrunner.TestRunner(self.test_command, shards, self.results)
+		output = io.StringIO()
+		try:
+			with contextlib.redirect_stdout(output):
+				runner.run('feed.xml', digest)
+		finally:
+			self.output = output.getvalue()
+		if not os.path.exists('runs'):
+			return []
+		with open('runs') as stream:
+			return sorted(int(line) for line in stream)
+
+	def testParallel(self):
+		self.assertEqual([0, 1, 2], self.run_tests(3))
+		assert 'All 3 test shards passed' in self.output, self.output
+		for shard in range(3):
+			with open('test-shard-%d.log' % shard) as stream:
+				self.assertEqual('shard %d of 3: -- feed.xml\n' % shard, stream.read())
+
+		# Already passed
+		self.assertEqual([], self.run_tests(3))
+		assert 'already passed' in self.output, self.output
+
+		# ... but not for a different tree or a different split
+		self.assertEqual([0, 1, 2], self.run_tests(3, digest = 'sha256new_DEF'))
+		self.assertEqual([0, 1], self.run_tests(2))
+
+		# The results are saved
+		cache = testrunner.ResultCache(self.results.path)
+		self.assertTrue(cache.has_passed(testrunner.get_result_key('sha256new_DEF', self.test_command, 2, 3)))
+
+	def testFailure(self):
+		with open('status-1', 'w') as stream:
+			stream.write('1')
+		try:
+			self.run_tests(3)
+			assert 0
+		except SafeException as ex:
+			self.assertEqual('Self-test failed for 1 of 3 shard(s)', str(ex))
+		assert 'Test shard 1 FAILED with exit status 1 (see test-shard-1.log)' in self.output, self.output
+
+		# Only the failed shard runs again
+		os.unlink('status-1')
+		self.assertEqual([1], self.run_tests(3, wait_for = 1))
+
+		# Without a digest, nothing is cached
+		self.assertEqual([0, 1, 2], self.run_tests(3, digest = None))
+
+	def testSingleShard(self):
+		with open('status-0', 'w') as stream:
+			stream.write(str(testrunner.NO_TESTS))
+		self.assertEqual([0], self.run_tests(1))
+		assert 'SKIPPED unit tests' in self.output, self.output
+		self.assertFalse(os.path.exists('test-shard-0.log'))
+		# (skipped tests haven't passed)
+		self.assertEqual([0], self.run_tests(1))
+
+	def testExpiry(self):
+		old = testrunner.get_result_key('sha256new_OLD', self.test_command, 0, 1)
+		self.results.results[old] = time.time() - testrunner.MAX_AGE - 100
+		self.results.record_pass(testrunner.get_result_key('sha256new_NEW', self.test_command, 0, 1))
+		with open(self.results.path) as stream:
+			self.assertEqual([testrunner.get_result_key('sha256new_NEW', self.test_command, 0, 1)], list(json.load(stream)))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, re, tempfile
+import unittest
+
+sys.path.insert(0, '..')
+import versionsubst, support
+from zeroinstall import SafeException
+
+VERSION_LINE = re.compile("^version = '(.*)'$", re.MULTILINE)
+
+class TestVersionSubst(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-test-')
+
+	def tearDown(self):
+		support.remove_tree(self.tmp)
+
+	def write(self, rel_path, contents):
+		path = os.path.join(self.tmp, rel_path)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, 'wb') as stream:
+			stream.write(contents.encode('utf-8'))
+
+	def read(self, rel_path):
+		with open(os.path.join(self.tmp, rel_path), 'rb') as stream:
+			return stream.read().decode('utf-8')
+
+	def testSimple(self):
+		self.write('version.py', "# Hello\nversion = '0.1'\n")
+		changes = versionsubst.substitute(self.tmp, [('version.py', VERSION_LINE)], '0.2')
+		self.assertEqual([(os.path.join(self.tmp, 'version.py'), ['0.1'])], changes)
+		self.assertEqual("# Hello\nversion = '0.2'\n", self.read('version.py'))
+
+		# Already set
+		self.assertEqual([], versionsubst.substitute(self.tmp, [('version.py', VERSION_LINE)], '0.2'))
+
+	def testMissing(self):
+		self.write('version.py', "# Hello\n")
+		try:
+			versionsubst.substitute(self.tmp, [('version.py', VERSION_LINE)], '0.2')
+			assert 0
+		except SafeException as ex:
+			assert 'No matches' in str(ex), ex
+
+	def testGlobs(self):
+		self.write('src/a.py', "version = '0.1'\n")
+		self.write('src/sub/b.py', "version = '0.1'\n")
+		self.write('src/sub/none.py', "# No version here\n")
+		self.write('README', "version = '0.1'\n")
+		changes = versionsubst.substitute(self.tmp, [('src/**/*.py', VERSION_LINE)], '0.2', jobs = 2)
+		self.assertEqual(['src/a.py', 'src/sub/b.py'], sorted(os.path.relpath(path, self.tmp) for path, old in changes))
+		self.assertEqual("version = '0.2'\n", self.read('src/sub/b.py'))
+		self.assertEqual("# No version here\n", self.read('src/sub/none.py'))
+		self.assertEqual("version = '0.1'\n", self.read('README'))
+
+		try:
+			versionsubst.substitute(self.tmp, [('doc/*.txt', VERSION_LINE)], '0.2')
+			assert 0
+		except SafeException as ex:
+			assert 'No files match' in str(ex), ex
+
+	def testSeveralRules(self):
+		self.write('setup.py', "name = 'hello'\nversion = '0.1'\nrelease = '0.1'\n")
+		rules = [('setup.py', VERSION_LINE), ('setup.py', re.compile("^release = '(.*)'$", re.MULTILINE))]
+		versionsubst.substitute(self.tmp, rules, '0.10')
+		self.assertEqual("name = 'hello'\nversion = '0.10'\nrelease = '0.10'\n", self.read('setup.py'))
+
+	def testUnicodePatterns(self):
+		# \w matches non-ASCII letters in the feed's (str) pattern
+		self.write('a.py', "version = '1.0-β'\n")
+		versionsubst.substitute(self.tmp, [('a.py', re.compile(r"^version = '([\w.-]+)'$", re.MULTILINE))], '1.0')
+		self.assertEqual("version = '1.0'\n", self.read('a.py'))
+
+		# A non-ASCII character class
+		self.write('b.txt', "Versión: 1.0\n")
+		versionsubst.substitute(self.tmp, [('b.txt', re.compile("^Versi[oó]n: (.*)$", re.MULTILINE))], '2.0')
+		self.assertEqual("Versión: 2.0\n", self.read('b.txt'))
+
+	def testUnicodeData(self):
+		# "." must match a whole character, not one byte of it
+		self.write('a.py', "version = 'é'\n")
+		versionsubst.substitute(self.tmp, [('a.py', re.compile("^version = '(.)'$", re.MULTILINE))], '2')
+		self.assertEqual("version = '2'\n", self.read('a.py'))
+
+	def testCRLF(self):
+		self.write('a.py', "# Hello\r\nversion = '0.1'\r\n")
+		versionsubst.substitute(self.tmp, [('a.py', VERSION_LINE)], '0.2')
+		self.assertEqual("# Hello\nversion = '0.2'\n", self.read('a.py'))
+
+	def testLarge(self):
+		self.write('big.py', '#\n' * versionsubst.MMAP_THRESHOLD + "version = '0.1'\n")
+		versionsubst.substitute(self.tmp, [('big.py', VERSION_LINE)], '0.2')
+		self.assertTrue(self.read('big.py').endswith("\nversion = '0.2'\n"))
+
+if __name__ == '__main__':
+	unittest.main()
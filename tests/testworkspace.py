@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Copyright (C) 2007, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, io, tarfile, tempfile, time
+import unittest
+
+sys.path.insert(0, '..')
+import workspace, support
+
+def make_archive(path, files, mtime = 1000000000):
+	"""Write a tar.gz containing hello-1.0/<name> for each (name, contents) in files.
+	Names ending in '/' are directories; contents starting with '->' are symlinks."""
+	with tarfile.open(path, 'w:gz') as tar:
+		for name, contents in files:
+			member = tarfile.TarInfo('hello-1.0/' + name.rstrip('/'))
+			member.mtime = mtime
+			if name.endswith('/'):
+				member.type = tarfile.DIRTYPE
+				member.mode = 0o755
+				tar.addfile(member)
+			elif contents.startswith(b'->'):
+				member.type = tarfile.SYMTYPE
+				member.linkname = contents[2:].decode('utf-8')
+				tar.addfile(member)
+			else:
+				member.size = len(contents)
+				member.mode = 0o755 if contents.startswith(b'#!') else 0o644
+				tar.addfile(member, io.BytesIO(contents))
+
+class TestWorkspace(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-test-')
+		self.archive_file = os.path.join(self.tmp, 'hello-1.0.tar.gz')
+		self.target = os.path.join(self.tmp, 'workspace', 'src')
+		self.sync = workspace.SourceSync(self.target, os.path.join(self.tmp, 'workspace', 'manifest.json'))
+		self.files = [('src/', None), ('src/main.c', b'int main() {}\n'), ('src/util.c', b'void util() {}\n'),
+			      ('configure', b'#!/bin/sh\n'), ('README', b'Read me\n'), ('NOTES', b'->README')]
+
+	def tearDown(self):
+		support.remove_tree(self.tmp)
+
+	def sync_files(self, files, mtime = 1000000000):
+		make_archive(self.archive_file, files, mtime)
+		return self.sync.sync(self.archive_file, 'hello-1.0')
+
+	def read(self, rel_path):
+		with open(os.path.join(self.target, rel_path), 'rb') as stream:
+			return stream.read()
+
+	def mtime(self, rel_path):
+		return os.stat(os.path.join(self.target, rel_path)).st_mtime
+
+	def testSync(self):
+		self.assertEqual((5, 0, 0), self.sync_files(self.files))
+		self.assertEqual(b'int main() {}\n', self.read('src/main.c'))
+		self.assertEqual(1000000000, self.mtime('src/main.c'))
+		self.assertEqual(0o755, os.stat(os.path.join(self.target, 'configure')).st_mode & 0o777)
+		self.assertEqual('README', os.readlink(os.path.join(self.target, 'NOTES')))
+
+		# (a build product, which the sync must leave alone)
+		with open(os.path.join(self.target, 'src', 'main.o'), 'wb') as stream:
+			stream.write(b'object')
+
+		# The same source again changes nothing (even though the archive is newer)
+		self.assertEqual((0, 5, 0), self.sync_files(self.files, mtime = 1000000100))
+		self.assertEqual(1000000000, self.mtime('src/main.c'))
+
+		# Only the changed file is written; files no longer in the archive are removed
+		files = [f for f in self.files if f[0] != 'src/util.c' and f[0] != 'README' and f[0] != 'NOTES']
+		files += [('src/main.c', b'int main() { return 0; }\n'), ('NOTES', b'->configure')]
+		files.remove(('src/main.c', b'int main() {}\n'))
+		self.assertEqual((2, 1, 2), self.sync_files(files, mtime = 1000000200))
+		self.assertEqual(1000000200, self.mtime('src/main.c'))
+		self.assertEqual(1000000000, self.mtime('configure'))
+		self.assertEqual('configure', os.readlink(os.path.join(self.target, 'NOTES')))
+		self.assertFalse(os.path.exists(os.path.join(self.target, 'src', 'util.c')))
+		self.assertFalse(os.path.exists(os.path.join(self.target, 'README')))
+		self.assertEqual(b'object', self.read('src/main.o'))
+
+	def testLocalChanges(self):
+		self.sync_files(self.files)
+		# Files edited in the workspace are replaced...
+		with open(os.path.join(self.target, 'README'), 'wb') as stream:
+			stream.write(b'Edited\n')
+		# ... as are missing ones
+		os.unlink(os.path.join(self.target, 'src', 'util.c'))
+		self.assertEqual((2, 3, 0), self.sync_files(self.files))
+		self.assertEqual(b'Read me\n', self.read('README'))
+		self.assertEqual(b'void util() {}\n', self.read('src/util.c'))
+
+		# A damaged manifest means everything is written again
+		with open(self.sync.manifest_file, 'w') as stream:
+			stream.write('damaged')
+		self.assertEqual((5, 0, 0), self.sync_files(self.files))
+
+	def testEvict(self):
+		workspaces = os.path.join(self.tmp, 'workspaces')
+		now = time.time()
+		n = workspace.MAX_ENTRIES + 2
+		for i in range(n):
+			path = os.path.join(workspaces, 'ws%d' % i)
+			workspace.lock_workspace(path).close()
+			age = workspace.MAX_AGE + 100 if i == n - 1 else 100 * (i + 1)
+			os.utime(os.path.join(path, '.lock'), (now - age, now - age))
+
+		# ws0 is in use, so it can't be removed (and it can't be locked again)
+		lock = workspace.lock_workspace(os.path.join(workspaces, 'ws0'))
+		try:
+			try:
+				workspace.lock_workspace(os.path.join(workspaces, 'ws0'))
+				assert 0
+			except workspace.SafeException as ex:
+				assert 'in use' in str(ex), ex
+
+			os.utime(os.path.join(workspaces, 'ws0', '.lock'), (now - 10000, now - 10000))
+			# Only ws6 (too old) goes; ws0 is the least recently used, but in use
+			self.assertEqual(1, workspace.evict_workspaces(workspaces))
+			self.assertEqual(['ws%d' % i for i in range(n - 1)], sorted(os.listdir(workspaces)))
+		finally:
+			lock.close()
+
+		# (ws0 counts as used just now, so the oldest is now ws5)
+		self.assertEqual(1, workspace.evict_workspaces(workspaces))
+		self.assertEqual(['ws%d' % i for i in range(n - 2)], sorted(os.listdir(workspaces)))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,104 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Records how long each phase of a release and each subprocess takes,
+# for the --profile option.
+
+import os, time, json, threading, subprocess, contextlib
+
+_start = time.time()
+events = []
+
+def _now_us():
+	return int((time.time() - _start) * 1e6)
+
+def _add_event(name, category, start_us, end_us, args):
+	event = {
+		'name': name,
+		'cat': category,
+		'ph': 'X',
+		'ts': start_us,
+		'dur': end_us - start_us,
+		'pid': os.getpid(),
+		'tid': threading.get_ident(),
+		'args': args,
+	}
+	events.append(event)
+	return event
+
+@contextlib.contextmanager
+def phase(name, **args):
+	"""Record the time taken by the body of the with statement as a phase of the release.
+	The body may add extra details to the yielded dict."""
+	start = _now_us()
+	try:
+		yield args
+	finally:
+		_add_event(name, 'phase', start, _now_us(), args)
+
+def _describe(args):
+	if isinstance(args, (str, bytes)):
+		return str(args)
+	return ' '.join(str(a) for a in args)
+
+class Popen(subprocess.Popen):
+	"""A subprocess.Popen which records the process in the trace when it is reaped."""
+	def __init__(self, args, *posargs, **kwargs):
+		self._trace_start = _now_us()
+		self._trace_event = None
+		super().__init__(args, *posargs, **kwargs)
+		self._trace_name = _describe(args)
+
+	def wait(self, timeout = None):
+		code = super().wait(timeout)
+		if self._trace_event is None:
+			self._trace_event = _add_event(self._trace_name, 'process', self._trace_start, _now_us(), {'exit_code': code})
+		return code
+
+	def communicate(self, input = None, timeout = None):
+		stdout, stderr = super().communicate(input, timeout)
+		if self._trace_event is not None:
+			self._trace_event['args']['bytes'] = len(stdout or '') + len(stderr or '')
+		return stdout, stderr
+
+def call(*popenargs, **kwargs):
+	"""Like subprocess.call, but traced."""
+	with Popen(*popenargs, **kwargs) as child:
+		return child.wait()
+
+def write_trace(path):
+	"""Save the events in Chrome's trace event format (load with chrome://tracing or Perfetto)."""
+	tmp_name = path + '.new'
+	with open(tmp_name, 'w') as stream:
+		json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, stream)
+	os.rename(tmp_name, path)
+
+def format_summary():
+	"""A plain-text report of the time spent in each phase and in each program."""
+	lines = ['Time spent in each phase:']
+	for event in sorted(events, key = lambda e: e['ts']):
+		if event['cat'] == 'phase':
+			lines.append('  %8.2fs  %s' % (event['dur'] / 1e6, event['name']))
+
+	processes = [e for e in events if e['cat'] == 'process']
+	by_program = {}
+	for event in processes:
+		program = os.path.basename(event['name'].split(' ', 1)[0])
+		if program == 'sh' and ' -c ' in event['name']:
+			program = 'sh -c'
+		count, total = by_program.get(program, (0, 0))
+		by_program[program] = (count + 1, total + event['dur'])
+
+	lines.append('Subprocesses (%d in total):' % len(processes))
+	for program, (count, total) in sorted(by_program.items(), key = lambda x: -x[1][1]):
+		lines.append('  %8.2fs  %4d x %s' % (total / 1e6, count, program))
+
+	slowest = sorted(processes, key = lambda e: -e['dur'])[:5]
+	if slowest:
+		lines.append('Slowest subprocesses:')
+		for event in slowest:
+			name = event['name']
+			if len(name) > 70:
+				name = name[:67] + '...'
+			lines.append('  %8.2fs  %s (exit code %s)' % (event['dur'] / 1e6, name, event['args']['exit_code']))
+	return '\n'.join(lines)
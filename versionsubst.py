@@ -0,0 +1,160 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Applies the <release:update-version> rules, reading and writing each file once.
+
+import os, re, glob, mmap, collections
+from concurrent import futures
+from logging import info
+from zeroinstall import SafeException
+
+# Files at least this big are searched through a memory map, rather than read in
+MMAP_THRESHOLD = 1024 * 1024
+
+def is_glob(path):
+	"""Does path contain any glob characters?
+	>>> is_glob('src/version.py'), is_glob('src/**/*.py')
+	(False, True)
+	"""
+	return re.search('[*?[]', path) is not None
+
+# Escapes which match differently in str and bytes patterns (or aren't allowed in bytes ones)
+_UNICODE_ESCAPES = re.compile(r'\\[wWdDsSbBNuU]')
+
+_NON_ASCII = re.compile(b'[\x80-\xff]')
+
+def _to_bytes_regex(regex):
+	"""The regex from the feed (a str pattern) as a bytes pattern, so that ASCII files can be
+	searched without decoding them. On ASCII data, it matches exactly what regex does.
+	>>> _to_bytes_regex(re.compile("^version = '(.*)'$", re.MULTILINE)).pattern
+	b"^version = '(.*)'$"
+	>>> _to_bytes_regex(re.compile(r"^version = '([\\w.]+)'$", re.MULTILINE)) is None
+	True
+
+	@return: the bytes regex, or None if the pattern can't be converted"""
+	pattern = regex.pattern
+	if regex.flags & re.IGNORECASE or _UNICODE_ESCAPES.search(pattern) or _NON_ASCII.search(pattern.encode('utf-8')):
+		return None
+	return re.compile(pattern.encode('ascii'), regex.flags & ~re.UNICODE)
+
+class Rule:
+	def __init__(self, regex, required):
+		if regex.groups != 1:
+			raise SafeException("Regex '%s' must have exactly one matching () group" % regex.pattern)
+		self.regex = regex
+		self.bytes_regex = _to_bytes_regex(regex)	# (None if files must be decoded for this rule)
+		self.required = required	# Is it an error if there's no match?
+
+def group_rules(impl_dir, version_substitutions):
+	"""Expand glob paths and group the rules by file.
+	@param version_substitutions: a list of (path relative to impl_dir, regex)
+	@return: an OrderedDict mapping absolute paths to lists of Rules"""
+	by_file = collections.OrderedDict()
+	for (rel_path, regex) in version_substitutions:
+		assert not os.path.isabs(rel_path), rel_path
+		path = os.path.join(impl_dir, rel_path)
+		if is_glob(rel_path):
+			# (a file matched by a glob needn't contain a match itself)
+			paths = sorted(p for p in glob.glob(path, recursive = True) if os.path.isfile(p))
+			if not paths:
+				raise SafeException("No files match '%s' (in %s)" % (rel_path, impl_dir))
+			rule = Rule(regex, required = False)
+		else:
+			paths = [path]
+			rule = Rule(regex, required = True)
+		for path in paths:
+			by_file.setdefault(path, []).append(rule)
+	return by_file
+
+def _find_changes(data, path, rules):
+	"""@param data: the file's contents (str, bytes or a memory map)
+	@return: a sorted list of (start, end, old value) spans to replace with the new version"""
+	spans = []
+	for rule in rules:
+		regex = rule.regex if isinstance(data, str) else rule.bytes_regex
+		match = regex.search(data)
+		if match is None:
+			if rule.required:
+				raise SafeException("No matches for regex '%s' in '%s'" % (rule.regex.pattern, path))
+			continue
+		start, end = match.span(1)
+		assert start >= 0, "Version match group did not match (regexp=%s; match=%s)" % (rule.regex.pattern, match.group(0))
+		spans.append((start, end, match.group(1)))
+	spans.sort()
+	for (a, b) in zip(spans, spans[1:]):
+		if a[1] > b[0]:
+			raise SafeException("Version substitutions overlap in '%s'" % path)
+	return spans
+
+def _replace(data, spans, new):
+	pieces = []
+	pos = 0
+	for start, end, old in spans:
+		pieces += [data[pos:start], new]
+		pos = end
+	pieces.append(data[pos:])
+	return pieces
+
+def _substitute_text(path, rules, new_version):
+	"""Files with CR characters are handled as text with universal newlines, so that
+	patterns ending in "$" still match before CR-LF (and the file ends up with LF line
+	endings, as with earlier versions). So are files with non-ASCII characters and rules
+	which can only be matched against decoded text."""
+	with open(path, 'rt') as stream:
+		data = stream.read()
+	spans = _find_changes(data, path, rules)
+	with open(path, 'wt') as stream:
+		stream.writelines(_replace(data, spans, new_version))
+	return [old for start, end, old in spans if old != new_version]
+
+def _needs_text(data):
+	"""Must data be decoded before matching? (bytes patterns only match the same way on ASCII)"""
+	return data.find(b'\r') != -1 or _NON_ASCII.search(data) is not None
+
+def substitute_file(path, rules, new_version):
+	"""Apply all the rules for one file, reading it once and writing it (at most) once.
+	Each rule is matched against the file's original contents.
+	@return: a list of the old values that were replaced (empty if the file wasn't changed)"""
+	if any(rule.bytes_regex is None for rule in rules):
+		return _substitute_text(path, rules, new_version)
+	new = new_version.encode('utf-8')
+	with open(path, 'rb') as stream:
+		size = os.fstat(stream.fileno()).st_size
+		if size >= MMAP_THRESHOLD:
+			with mmap.mmap(stream.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+				if _needs_text(mapped):
+					data = None
+				else:
+					spans = _find_changes(mapped, path, rules)
+					if all(old == new for start, end, old in spans):
+						return []
+					data = mapped[:]
+		else:
+			data = stream.read()
+			if _needs_text(data):
+				data = None
+			else:
+				spans = _find_changes(data, path, rules)
+				if all(old == new for start, end, old in spans):
+					return []
+
+	if data is None:
+		return _substitute_text(path, rules, new_version)
+
+	with open(path, 'wb') as stream:
+		stream.writelines(_replace(data, spans, new))
+	return [old.decode('utf-8', 'replace') for start, end, old in spans if old != new]
+
+def substitute(impl_dir, version_substitutions, new_version, jobs = None):
+	"""Set the version in all the files, processing files in parallel.
+	@return: a list of (path, [old values]) for the files that were changed"""
+	by_file = group_rules(impl_dir, version_substitutions)
+	if len(by_file) <= 1:
+		results = [substitute_file(path, rules, new_version) for path, rules in by_file.items()]
+	else:
+		with futures.ThreadPoolExecutor(max_workers = jobs) as pool:
+			results = list(pool.map(lambda item: substitute_file(item[0], item[1], new_version), by_file.items()))
+	changes = [(path, old) for path, old in zip(by_file, results) if old]
+	for path, old in changes:
+		info("Version in %s: %s -> %s", os.path.relpath(path, impl_dir), ', '.join(sorted(set(old))), new_version)
+	return changes
@@ -0,0 +1,190 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Persistent build directories for "0release --build-slave --incremental-build".
+
+import os, json, hashlib, fcntl, time
+from logging import info
+from zeroinstall import SafeException
+from zeroinstall.support import basedir
+
+import archive, support
+
+MAX_ENTRIES = 5
+MAX_AGE = 60 * 24 * 60 * 60	# Workspaces not used for this long are removed
+
+def _get_workspaces_dir():
+	return os.path.join(basedir.xdg_cache_home, '0install.net', '0release', 'workspaces')
+
+def get_workspace_dir(feed):
+	"""The build workspace for feed, which is kept between releases
+	(in ~/.cache/0install.net/0release/workspaces)."""
+	uris = sorted(feed.feed_for) or [feed.get_name()]
+	key = hashlib.sha256('\n'.join(uris).encode('utf-8')).hexdigest()[:16]
+	name = feed.get_name().lower().replace(' ', '-') + '-' + key
+	return os.path.join(_get_workspaces_dir(), name)
+
+def lock_workspace(path):
+	"""Take an exclusive lock on the workspace at path (released when the result is closed)."""
+	os.makedirs(path, exist_ok = True)
+	stream = open(os.path.join(path, '.lock'), 'w')
+	try:
+		fcntl.flock(stream.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except OSError:
+		stream.close()
+		raise SafeException("Build workspace %s is in use by another build" % path)
+	return stream
+
+def evict_workspaces(workspaces_dir = None):
+	"""Remove workspaces which haven't been used for MAX_AGE, and then all but the
+	MAX_ENTRIES most recently used. Workspaces in use by another build are left alone.
+	The lock file's mtime is the time the workspace was last used (lock_workspace updates it).
+	@return: the number of workspaces removed"""
+	workspaces_dir = workspaces_dir or _get_workspaces_dir()
+	if not os.path.isdir(workspaces_dir):
+		return 0
+	entries = []
+	for entry in os.scandir(workspaces_dir):
+		try:
+			last_used = os.stat(os.path.join(entry.path, '.lock')).st_mtime
+		except OSError:
+			last_used = entry.stat().st_mtime
+		entries.append((last_used, entry.path))
+	entries.sort(reverse = True)
+	cutoff = time.time() - MAX_AGE
+	removed = 0
+	for i, (last_used, path) in enumerate(entries):
+		if i < MAX_ENTRIES and last_used >= cutoff:
+			continue
+		try:
+			lock = lock_workspace(path)
+		except SafeException:
+			continue
+		try:
+			info("Removing old build workspace %s", path)
+			support.remove_tree(path)
+			removed += 1
+		finally:
+			lock.close()
+	return removed
+
+def _stat_id(path):
+	st = os.lstat(path)
+	return [st.st_size, st.st_mtime_ns]
+
+class SourceSync:
+	"""Keeps a directory in step with the extract directory of successive source archives.
+	Only files whose contents changed are rewritten, and they get their mtimes from the
+	archive; unchanged files are left alone, so that make, etc, can see that they don't
+	need rebuilding.
+	A manifest of what was written is kept in manifest_file, so that the tree itself doesn't
+	need to be hashed each time. Files changed since the last sync are replaced too."""
+
+	def __init__(self, target, manifest_file):
+		self.target = target
+		self.manifest_file = manifest_file
+
+	def _load_manifest(self):
+		try:
+			with open(self.manifest_file, 'r') as stream:
+				return json.load(stream)
+		except (OSError, ValueError):
+			return {}
+
+	def _is_current(self, rel_path, old_entry, entry):
+		"""Is rel_path as described by old_entry (from the manifest), unmodified since, and
+		the same as entry? Entries are [type, sha256 or link target, executable, stat]."""
+		if old_entry is None or old_entry[:3] != entry[:3]:
+			return False
+		path = os.path.join(self.target, rel_path)
+		try:
+			if entry[0] == 'S':
+				return os.readlink(path) == entry[1]
+			return _stat_id(path) == old_entry[3]
+		except OSError:
+			return False
+
+	def sync(self, archive_file, extract):
+		"""Update target to match the extract directory of archive_file.
+		@return: (number of files written, number unchanged, number removed)"""
+		start = time.time()
+		old = self._load_manifest()
+		new = {}
+		written = unchanged = removed = 0
+		prefix = extract.strip('/') + '/'
+		os.makedirs(self.target, exist_ok = True)
+
+		with archive.open_tarball(archive_file) as tar:
+			for member in archive.iter_members(tar):
+				name = member.name
+				if not name.startswith(prefix): continue
+				rel_path = name[len(prefix):].strip('/')
+				if not rel_path: continue
+				path = archive._get_extract_path(self.target, rel_path)
+
+				if member.isdir():
+					if os.path.islink(path) or (os.path.exists(path) and not os.path.isdir(path)):
+						os.unlink(path)
+					os.makedirs(path, exist_ok = True)
+					new[rel_path] = ['D', None, 0, None]
+					continue
+
+				os.makedirs(os.path.dirname(path), exist_ok = True)
+				if member.issym():
+					entry = ['S', member.linkname, 0, None]
+					if self._is_current(rel_path, old.get(rel_path), entry):
+						unchanged += 1
+					else:
+						if os.path.lexists(path):
+							support.remove_tree(path)
+						os.symlink(member.linkname, path)
+						written += 1
+					new[rel_path] = entry
+				elif member.isfile() or member.islnk():
+					if member.isfile():
+						data = tar.extractfile(member).read()
+					else:
+						# (the stream can't go back to the target, but we've already written it)
+						with open(archive._get_extract_path(self.target, member.linkname[len(prefix):]), 'rb') as stream:
+							data = stream.read()
+					executable = 1 if member.mode & 0o111 else 0
+					entry = ['F', hashlib.sha256(data).hexdigest(), executable, None]
+					old_entry = old.get(rel_path)
+					if self._is_current(rel_path, old_entry, entry):
+						entry[3] = old_entry[3]
+						new[rel_path] = entry
+						unchanged += 1
+						continue
+					if os.path.lexists(path) and (os.path.islink(path) or not os.path.isfile(path)):
+						support.remove_tree(path)
+					tmp_name = path + '.0release-new'
+					with open(tmp_name, 'wb') as stream:
+						stream.write(data)
+					os.chmod(tmp_name, 0o755 if executable else 0o644)
+					os.utime(tmp_name, (member.mtime, member.mtime))
+					os.rename(tmp_name, path)
+					entry[3] = _stat_id(path)
+					new[rel_path] = entry
+					written += 1
+
+		# Remove anything from the previous release that isn't in this one (deepest first)
+		for rel_path in sorted(set(old) - set(new), reverse = True):
+			path = os.path.join(self.target, rel_path)
+			if os.path.lexists(path):
+				if old[rel_path][0] == 'D':
+					try:
+						os.rmdir(path)
+					except OSError:
+						continue	# (still contains files we didn't create)
+				else:
+					os.unlink(path)
+				removed += 1
+
+		tmp_name = self.manifest_file + '.new'
+		with open(tmp_name, 'w') as stream:
+			json.dump(new, stream)
+		os.rename(tmp_name, self.manifest_file)
+
+		info("Synced %s into %s in %.2fs: %d written, %d unchanged, %d removed",
+				archive_file, self.target, time.time() - start, written, unchanged, removed)
+		return written, unchanged, removed